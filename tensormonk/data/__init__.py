@@ -1,9 +1,14 @@
 """ TensorMONK :: data """
 
 __all__ = ["DataSets", "PascalVOC", "FewPerLabel", "FolderITTR",
-           "Flip", "ElasticSimilarity", "LMDB",
+           "Flip", "ElasticSimilarity", "LMDB", "FolderToLMDB",
            "RandomBlur", "RandomColor", "RandomNoise", "RandomTransforms",
-           "SuperResolutionData"]
+           "ShardWriter", "ShardDataset",
+           "ToMemmap", "MemmapDataset", "MemmapBatchSampler",
+           "PKBatchSampler", "AspectRatioBatchSampler",
+           "FolderIndex", "IndexedImageFolder",
+           "SuperResolutionData", "SampleCache",
+           "SharedBatchLoader", "ThreadLoader"]
 
 from .datasets import DataSets
 from .pascalvoc import PascalVOC
@@ -12,6 +17,16 @@ from .folderittr import FolderITTR
 from .transforms import Flip, ElasticSimilarity, RandomBlur, RandomColor,\
     RandomNoise, RandomTransforms
 from .lmdb_db import LMDB
+from .lmdb_builder import FolderToLMDB
+from .shards import ShardWriter, ShardDataset
+from .memmap import ToMemmap, MemmapDataset, MemmapBatchSampler
+from .samplers import PKBatchSampler, AspectRatioBatchSampler
+from .folder_index import FolderIndex, IndexedImageFolder
 from .sr_data import SuperResolutionData
+from .sample_cache import SampleCache
+from .shared_loader import SharedBatchLoader
+from .thread_loader import ThreadLoader
 
-del datasets, fewperlabel, folderittr, transforms, pascalvoc, lmdb_db
+del (datasets, fewperlabel, folderittr, transforms, pascalvoc, lmdb_db,
+     lmdb_builder, shards, memmap, samplers, folder_index, sample_cache,
+     shared_loader, thread_loader)
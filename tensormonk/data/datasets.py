@@ -2,6 +2,8 @@
 
 import os
 import torch
+import torch.nn.functional as F
+import numpy as np
 from torch.utils.data import DataLoader
 import multiprocessing
 from torchvision import datasets
@@ -9,6 +11,66 @@ from torchvision.transforms import RandomApply, ColorJitter, \
     RandomResizedCrop, RandomRotation, Compose, ToTensor, Normalize, \
     RandomHorizontalFlip, Resize
 from .pascalvoc import PascalVOC
+from .transforms import ElasticSimilarity, Flip, RandomTransforms
+
+
+class TensorLoader(object):
+    r"""Iterates over an in-memory tensor and labels in batches (by index
+    slicing, no worker processes). Augmentation is applied on the batch.
+
+    Args:
+        tensor (torch.Tensor): NCHW tensor of all the samples
+        targets (torch.Tensor): N labels
+        n_samples (int): samples per batch
+        shuffle (bool): shuffles the samples every epoch
+        augment (nn.Module, optional): batched augmentation, default = None
+    """
+    def __init__(self, tensor: torch.Tensor, targets: torch.Tensor,
+                 n_samples: int, shuffle: bool, augment=None):
+        self.tensor = tensor
+        self.targets = targets
+        self.n_samples = n_samples
+        self.shuffle = shuffle
+        self.augment = augment
+
+    def __len__(self):
+        return (self.tensor.size(0) + self.n_samples - 1) // self.n_samples
+
+    def __iter__(self):
+        n = self.tensor.size(0)
+        idx = torch.randperm(n) if self.shuffle else None
+        for i in range(0, n, self.n_samples):
+            if idx is None:
+                tensor = self.tensor[i:i + self.n_samples]
+                targets = self.targets[i:i + self.n_samples]
+            else:
+                tensor = self.tensor[idx[i:i + self.n_samples]]
+                targets = self.targets[idx[i:i + self.n_samples]]
+            if self.augment is not None:
+                if idx is None:
+                    tensor = tensor.clone()
+                tensor = self.augment(tensor)
+            yield tensor, targets
+
+
+def load_in_memory(data, tensor_size: tuple, mean: tuple, std: tuple):
+    r"""Converts all the samples of MNIST/FashionMNIST/CIFAR10/CIFAR100 to a
+    single normalized NCHW tensor and labels."""
+    tensor = data.data
+    if isinstance(tensor, np.ndarray):
+        tensor = torch.from_numpy(tensor)
+    # NHW (MNIST/FashionMNIST) or NHWC (CIFAR10/CIFAR100) to NCHW
+    tensor = tensor.unsqueeze(1) if tensor.dim() == 3 else \
+        tensor.permute(0, 3, 1, 2)
+    tensor = tensor.float().div_(255)
+    if tuple(tensor.shape[2:]) != tuple(tensor_size[2:]):
+        tensor = F.interpolate(tensor, size=tuple(tensor_size[2:]),
+                               mode="bilinear", align_corners=False)
+    if mean is not None:
+        mean = torch.Tensor(mean).view(1, -1, 1, 1)
+        std = torch.Tensor(std).view(1, -1, 1, 1)
+        tensor = tensor.sub_(mean).div_(std)
+    return tensor.contiguous(), torch.as_tensor(data.targets).long()
 
 
 def DataSets(dataset: str = "MNIST",
@@ -17,7 +79,8 @@ def DataSets(dataset: str = "MNIST",
              n_samples: int = 64,
              cpus: int = multiprocessing.cpu_count(),
              augment: bool = False,
-             normalize: bool = True):
+             normalize: bool = True,
+             in_memory: bool = False):
     r"""Train, validation and test dataset iterator for
     MNIST/FashionMNIST/CIFAR10/CIFAR100/PascalVOC2007/PascalVOC2012
 
@@ -33,6 +96,12 @@ def DataSets(dataset: str = "MNIST",
             and random rotation
         normalize (bool, optional): When True, uses default mean and std.
             When False, out tensor values range between 0-1
+        in_memory (bool, optional): When True, all the samples of MNIST/
+            FashionMNIST/CIFAR10/CIFAR100 are loaded into a single normalized
+            tensor, and batches are delivered by index slicing without
+            worker processes (TensorLoader). augment uses batched tensor
+            ops (ElasticSimilarity and Flip) instead of per-sample PIL
+            transforms.
 
     Return:
         train data iterator, test data iterator and n_labels
@@ -50,6 +119,7 @@ def DataSets(dataset: str = "MNIST",
         os.mkdir(folder)
 
     basics = [ToTensor()]
+    mean = std = None
     if dataset in ["mnist", "fashionmnist", "cifar10", "cifar100"]:
         n_labels = 10
         if dataset == "mnist":
@@ -58,25 +128,21 @@ def DataSets(dataset: str = "MNIST",
                 tensor_size = (1, 1, 28, 28)
             elif tensor_size[2] != 28 or tensor_size[3] != 28:
                 basics = [Resize(tensor_size[2:][::-1])] + basics
-            if normalize:
-                basics += [Normalize((0.1307,), (0.3081,))]
+            mean, std = (0.1307,), (0.3081,)
         if dataset == "fashionmnist":
             loader = datasets.FashionMNIST
             if tensor_size is None:
                 tensor_size = (1, 1, 28, 28)
             elif tensor_size[2] != 32 or tensor_size[3] != 32:
                 basics = [Resize(tensor_size[2:][::-1])] + basics
-            if normalize:
-                basics += [Normalize((0.5,), (0.5,))]
+            mean, std = (0.5,), (0.5,)
         if dataset == "cifar10":
             loader = datasets.CIFAR10
             if tensor_size is None:
                 tensor_size = (1, 3, 32, 32)
             elif tensor_size[2] != 32 or tensor_size[3] != 32:
                 basics = [Resize(tensor_size[2:][::-1])] + basics
-            if normalize:
-                basics += [Normalize((0.4914, 0.4822, 0.4465),
-                                     (0.2023, 0.1994, 0.2010))]
+            mean, std = (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
         if dataset == "cifar100":
             n_labels = 100
             loader = datasets.CIFAR100
@@ -84,9 +150,11 @@ def DataSets(dataset: str = "MNIST",
                 tensor_size = (1, 3, 32, 32)
             elif tensor_size[2] != 32 or tensor_size[3] != 32:
                 basics = [Resize(tensor_size[2:][::-1])] + basics
-            if normalize:
-                basics += [Normalize((0.5071, 0.4867, 0.4408),
-                                     (0.2675, 0.2565, 0.2761))]
+            mean, std = (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)
+        if normalize:
+            basics += [Normalize(mean, std)]
+        else:
+            mean = std = None
     elif dataset == "emnist":
         # TODO
         pass
@@ -115,6 +183,24 @@ def DataSets(dataset: str = "MNIST",
                             collate_fn=collate_fn)
         return trData, None, teData, n_labels, tensor_size
 
+    if in_memory:
+        teData = loader(root=folder, train=False, download=True)
+        teData = TensorLoader(*load_in_memory(teData, tensor_size, mean, std),
+                              n_samples, shuffle=False)
+        trData = loader(root=folder, train=True, download=False)
+        few_augs = None
+        if augment:
+            # batched tensor ops similar to the PIL augmentations
+            few_augs = [ElasticSimilarity(elastic=0., angle=16, scale=0.15,
+                                          translation=0.1, zoom_in_only=False)]
+            if dataset not in ["mnist", "fashionmnist"]:
+                few_augs += [Flip(horizontal=True)]
+            few_augs = RandomTransforms(
+                few_augs, [0.8] + [0.25] * (len(few_augs) - 1))
+        trData = TensorLoader(*load_in_memory(trData, tensor_size, mean, std),
+                              n_samples, shuffle=True, augment=few_augs)
+        return trData, None, teData, n_labels, tensor_size
+
     # test data
     teData = loader(root=folder, train=False, download=True,
                     transform=Compose(basics))
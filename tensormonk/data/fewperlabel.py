@@ -1,13 +1,14 @@
 """ TensorMONK :: data :: FewPerLabel """
 
 import os
-from random import shuffle
-from functools import reduce
-from PIL import Image as ImPIL
-from tqdm import trange
+from functools import partial
 import numpy as np
 from torch.utils.data import Dataset
 from torchvision import transforms
+from .samplers import PKBatchSampler, _rank_and_world_size
+from .folder_index import FolderIndex
+from .utils import open_image
+from .sample_cache import SampleCache
 
 IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
 
@@ -21,10 +22,15 @@ def list_images(folder):
 
 
 class FewPerLabel(Dataset):
-    r"""Folder iterator to sample n consecutive samples per label. Batch size
-    must be equal a multiplier of n to get valid sets. On a dataset with 10
-    labels, with n = 2, an example batch can yeild the following labels
-    0 0 2 2 6 6 1 1 6 6
+    r"""Folder iterator to sample n consecutive samples per label. Use
+    batch_sampler to get valid sets. On a dataset with 10 labels, with n = 2
+    and 5 labels per batch, an example batch can yeild the following labels
+    0 0 2 2 6 6 1 1 7 7
+
+    Example:
+        >>> data = FewPerLabel("../data/train", (1, 3, 64, 64), 2)
+        >>> loader = torch.utils.data.DataLoader(
+                data, batch_sampler=data.batch_sampler(16), num_workers=8)
 
     Args:
         path: full path to folders, where each folder represents a class
@@ -33,45 +39,57 @@ class FewPerLabel(Dataset):
         process_image: None (reads and resizes to tensor_size) or function to
                        read and modify
         augmentations: a list/tuple of functions to augment pil image
+        cache_index: When True, uses cached FolderIndex (only folders that
+                     changed are rescanned)
+        shared_cache: bytes of SampleCache (0 = disabled) shared by all the
+                      DataLoader workers -- images from process_image (before
+                      augmentations) larger than tensor_size are not cached.
+                      The cache is removed when the dataset is garbage
+                      collected or the process exits
 
     Returns:
         a torch.Tensor image with values in the range [0, 1] and
         torch.LongTensor label
     """
     def __init__(self, path, tensor_size, n_consecutive, process_image=None,
-                 augmentations=[], n_samples=int(1e6)):
-        # get all folders
+                 augmentations=[], n_samples=int(1e6),
+                 cache_index: bool = True, shared_cache: int = 0):
+        # get all folders and images -- only immediate folders
         if isinstance(path, str):
             path = [path]
         folders = []
         for p in path:
-            for folder in next(os.walk(p))[1]:  # only immediate folders
-                folders.append(os.path.join(p, folder))
-        self.folders = sorted(folders)
+            index = FolderIndex(p, IMAGE_EXTENSIONS, cache=cache_index)
+            for folder, images in zip(index.folders, index.per_label()):
+                folder = os.path.join(p, folder)
+                # only immediate images (the index has sub folders)
+                folders.append((folder, [x for x in images if
+                                         os.path.dirname(x) == folder]))
+        folders = sorted(folders)
+        self.folders = [x for x, _ in folders]
 
         # read all images -- creates a list of lists
         self.dataset = []
         self.n_per_label = []
-        for i in trange(len(self.folders), desc="CouplePerClass"):
-            images = list_images(folders[i])
+        for _, images in folders:
             if len(images) > 0:
                 self.dataset.append(images)
                 self.n_per_label.append(len(images))
 
-        # random list to pick labels and samples
+        # flat list of images and their labels (used by batch_sampler)
         self.n_labels = len(self.dataset)
         self.n_consecutive = n_consecutive
-        self.true_n_samples = np.sum(self.n_per_label)
-        self.random_labels = self.get_random_list(self.n_labels, None,
-                                                  self.n_consecutive)
+        self.true_n_samples = int(np.sum(self.n_per_label))
+        self.samples = [x for images in self.dataset for x in images]
+        self.targets = np.repeat(np.arange(self.n_labels),
+                                 self.n_per_label).astype(np.int64)
 
         # process_image
         self.tensor_size = tensor_size
         if process_image is None:
-            def process_image(x):
-                x = ImPIL.open(x)
-                x = x.resize((tensor_size[3], tensor_size[2]), ImPIL.BILINEAR)
-                return x
+            # reduced resolution decode for large jpegs
+            process_image = partial(open_image,
+                                    size=(tensor_size[3], tensor_size[2]))
         self.process_image = process_image
 
         # augmentations
@@ -79,36 +97,47 @@ class FewPerLabel(Dataset):
         self.n_samples = n_samples
         self.to_tensor = transforms.ToTensor()
 
+        # decoded images shared by all the workers
+        self.sample_cache = None
+        if shared_cache > 0:
+            self.sample_cache = SampleCache(
+                SampleCache.name_of(SampleCache.stat_of(self.samples),
+                                    SampleCache.identity_of(process_image),
+                                    tuple(tensor_size), shared_cache),
+                self.true_n_samples,
+                tensor_size[2] * tensor_size[3] * 3, shared_cache,
+                unlink_on_exit=True)
+
     def __len__(self):
         return self.n_samples
 
     def __getitem__(self, idx):
-        label = self.random_labels.pop(0)
-        file_name = self.dataset[label][idx % self.n_per_label[label]]
-        image = self.process_image(file_name)
+        idx = idx % self.true_n_samples
+        file_name, label = self.samples[idx], int(self.targets[idx])
+        if self.sample_cache is None:
+            image = self.process_image(file_name)
+        else:
+            image = self.sample_cache.fetch_image(
+                idx, partial(self.process_image, file_name))
 
         for fn in self.augmentations:
             image = fn(image)
 
         if self.tensor_size[1] == 1:
             image = image.convert("L")
-
-        if len(self.random_labels) == 0:
-            # generates random order of labels
-            self.random_labels = self.get_random_list(self.n_labels, label,
-                                                      self.n_consecutive)
         return self.to_tensor(image), label
 
-    @staticmethod
-    def get_random_list(n_labels, last=None, n_consecutive=1):
-        random_labels = list(range(0, n_labels))
-        shuffle(random_labels)
-        if last is not None and last == random_labels[0]:
-            random_labels = random_labels[1:] + random_labels[:1]
-        if n_consecutive > 1:
-            random_labels = [[x] * n_consecutive for x in random_labels]
-            random_labels = reduce(lambda x, y: x + y, random_labels)
-        return random_labels
+    def batch_sampler(self, n_labels_per_batch: int, seed: int = 0,
+                      rank: int = None, world_size: int = None):
+        r"""PKBatchSampler with n_labels_per_batch x n_consecutive samples per
+        batch and n_samples // batch size batches per epoch (split across
+        distributed ranks). """
+        rank, world_size = _rank_and_world_size(rank, world_size)
+        batch_size = n_labels_per_batch * self.n_consecutive
+        n_batches = max(1, self.n_samples // (batch_size * world_size))
+        return PKBatchSampler(self.targets, n_labels_per_batch,
+                              self.n_consecutive, n_batches, seed,
+                              rank, world_size)
 
 
 # import core
@@ -117,7 +146,8 @@ class FewPerLabel(Dataset):
 #     (1, 3, 128, 128), 2, process_image=None,
     # augmentations=[], n_samples=int(500))
 # trDataLoader = torch.utils.data.DataLoader(trData,
-#     batch_size=16, shuffle=True, num_workers=multiprocessing.cpu_count())
+#     batch_sampler=trData.batch_sampler(8),
+#     num_workers=multiprocessing.cpu_count())
 #
 # for x, y in trDataLoader:
 #     break
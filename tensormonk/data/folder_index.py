@@ -0,0 +1,229 @@
+""" TensorMONK :: data :: FolderIndex """
+
+__all__ = ["FolderIndex", "IndexedImageFolder"]
+
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from torchvision import datasets
+
+IMAGE_EXTENSIONS = datasets.folder.IMG_EXTENSIONS
+
+
+def scan_folder(folder: str, extensions: tuple):
+    r""" Returns mtime of folder (latest of folder and its sub folders),
+    (name, size, mtime) of files (names are relative to folder, in the order
+    of ImageFolder) and sub folders """
+    mtime, files, subdirs = os.stat(folder).st_mtime, [], []
+    for root, _, names in sorted(os.walk(folder, followlinks=True)):
+        relative = os.path.relpath(root, folder)
+        if relative != ".":
+            subdirs.append(relative)
+            mtime = max(mtime, os.stat(root).st_mtime)
+        for name in sorted(names):
+            if not name.lower().endswith(extensions):
+                continue
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((os.path.relpath(path, folder), stat.st_size,
+                              stat.st_mtime))
+    return mtime, files, subdirs
+
+
+def folder_mtime(folder: str, subdirs: list):
+    r""" Returns the latest mtime of folder and its sub folders (-1 when a
+    sub folder is removed) """
+    try:
+        return max([os.stat(folder).st_mtime] + [
+            os.stat(os.path.join(folder, x)).st_mtime for x in subdirs])
+    except FileNotFoundError:
+        return -1.
+
+
+class FolderIndex(object):
+    r"""Index of a folder of class folders (each folder represents a label)
+    with image names, labels, sizes and mtimes. Folders (and their sub
+    folders, same as ImageFolder) are scanned in parallel (threads) and the
+    index is saved to a cache file (path/.tensormonk_index.npz). Later, the
+    cache is loaded and only the folders whose mtime (or the mtime of a sub
+    folder) changed (files are added/removed/renamed) are rescanned.
+
+    Example:
+        >>> index = FolderIndex("../data/train")
+        >>> index.folders, index.files, index.labels
+
+    Args:
+        path (str): full path to folders, where each folder represents a class
+        extensions (tuple, optional): valid file extensions (("", ) for all
+            files), default = torchvision.datasets.folder.IMG_EXTENSIONS
+        cache (bool, optional): When True, loads and saves the cache.
+            default = True
+        n_threads (int, optional): threads used to scan, default = 16
+
+    ** A cache that can not be written (read-only path) is ignored with a
+    warning.
+    """
+    CACHE = ".tensormonk_index.npz"
+
+    def __init__(self, path: str, extensions: tuple = IMAGE_EXTENSIONS,
+                 cache: bool = True, n_threads: int = 16):
+        if not isinstance(path, str):
+            raise TypeError("FolderIndex: path must be str")
+        if not os.path.isdir(path):
+            raise ValueError("FolderIndex: path is not valid dir")
+        if not isinstance(cache, bool):
+            raise TypeError("FolderIndex: cache must be bool")
+
+        self.path = path
+        self.extensions = tuple(x.lower() for x in extensions)
+        self.n_threads = n_threads
+        self.n_rescanned = 0
+        folders = sorted(x.name for x in os.scandir(path) if x.is_dir())
+
+        cached = self.load() if cache else {}
+        # rescan new folders and folders with new mtime
+        with ThreadPoolExecutor(n_threads) as pool:
+            mtimes = list(pool.map(
+                lambda x: folder_mtime(os.path.join(path, x),
+                                       cached[x][2] if x in cached else []),
+                folders))
+            rescan = [x for x, mtime in zip(folders, mtimes)
+                      if x not in cached or cached[x][0] != mtime]
+            scanned = pool.map(
+                lambda x: scan_folder(os.path.join(path, x), self.extensions),
+                rescan)
+            cached.update(dict(zip(rescan, scanned)))
+        self.n_rescanned = len(rescan)
+
+        self.folders = folders
+        self.folder_mtimes = np.array([cached[x][0] for x in folders])
+        files, labels, sizes, mtimes = [], [], [], []
+        self.subdirs = [cached[x][2] for x in folders]
+        for label, folder in enumerate(folders):
+            for name, size, mtime in cached[folder][1]:
+                files.append(os.path.join(folder, name))
+                labels.append(label)
+                sizes.append(size)
+                mtimes.append(mtime)
+        self.files = files
+        self.labels = np.array(labels, dtype=np.int64)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.mtimes = np.array(mtimes, dtype=np.float64)
+        if cache and (self.n_rescanned or len(cached) != len(folders)):
+            self.save()
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def samples(self):
+        r""" A list of (full path, label) """
+        return [(os.path.join(self.path, x), int(y))
+                for x, y in zip(self.files, self.labels)]
+
+    def per_label(self):
+        r""" A list of full paths per label (folder) """
+        out = [[] for _ in self.folders]
+        for x, y in zip(self.files, self.labels):
+            out[y].append(os.path.join(self.path, x))
+        return out
+
+    def load(self):
+        r""" Returns {folder: (mtime, [(name, size, mtime), ...],
+        [sub folder, ...])} """
+        file_name = os.path.join(self.path, FolderIndex.CACHE)
+        if not os.path.isfile(file_name):
+            return {}
+        try:
+            content = np.load(file_name)
+            if tuple(content["extensions"].tolist()) != self.extensions:
+                return {}
+            cached = {x: (t, [], []) for x, t in zip(
+                content["folders"].tolist(),
+                content["folder_mtimes"].tolist())}
+            folders = content["folders"].tolist()
+            for f, name, size, mtime in zip(
+                    content["owners"].tolist(), content["names"].tolist(),
+                    content["sizes"].tolist(), content["mtimes"].tolist()):
+                cached[folders[f]][1].append((name, size, mtime))
+            for f, name in zip(content["subdir_owners"].tolist(),
+                               content["subdirs"].tolist()):
+                cached[folders[f]][2].append(name)
+        except (OSError, KeyError, ValueError):
+            return {}
+        return cached
+
+    def save(self):
+        r""" Saves the index to path/.tensormonk_index.npz """
+        file_name = os.path.join(self.path, FolderIndex.CACHE)
+        owners = self.labels
+        names = [os.path.relpath(x, self.folders[y])
+                 for x, y in zip(self.files, owners)]
+        subdir_owners = [i for i, x in enumerate(self.subdirs) for _ in x]
+        subdirs = [y for x in self.subdirs for y in x]
+        try:
+            with open(file_name + ".tmp", "wb") as f:
+                np.savez(f, folders=np.array(self.folders, dtype=str),
+                         folder_mtimes=self.folder_mtimes,
+                         owners=owners, names=np.array(names, dtype=str),
+                         sizes=self.sizes, mtimes=self.mtimes,
+                         subdir_owners=np.array(subdir_owners,
+                                                dtype=np.int64),
+                         subdirs=np.array(subdirs, dtype=str),
+                         extensions=np.array(self.extensions, dtype=str))
+            os.replace(file_name + ".tmp", file_name)
+        except OSError as e:
+            warnings.warn("FolderIndex: unable to save cache - {}".format(e))
+
+
+class IndexedImageFolder(datasets.ImageFolder):
+    r"""torchvision.datasets.ImageFolder that uses FolderIndex (cached) to
+    find classes and images. Accepts all the arguments of ImageFolder along
+    with cache (see FolderIndex) and sample_cache (a SampleCache of images
+    from loader, keys are indices of samples). Samples are the same as
+    ImageFolder -- IMG_EXTENSIONS, or is_valid_file (the index has all the
+    files) when given.
+    """
+    def __init__(self, root: str, *args, cache: bool = True,
+                 sample_cache=None, **kwargs):
+        # ImageFolder(root, transform, target_transform, loader,
+        #             is_valid_file, ...)
+        is_valid_file = args[3] if len(args) > 3 else \
+            kwargs.get("is_valid_file")
+        self.index = FolderIndex(root, IMAGE_EXTENSIONS if is_valid_file is
+                                 None else ("", ), cache=cache)
+        self.sample_cache = sample_cache
+        super(IndexedImageFolder, self).__init__(root, *args, **kwargs)
+
+    def __getitem__(self, index: int):
+        if self.sample_cache is None:
+            return super(IndexedImageFolder, self).__getitem__(index)
+        path, target = self.samples[index]
+        sample = self.sample_cache.fetch_image(index,
+                                               lambda: self.loader(path))
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def find_classes(self, directory: str):
+        return self.index.folders, {x: i for i, x in
+                                    enumerate(self.index.folders)}
+
+    def make_dataset(self, directory: str, class_to_idx: dict,
+                     extensions: tuple = None, is_valid_file=None,
+                     allow_empty: bool = False):
+        if extensions is not None:
+            def is_valid_file(x: str):
+                return datasets.folder.has_file_allowed_extension(
+                    x, extensions)
+        samples = [x for x in self.index.samples if is_valid_file(x[0])]
+        empty = set(range(len(self.index.folders))) - {y for _, y in samples}
+        if empty and not allow_empty:
+            raise FileNotFoundError(
+                "IndexedImageFolder: found no valid file for the classes " +
+                ", ".join(sorted(self.index.folders[x] for x in empty)))
+        return samples
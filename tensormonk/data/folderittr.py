@@ -1,18 +1,26 @@
 """ TensorMONK :: data :: FolderITTR """
 
-import os
 import torch
-import torchvision.datasets as DataSET
 import torchvision.transforms as DataMods
 from random import random as rand01
 from PIL import Image as ImPIL
+from functools import partial
+from .folder_index import IndexedImageFolder
+from .utils import open_image
+from .sample_cache import SampleCache
 
 
 def FolderITTR(data_path, BSZ,
                tensor_size=(6, 3, 28, 28),
                cpus=6,
                functions=[],
-               random_flip=True):
+               random_flip=True,
+               cache_index=True,
+               shared_cache=0):
+    r"""ImageFolder (cached index) loader. When functions is empty, images
+    are decoded at tensor_size, and shared_cache > 0 (bytes) caches them in a
+    SampleCache that is shared by all the workers (later epochs skip
+    decoding, the cache is removed when the process exits). """
 
     def flip(x):
         return x.transpose(ImPIL.FLIP_LEFT_RIGHT) if rand01() > .5 else x
@@ -20,11 +28,26 @@ def FolderITTR(data_path, BSZ,
     def resize(x):
         return x.resize((tensor_size[3], tensor_size[2]), ImPIL.BILINEAR)
 
-    mods = list(functions) + [resize, ] + ([flip, ] if random_flip else []) + \
-        [DataMods.ToTensor(), ]
-    data = DataSET.ImageFolder(data_path, DataMods.Compose(mods))
+    # without functions, the loader resizes (reduced resolution decode for
+    # large jpegs)
+    kwargs = {}
+    if len(functions) == 0:
+        kwargs["loader"] = partial(open_image, mode="RGB",
+                                   size=(tensor_size[3], tensor_size[2]))
+    mods = list(functions) + ([] if kwargs else [resize, ]) + \
+        ([flip, ] if random_flip else []) + [DataMods.ToTensor(), ]
+    data = IndexedImageFolder(data_path, DataMods.Compose(mods),
+                              cache=cache_index, **kwargs)
+    if shared_cache > 0 and len(functions) == 0:
+        data.sample_cache = SampleCache(
+            SampleCache.name_of(
+                SampleCache.stat_of([x for x, _ in data.samples]),
+                SampleCache.identity_of(data.loader), tuple(tensor_size),
+                shared_cache),
+            len(data), tensor_size[2] * tensor_size[3] * 3, shared_cache,
+            unlink_on_exit=True)
     data_loader = torch.utils.data.DataLoader(data, batch_size=BSZ,
                                               shuffle=True, num_workers=cpus)
-    n_labels = len(next(os.walk(data_path))[1])
+    n_labels = len(data.classes)
 
     return (data_loader, n_labels)
@@ -2,56 +2,141 @@
 
 import time
 import numpy as np
-from threading import Thread
+import torch
+from threading import Thread, Condition
 import cv2
 
 
 class Camera:
-    r""" Extended on imutils.WebcamVideoStream with frame averaging (can be
-    used as an iterator) """
-    live = False
-    frame = None
-    video = None
+    r"""Extended on imutils.WebcamVideoStream with frame averaging (can be
+    used as an iterator). Every instance has a capture thread that writes
+    frames to a preallocated ring buffer of buffer_size frames (a single
+    writer publishes a frame by incrementing a counter after the write, so
+    readers never lock the buffer).
 
+    Example:
+        >>> with Camera(0, rgb=True) as camera:
+        >>>     frame = camera.get()          # next frame (blocking)
+        >>>     batch = camera.get_batch(4)   # last 4 frames (pinned tensor)
+
+        >>> for frame in Camera("./video.mp4", realtime=False).initialize():
+        >>>     pass
+
+    Args:
+        gizmo (int/str): camera index or a video file/stream, default = 0
+        rgb (bool): When True, frames are RGB (else BGR), default = False
+        mirror (bool): When True, frames are mirrored, default = False
+        average_frames (int): averages consecutive frames to minimize motion
+            blur (max 6), default = 1
+        buffer_size (int): frames in the ring buffer, default = 8
+        realtime (bool): When True, video files are read at their frame rate
+            (else, as fast as possible). default = True
+        pin_memory (bool): When True (and cuda is available), the ring buffer
+            and get_batch are in pinned memory. default = True
+    """
     def __init__(self,
-                 gizmo: int = 0,
+                 gizmo=0,
                  rgb: bool = False,
                  mirror: bool = False,
-                 average_frames: int = 1):
+                 average_frames: int = 1,
+                 buffer_size: int = 8,
+                 realtime: bool = True,
+                 pin_memory: bool = True):
 
+        if not isinstance(buffer_size, int) or buffer_size < 2:
+            raise ValueError("Camera: buffer_size must be int >= 2")
         # additional args
         self.rgb = rgb
         self.mirror = mirror
-        self.average_frames = min(6, average_frames)
+        self.average_frames = max(1, min(6, average_frames))
+        self.is_file = isinstance(gizmo, str)
+        self.realtime = realtime
 
         # camera
-        Camera.video = cv2.VideoCapture(gizmo)
-        Camera.live = True
-        self._grab_a_frame()
-        while Camera.frame is None:
-            time.sleep(0.)
-            self._grab_a_frame()
+        self.video = cv2.VideoCapture(gizmo)
+        if not self.video.isOpened():
+            raise ValueError("Camera: unable to open {}".format(gizmo))
+        fps = self.video.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and fps > 0 else 30.
+        frame = self._grab_a_frame()
+        if frame is None:
+            raise ValueError("Camera: unable to read {}".format(gizmo))
+
+        # ring buffer -- frame i is in slot i % buffer_size
+        self.buffer_size = buffer_size
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.buffer = torch.empty((buffer_size, ) + frame.shape,
+                                  dtype=torch.uint8)
+        if self.pin_memory:
+            self.buffer = self.buffer.pin_memory()
+        self._frames = self.buffer.numpy()
+        self._frames[0] = frame
+        self.count = 1
+        self._last = 0
+        self._batches = {}
+        self._new_frame = Condition()
+        self.live = False
+        self._thread = None
 
     def initialize(self):
-        Thread(target=self._continuous_feed, args=()).start()
+        r""" Starts the capture thread """
+        if self._thread is None:
+            self.live = True
+            self._thread = Thread(target=self._continuous_feed, daemon=True)
+            self._thread.start()
         return self
 
+    start = initialize
+
+    def stop(self):
+        r""" Stops the capture thread and releases the camera """
+        self.live = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.video.release()
+
+    def __enter__(self):
+        return self.initialize()
+
+    def __exit__(self, *args):
+        self.stop()
+
     def _continuous_feed(self):
-        while True:
-            if not Camera.live:
-                return
-            self._grab_a_frame()
+        interval = 1. / self.fps
+        next_time = time.perf_counter()
+        try:
+            while self.live:
+                if self.is_file and self.realtime:
+                    next_time += interval
+                    time.sleep(max(0., next_time - time.perf_counter()))
+                frame = self._grab_a_frame()
+                if frame is None:
+                    break
+                self._frames[self.count % self.buffer_size] = frame
+                with self._new_frame:
+                    self.count += 1
+                    self._new_frame.notify_all()
+        finally:
+            # iterators wait while live -- a failed read must end them
+            with self._new_frame:
+                self.live = False
+                self._new_frame.notify_all()
 
     def _grab_a_frame(self):
         if self.average_frames == 1:
-            frame = Camera.video.read()[1]
+            success, frame = self.video.read()
+            if not success:
+                return None
         else:
             # frame averaging to minimize motion blur
             accumulate = None
             for _ in range(self.average_frames):
-                frame = Camera.video.read()[1].astype(np.float32)[1]
+                success, frame = self.video.read()
+                if not success:
+                    return None
                 if accumulate is None:
-                    accumulate = frame
+                    accumulate = frame.astype(np.float32)
                 else:
                     accumulate += frame
             frame = (accumulate / self.average_frames).astype(np.uint8)
@@ -59,19 +144,82 @@ class Camera:
             frame = frame[:, :, [2, 1, 0]]
         if self.mirror:
             frame = frame[:, ::-1, :]
-        Camera.frame = frame
+        return frame
+
+    def _wait(self, count: int, timeout: float):
+        r""" Waits till self.count >= count (or timeout/end of stream) """
+        with self._new_frame:
+            return self._new_frame.wait_for(
+                lambda: self.count >= count or not self.live, timeout)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        return self.read()
+        # a live camera can stall (or run below its frame rate) -- stops at
+        # the end of a video file or on stop()
+        while True:
+            live = self.live
+            frame = self.get()
+            if frame is not None:
+                return frame
+            if not live:
+                raise StopIteration
 
     def read(self):
-        return Camera.frame
+        r""" Latest frame (non-blocking) """
+        return self._frames[(self.count - 1) % self.buffer_size].copy()
+
+    def get(self, timeout: float = None):
+        r"""Returns the next frame (newer than the last frame returned by
+        get), waits for at most timeout seconds (default = 4 frames at the
+        frame rate). Returns None when there is no new frame (Ex: end of
+        video file or a stalled camera). Iterating over the camera waits
+        while the capture thread is live.
+
+        ** When the consumer is slower than the camera, older frames are
+        skipped (the latest frame is returned).
+        """
+        if timeout is None:
+            timeout = 4. / self.fps
+        if self.count <= self._last:
+            self._wait(self._last + 1, timeout)
+        count = self.count
+        if count <= self._last:
+            return None
+        frame = self._frames[(count - 1) % self.buffer_size].copy()
+        self._last = count
+        return frame
+
+    def get_batch(self, n: int, timeout: float = None):
+        r"""Returns the last n frames (oldest to newest) as a uint8 tensor of
+        shape n x height x width x channels (pinned when pin_memory is True
+        and cuda is available). Waits for n frames when the camera has fewer
+        than n frames (at most timeout seconds, default = n + 4 frames at the
+        frame rate). The returned tensor is reused by the next get_batch(n).
+        """
+        if not 1 <= n < self.buffer_size:
+            raise ValueError("Camera: n must be in [1, buffer_size)")
+        if timeout is None:
+            timeout = (n + 4.) / self.fps
+        if self.count < n:
+            self._wait(n, timeout)
+        if n not in self._batches:
+            batch = torch.empty((n, ) + self.buffer.shape[1:],
+                                dtype=torch.uint8)
+            self._batches[n] = batch.pin_memory() if self.pin_memory else \
+                batch
+        count = self.count
+        idx = torch.arange(count - n, count).clamp(0) % self.buffer_size
+        # n < buffer_size, so the writer is a slot ahead of the oldest frame
+        torch.index_select(self.buffer, 0, idx, out=self._batches[n])
+        self._last = max(self._last, count)
+        return self._batches[n]
 
 # from matplotlib import pyplot as plt
 # camera = Camera().initialize()
 # %timeit camera.read()
 # %timeit next(camera)
+# %timeit camera.get_batch(4)
 # plt.imshow(camera.read())
+# camera.stop()
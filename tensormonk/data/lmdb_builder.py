@@ -0,0 +1,205 @@
+""" TensorMONK's :: data :: FolderToLMDB """
+
+__all__ = ["FolderToLMDB"]
+
+import os
+import io
+import json
+import lmdb
+import hashlib
+import msgpack
+import multiprocessing
+from .lmdb_db import LMDB, get_cipher
+from .folder_index import FolderIndex
+from .utils import open_image
+
+
+_WORKER = {}
+
+
+def _worker_initialize(tensor_size: tuple, image_format: str, cipher: str,
+                       key: bytes):
+    r""" Sets the per process state (resize, format and encryption key) """
+    _WORKER["tensor_size"] = tensor_size
+    _WORKER["image_format"] = image_format
+    _WORKER["encrypt"] = None
+    if key is not None:
+        _WORKER["encrypt"] = get_cipher(cipher, key)[0]
+
+
+def _worker_encode(sample: tuple):
+    r""" Reads, resizes, encrypts and packs a sample (image file, label) into
+    the record format used by LMDB._encode """
+    file_name, label = sample
+    t_size = _WORKER["tensor_size"]
+    if t_size is None:
+        with open(file_name, "rb") as f:
+            content = f.read()
+    else:
+        image = open_image(file_name, (t_size[3], t_size[2]),
+                           "L" if t_size[1] == 1 else "RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=_WORKER["image_format"])
+        content = buffer.getvalue()
+
+    name = file_name.encode()
+    if _WORKER["encrypt"] is not None:
+        content = _WORKER["encrypt"].encrypt(content)
+        name = _WORKER["encrypt"].encrypt(name)
+
+    record = {
+        "image": {b"type": LMDB.ATTRIBUTE_TYPES.index("image"),
+                  b"content": content, b"dtype": b"", b"image_name": name},
+        "label": {b"type": LMDB.ATTRIBUTE_TYPES.index(int),
+                  b"content": str(label), b"dtype": b"", b"image_name": b""}}
+    return msgpack.packb(record, use_bin_type=True)
+
+
+def _build_info(path: str, samples: list, tensor_size: tuple,
+                image_format: str, encrypt: bool, cipher: str):
+    r""" Describes a build -- number of samples, sha256 of the ordered
+    (relative file name, label) list and the arguments that change records """
+    digest = hashlib.sha256()
+    for file_name, label in samples:
+        name = os.path.relpath(file_name, path)
+        digest.update("{}\t{}\n".format(name, label).encode())
+    return {"n_samples": len(samples), "sha256": digest.hexdigest(),
+            "tensor_size": None if tensor_size is None else
+            list(tensor_size[1:]),
+            "image_format": image_format if tensor_size is not None else None,
+            "cipher": cipher if encrypt else None}
+
+
+def FolderToLMDB(path: str,
+                 file_name: str,
+                 map_size: int,
+                 tensor_size: tuple = None,
+                 image_format: str = "png",
+                 encrypt: bool = False,
+                 key_file_name: str = None,
+                 cipher: str = "fernet",
+                 cpus: int = multiprocessing.cpu_count(),
+                 commit_every: int = 1024):
+    r"""Builds a LMDB database from a folder of class folders (same layout
+    used by FolderITTR and FewPerLabel). Reading, resizing and encrypting of
+    images is done in a process pool, and the main process is the only
+    writer that commits samples in batches of commit_every.
+
+    The database has attributes ("image", "label") and can be read with
+    LMDB. A label index (file_name + ".labels.json") with folder name per
+    label and number of samples per label is written alongside.
+
+    An interrupted build can be resumed by calling FolderToLMDB with the same
+    arguments -- samples are written in a sorted order and all the samples
+    already in the database are skipped. The ordered sample list and the
+    arguments are saved in the database, and a resume (or an update with new
+    images) raises ValueError when the samples in the database are not the
+    first samples of the folder (Ex: a new class folder that sorts before
+    the existing ones) or when tensor_size/image_format/cipher differ.
+
+    Args:
+        path (str): full path to folders, where each folder represents a class
+        file_name (str): lmdb file name (full path)
+        map_size (int): size of database, see LMDB
+        tensor_size (list/tuple, optional): BCHW, when not None, images are
+            resized to (height, width) = tensor_size[2:] and converted to grey
+            scale when tensor_size[1] == 1. When None, image files are saved
+            without any changes. default = None
+        image_format (str, optional): format used to save the resized images.
+            default = "png"
+        encrypt (bool, optional): see LMDB. default = False
+        key_file_name (str, optional): see LMDB. default = None
+        cipher (str, optional): see LMDB. default = "fernet"
+        cpus (int, optional): number of processes used to read the images.
+            default = cpu_count
+        commit_every (int, optional): number of samples per write
+            transaction. default = 1024
+
+    Return:
+        LMDB object (not started) and a list of label names
+    """
+    if not isinstance(path, str):
+        raise TypeError("FolderToLMDB: path must be str")
+    if not os.path.isdir(path):
+        raise ValueError("FolderToLMDB: path is not valid dir")
+    if not (tensor_size is None or
+            (isinstance(tensor_size, (list, tuple)) and
+             len(tensor_size) == 4)):
+        raise TypeError("FolderToLMDB: tensor_size must be None/BCHW")
+    if not isinstance(cpus, int) or cpus < 1:
+        raise ValueError("FolderToLMDB: cpus must be int >= 1")
+    if not isinstance(commit_every, int) or commit_every < 1:
+        raise ValueError("FolderToLMDB: commit_every must be int >= 1")
+
+    # sorted list of (image, label) -- order is required to resume
+    labels, samples, n_per_label = [], [], []
+    index = FolderIndex(path)
+    for folder, images in zip(index.folders, index.per_label()):
+        if len(images) == 0:
+            continue
+        samples += [(x, len(labels)) for x in images]
+        labels.append(folder)
+        n_per_label.append(len(images))
+
+    database = LMDB(file_name, ("image", "label"), map_size,
+                    encrypt=encrypt, key_file_name=key_file_name,
+                    cipher=cipher)
+    database.start(write=True)
+    stored = database[b"folder_to_lmdb"]
+    if stored is not None:
+        stored = json.loads(stored.decode())
+    elif len(database):
+        database.stop()
+        raise ValueError("FolderToLMDB: {} was not built by "
+                         "FolderToLMDB".format(file_name))
+    info = _build_info(path, samples, tensor_size, image_format, encrypt,
+                       cipher)
+    if stored is not None:
+        # samples in the database must be the first samples of the folder
+        n = stored["n_samples"]
+        prefix = _build_info(path, samples[:n], tensor_size, image_format,
+                             encrypt, cipher)
+        if n > len(samples) or prefix != stored:
+            database.stop()
+            raise ValueError("FolderToLMDB: {} was built from a different "
+                             "list of samples or with different tensor_size/"
+                             "image_format/cipher, build a new "
+                             "database".format(file_name))
+    database[b"folder_to_lmdb"] = json.dumps(info).encode()
+    with open(file_name + ".labels.json", "w") as txt:
+        json.dump({"labels": labels, "n_per_label": n_per_label}, txt)
+    key = None
+    if database.encrypt:
+        with open(database.key_file_name, "rb") as txt:
+            key = txt.read()
+
+    n_samples = len(database)
+    pending = samples[n_samples:]
+    if len(pending) == 0:
+        database.stop()
+        return database, labels
+    pool = multiprocessing.Pool(cpus, _worker_initialize,
+                                (tensor_size, image_format, database.cipher,
+                                 key))
+    try:
+        records = pool.imap(_worker_encode, pending,
+                            chunksize=max(1, min(64, commit_every // cpus)))
+        txn = database._env.begin(write=True)
+        for record in records:
+            txn.put("{:010}".format(n_samples).encode(), record)
+            n_samples += 1
+            if n_samples % commit_every == 0 or n_samples == len(samples):
+                # n_samples is updated with the batch, so a commit is atomic
+                txn.put(b"n_samples", str(n_samples).encode())
+                txn.commit()
+                txn = database._env.begin(write=True)
+        txn.abort()
+    except lmdb.MapFullError:
+        raise ValueError("FolderToLMDB: map_size is too small, resume with "
+                         "a larger map_size")
+    finally:
+        pool.terminate()
+        pool.join()
+        database.stop()
+    database.n_samples = n_samples
+    return database, labels
@@ -8,9 +8,57 @@ from PIL import Image as ImPIL
 import msgpack
 import base64
 import warnings
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings("ignore", category=FutureWarning)
 
 
+class AEAD(object):
+    r""" Authenticated encryption (AES-GCM or ChaCha20-Poly1305) on raw bytes
+    with a random 96-bit nonce per record (nonce + ciphertext + tag). Has the
+    same encrypt/decrypt interface as cryptography.fernet.Fernet.
+
+    Args:
+        cipher (str): "aesgcm" or "chacha20"
+        key (bytes): 32 byte key
+    """
+    NONCE_SIZE = 12
+
+    def __init__(self, cipher: str, key: bytes):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM, \
+            ChaCha20Poly1305
+        self._aead = (AESGCM if cipher == "aesgcm" else ChaCha20Poly1305)(key)
+
+    @staticmethod
+    def generate_key(cipher: str):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM, \
+            ChaCha20Poly1305
+        if cipher == "aesgcm":
+            return AESGCM.generate_key(bit_length=256)
+        return ChaCha20Poly1305.generate_key()
+
+    def encrypt(self, data: bytes):
+        nonce = os.urandom(AEAD.NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, None)
+
+    def decrypt(self, token: bytes):
+        return self._aead.decrypt(token[:AEAD.NONCE_SIZE],
+                                  token[AEAD.NONCE_SIZE:], None)
+
+
+def get_cipher(cipher: str, key: bytes = None):
+    r""" Returns (cipher object, key) -- a new key is generated when key is
+    None """
+    if cipher == "fernet":
+        from cryptography.fernet import Fernet
+        if key is None:
+            key = Fernet.generate_key()
+        return Fernet(key), key
+    if key is None:
+        key = AEAD.generate_key(cipher)
+    return AEAD(cipher, key), key
+
+
 class LMDB(object):
     r""" Creates and read a lmdb database.
 
@@ -21,6 +69,8 @@ class LMDB(object):
         image in bytearray and saves to the database (full image path is also
         saved to the database - set show_image_name to True to output the image
         name during read).
+        - bytes are saved as an encoded image (Ex: downloaded images) with
+        an empty image name.
 
     Reading a database:
     ------------------
@@ -29,6 +79,10 @@ class LMDB(object):
         np.ndarray retain their type and shape
         - str's ending with IMAGE_TYPES will return a pillow image. When
         show_image_name is True, (pillow image, image name) is returned.
+        - read_batch(indices) decodes (and decrypts) samples in a thread pool
+        - With sample_cache, decoded images are cached (key of an image is
+        idx * len(attributes) + position of attribute), so later reads skip
+        decryption and decoding
 
     Example:
         >>> database = LMDB(file_name="./test.lmdb",
@@ -60,21 +114,39 @@ class LMDB(object):
         key_file_name (str): Required when encrypt=True, store the random
             encryption key for a new database or loaded the key to decrypt
             images
+        cipher (str): Used when encrypt=True on a new database. Options are
+            "fernet" (cryptography.fernet.Fernet), "aesgcm" (AES-GCM) and
+            "chacha20" (ChaCha20-Poly1305). The AEAD ciphers work on raw bytes
+            with a random nonce per record (28 bytes of overhead per record),
+            and avoid the base64 expansion and HMAC of fernet. Existing
+            databases use the cipher they were created with (databases
+            created before cipher was added are fernet).
+            default = "fernet"
+        n_threads (int): threads used by read_batch, default = 4
+        sample_cache (SampleCache): a cache of decoded images shared by all
+            the processes, n_keys must be >= len(database) * len(attributes).
+            default = None
 
     ** No Guarantees or Warranties
     Few to note:
         - If you are not sure about encrypt, don't use it.
         - Do not save/send ".key" along with database file.
         - Obviously, using encrypt, will slow down the read and write process.
+          "aesgcm" and "chacha20" are an order of magnitude faster than
+          "fernet" (100KB record: ~0.1ms vs ~1ms to decrypt on a CPU).
     """
 
     ATTRIBUTE_TYPES = (str, int, float, np.ndarray, "image")
     IMAGE_TYPES = (".png", ".jpg", ".jpeg", ".tiff", ".bmp")
+    CIPHERS = ("fernet", "aesgcm", "chacha20")
 
     def __init__(self, file_name: str, attributes: tuple, map_size: int,
                  show_image_name: bool = False,
                  encrypt: bool = False,
-                 key_file_name: str = None):
+                 key_file_name: str = None,
+                 cipher: str = "fernet",
+                 n_threads: int = 4,
+                 sample_cache=None):
 
         if not isinstance(file_name, str):
             raise TypeError("LMDB: file_name must be str")
@@ -92,6 +164,10 @@ class LMDB(object):
             raise TypeError("LMDB: key_file_name must be str/None")
         if encrypt and not isinstance(key_file_name, str):
             raise ValueError("LMDB: key_file_name must be str")
+        if cipher not in LMDB.CIPHERS:
+            raise ValueError("LMDB: cipher must be fernet/aesgcm/chacha20")
+        if not isinstance(n_threads, int) or n_threads < 1:
+            raise ValueError("LMDB: n_threads must be int >= 1")
 
         self.file_name = file_name
         self.attributes = attributes
@@ -99,7 +175,11 @@ class LMDB(object):
         self.show_image_name = show_image_name
         self.encrypt = encrypt
         self.key_file_name = key_file_name
+        self.cipher = cipher
+        self.n_threads = n_threads
+        self.sample_cache = sample_cache
         self.n_samples = 0
+        self._pool = None
 
     def __len__(self):
         return self.n_samples
@@ -120,13 +200,16 @@ class LMDB(object):
         r""" Starts the read/write lmdb environment! """
         if os.path.isfile(self.file_name):
             self.read_only = True
+            kwargs = {"map_size": self.map_size} if write else {}
             self._env = lmdb.open(
                 self.file_name, max_readers=1, readonly=not write, lock=False,
-                readahead=False, meminit=False, subdir=False)
+                readahead=False, meminit=False, subdir=False, **kwargs)
             self._load_len()
             self._load_attributes()
             self.encrypt = "True" == self.__getitem__(b"encrypt").decode()
             if self.encrypt:
+                cipher = self.__getitem__(b"cipher")
+                self.cipher = "fernet" if cipher is None else cipher.decode()
                 self.__set_encrypt(False)
         elif write and not os.path.isfile(self.file_name):
             self._env = lmdb.open(
@@ -136,12 +219,16 @@ class LMDB(object):
             self._note_attributes()
             self.__setitem__(b"encrypt", str(self.encrypt).encode())
             if self.encrypt:
+                self.__setitem__(b"cipher", self.cipher.encode())
                 self.__set_encrypt(True)
         else:
             raise FileNotFoundError
 
     def stop(self):
         r""" Stops the read/write lmdb environment! """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
         self._env.close()
 
     def read(self, idx: int):
@@ -149,7 +236,22 @@ class LMDB(object):
             print("LMDB: idx is not valid!")
             raise IndexError(repr(idx), "LMDB: idx is not valid, must be " +
                              "{}-{}!".format(0, len(self)-1))
-        return self._decode(self.__getitem__("{:010}".format(idx).encode()))
+        return self._decode(self.__getitem__("{:010}".format(idx).encode()),
+                            idx)
+
+    def read_batch(self, indices: (list, tuple)):
+        r""" Reads all the indices in a single transaction, and decodes (and
+        decrypts) them in a pool of n_threads. """
+        for idx in indices:
+            if not (0 <= idx < len(self)):
+                raise IndexError(repr(idx), "LMDB: idx is not valid, must be "
+                                 "{}-{}!".format(0, len(self)-1))
+        with self._env.begin(write=False) as f:
+            contents = [f.get("{:010}".format(idx).encode())
+                        for idx in indices]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.n_threads)
+        return list(self._pool.map(self._decode, contents, indices))
 
     def write(self, *args):
         assert len(self.attributes) == len(args)
@@ -181,12 +283,22 @@ class LMDB(object):
 
     def _attribute_encode(self, x):
         r""" Converts a value of type str/int/float/np.ndarray to bytes
-            - str to bytes
+            - str to bytes (image files are read)
+            - bytes are encoded images
             - int/float to str and then bytes
             - np.ndarray to base64 encoding
         """
-        assert isinstance(x, LMDB.ATTRIBUTE_TYPES)
         out = self._new_dict()
+        if isinstance(x, bytes):
+            # encoded image (Ex: downloaded content)
+            if self.encrypt:
+                x = self.__encrypt.encrypt(x)
+            out[b"content"] = x
+            out[b"image_name"] = self.__encrypt.encrypt(b"") if \
+                self.encrypt else b""
+            out[b"type"] = LMDB.ATTRIBUTE_TYPES.index("image")
+            return out
+        assert isinstance(x, LMDB.ATTRIBUTE_TYPES[:-1])
         if isinstance(x, str):
             out[b"type"] = LMDB.ATTRIBUTE_TYPES.index(str)
             if x.lower().endswith(LMDB.IMAGE_TYPES):
@@ -228,14 +340,23 @@ class LMDB(object):
             return np.frombuffer(base64.decodebytes(x[b"content"]),
                                  dtype=dtype)
         else:
-            if self.encrypt:
-                image = ImPIL.open(io.BytesIO(
-                    self.__encrypt.decrypt(x[b"content"])))
-                name = self.__encrypt.decrypt(x[b"image_name"])
-            else:
-                image = ImPIL.open(io.BytesIO(x[b"content"]))
-                name = x[b"image_name"]
-            return (image, name.decode()) if self.show_image_name else image
+            image = self._image_decode(x)
+            return (image, self._image_name(x)) if self.show_image_name else \
+                image
+
+    def _image_decode(self, x):
+        r""" Pillow image of an image attribute """
+        content = x[b"content"]
+        if self.encrypt:
+            content = self.__encrypt.decrypt(content)
+        return ImPIL.open(io.BytesIO(content))
+
+    def _image_name(self, x):
+        r""" Image name of an image attribute """
+        name = x[b"image_name"]
+        if self.encrypt:
+            name = self.__encrypt.decrypt(name)
+        return name.decode()
 
     def _msgpack_encode(self, x):
         r""" Encodes content in x using msgpack to bytes """
@@ -260,24 +381,34 @@ class LMDB(object):
             content[attribute] = self._attribute_encode(value)
         return self._msgpack_encode(content)
 
-    def _decode(self, content: bytes):
+    def _decode(self, content: bytes, idx: int = None):
         r""" Decodes bytes to a tuple of values for given attributes (order is
         same as attributes) - given the specific format better to read a lmdb
-        file written by same function! """
+        file written by same function! Images of sample idx are read from
+        (and added to) sample_cache. """
         assert isinstance(content, bytes)
         content = self._msgpack_decode(content)
         values = []
-        for attribute in self.attributes:
-            value = self._attribute_decode(content[attribute])
+        for i, attribute in enumerate(self.attributes):
+            x = content[attribute]
+            if self.sample_cache is not None and idx is not None and \
+               x[b"type"] == LMDB.ATTRIBUTE_TYPES.index("image"):
+                value = self.sample_cache.fetch_image(
+                    idx * len(self.attributes) + i,
+                    partial(self._image_decode, x))
+                if self.show_image_name:
+                    value = (value, self._image_name(x))
+                values.append(value)
+                continue
+            value = self._attribute_decode(x)
             if value == "":
                 value = None
             values.append(value)
         return tuple(values)
 
     def __set_encrypt(self, new_key: bool):
-        from cryptography.fernet import Fernet
         if new_key:
-            key = Fernet.generate_key()
+            self.__encrypt, key = get_cipher(self.cipher)
             with open(self.key_file_name, "wb") as txt:
                 txt.write(key)
         else:
@@ -285,7 +416,7 @@ class LMDB(object):
                 raise FileNotFoundError
             with open(self.key_file_name, "rb") as txt:
                 key = txt.read()
-        self.__encrypt = Fernet(key)
+            self.__encrypt, key = get_cipher(self.cipher, key)
         del key
 
 
@@ -311,3 +442,12 @@ class LMDB(object):
 # database.read(3)[0]
 # len(database)
 # database.stop()
+#
+# # fernet vs aesgcm vs chacha20 on 100KB records
+# # (decrypt -- fernet ~1ms, aesgcm ~0.05ms, chacha20 ~0.1ms)
+# content = os.urandom(100 * 1024)
+# for cipher in LMDB.CIPHERS:
+#     fn = get_cipher(cipher)[0]
+#     token = fn.encrypt(content)
+#     %timeit fn.encrypt(content)
+#     %timeit fn.decrypt(token)
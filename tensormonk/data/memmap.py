@@ -0,0 +1,204 @@
+""" TensorMONK's :: data :: Memmap """
+
+__all__ = ["ToMemmap", "MemmapDataset", "MemmapBatchSampler"]
+
+import numpy as np
+import torch
+import multiprocessing
+from PIL import Image as ImPIL
+
+
+class _ToUInt8(object):
+    r""" Collate function that resizes a list of (pil image/ndarray, label) to
+    uint8 NCHW array and int64 labels """
+    def __init__(self, tensor_size: tuple):
+        self.tensor_size = tensor_size
+
+    def __call__(self, a_batch: list):
+        (c, h, w), images, labels = self.tensor_size[1:], [], []
+        for image, label in a_batch:
+            if not isinstance(image, ImPIL.Image):
+                image = ImPIL.fromarray(np.asarray(image))
+            image = image.convert("L" if c == 1 else "RGB")
+            if image.size != (w, h):
+                image = image.resize((w, h), ImPIL.BILINEAR)
+            images.append(np.asarray(image).reshape(h, w, c))
+            labels.append(label)
+        return (np.stack(images).transpose(0, 3, 1, 2),
+                np.array(labels, dtype=np.int64))
+
+
+def ToMemmap(dataset, file_name: str, tensor_size: tuple,
+             cpus: int = multiprocessing.cpu_count(), batch_size: int = 256,
+             shuffle: bool = True):
+    r"""Converts a dataset (with no transforms) that returns a (pil image or
+    HWC ndarray, label) to decoded and resized uint8 NCHW tensors in
+    file_name (.npy) and labels (int64) in file_name[:-4] + ".labels.npy".
+    Decoding is done by cpus DataLoader workers and the batches are written
+    to a memory-mapped file.
+
+    Example:
+        >>> ToMemmap(torchvision.datasets.ImageFolder("../data/train"),
+                     "../data/train.npy", (1, 3, 64, 64))
+        >>> ToMemmap(torchvision.datasets.CIFAR10("../data", train=True),
+                     "../data/cifar10.npy", (1, 3, 32, 32))
+
+    Args:
+        dataset: an indexable dataset that returns (pil image/ndarray, label)
+        file_name (str): full path of .npy file
+        tensor_size (list/tuple): BCHW of the stored tensors
+        cpus (int, optional): workers used to decode, default = cpu_count
+        batch_size (int, optional): samples per worker batch, default = 256
+        shuffle (bool, optional): When True, samples are written in a random
+            order so that contiguous batches have a mix of labels.
+            default = True
+
+    Return:
+        file_name of images and labels
+    """
+    if not isinstance(file_name, str) or not file_name.endswith(".npy"):
+        raise ValueError("ToMemmap: file_name must be str and end with .npy")
+    if not (isinstance(tensor_size, (list, tuple)) and len(tensor_size) == 4):
+        raise TypeError("ToMemmap: tensor_size must be BCHW")
+
+    n = len(dataset)
+    if shuffle:
+        dataset = torch.utils.data.Subset(dataset, torch.randperm(n).tolist())
+    images = np.lib.format.open_memmap(file_name, mode="w+", dtype=np.uint8,
+                                       shape=(n, ) + tuple(tensor_size[1:]))
+    labels = np.zeros((n, ), dtype=np.int64)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, num_workers=cpus,
+        collate_fn=_ToUInt8(tuple(tensor_size)))
+    start = 0
+    for image, label in loader:
+        images[start:start + image.shape[0]] = image
+        labels[start:start + image.shape[0]] = label
+        start += image.shape[0]
+    images.flush()
+    del images
+    np.save(file_name[:-4] + ".labels.npy", labels)
+    return file_name, file_name[:-4] + ".labels.npy"
+
+
+class MemmapDataset(object):
+    r"""Reads uint8 NCHW tensors and labels written by ToMemmap. Indexing with
+    an int returns a sample, and indexing with a slice (MemmapBatchSampler)
+    returns a batch that is a zero-copy view of the memory-mapped file.
+    Normalization (x / 255 - mean) / std is applied as a single vectorized op
+    on a batch.
+
+    Example:
+        >>> data = MemmapDataset("../data/train.npy", mean=(0.5, 0.5, 0.5),
+                                 std=(0.25, 0.25, 0.25))
+        >>> loader = torch.utils.data.DataLoader(
+                data, batch_size=None, num_workers=4,
+                sampler=MemmapBatchSampler(len(data), 64, shuffle=True))
+
+    Args:
+        file_name (str): .npy file from ToMemmap
+        mean (list/tuple, optional): mean per channel, default = None
+        std (list/tuple, optional): std per channel, default = None
+        normalize (bool, optional): When False, returns uint8 tensors (to
+            normalize on gpu with MemmapDataset.normalize). When True, returns
+            float tensors (mean and std are used when available, else values
+            are in the range of 0-1). default = True
+    """
+    def __init__(self, file_name: str, mean: tuple = None, std: tuple = None,
+                 normalize: bool = True):
+        if not isinstance(file_name, str) or not file_name.endswith(".npy"):
+            raise ValueError("MemmapDataset: file_name must be str and end "
+                             "with .npy")
+        if not isinstance(normalize, bool):
+            raise TypeError("MemmapDataset: normalize must be bool")
+
+        # copy-on-write to get writable numpy views without copies
+        self.images = np.load(file_name, mmap_mode="c")
+        self.labels = torch.from_numpy(
+            np.load(file_name[:-4] + ".labels.npy"))
+        self.tensor_size = (1, ) + self.images.shape[1:]
+        self.normalize_batch = normalize
+
+        c = self.images.shape[1]
+        mean = torch.zeros(c) if mean is None else torch.Tensor(mean)
+        std = torch.ones(c) if std is None else torch.Tensor(std)
+        self.scale = (1 / (std * 255)).view(1, -1, 1, 1)
+        self.shift = (- mean / std).view(1, -1, 1, 1)
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            tensor = torch.from_numpy(self.images[idx])
+            labels = self.labels[idx]
+        elif isinstance(idx, (list, tuple, np.ndarray, torch.Tensor)):
+            idx = np.sort(np.asarray(idx))
+            tensor = torch.from_numpy(self.images[idx])
+            labels = self.labels[idx]
+        else:
+            idx = int(idx)
+            idx = idx + len(self) if idx < 0 else idx
+            if not 0 <= idx < len(self):
+                raise IndexError("MemmapDataset: index out of range")
+            tensor = torch.from_numpy(self.images[idx:idx + 1])
+            labels = self.labels[idx]
+            if self.normalize_batch:
+                tensor = self.normalize(tensor)
+            return tensor[0], labels
+        if self.normalize_batch:
+            tensor = self.normalize(tensor)
+        return tensor, labels
+
+    def normalize(self, tensor: torch.Tensor):
+        r""" (uint8 tensor / 255 - mean) / std of a NCHW tensor """
+        return torch.addcmul(self.shift.to(tensor.device), tensor.float(),
+                             self.scale.to(tensor.device))
+
+
+class MemmapBatchSampler(torch.utils.data.Sampler):
+    r"""Samples contiguous batches (slices) for MemmapDataset. When shuffle is
+    True, the order of contiguous blocks of batch_size is shuffled every
+    epoch (ToMemmap writes the samples in a random order, so the blocks are
+    not sorted by label). Use with DataLoader's batch_size=None.
+
+    Args:
+        n_samples (int): len(MemmapDataset)
+        batch_size (int): samples per batch
+        shuffle (bool, optional): default = True
+        drop_last (bool, optional): drops last incomplete batch,
+            default = False
+        contiguous (bool, optional): When False, random sorted indices are
+            sampled per batch (not zero-copy). default = True
+    """
+    def __init__(self, n_samples: int, batch_size: int,
+                 shuffle: bool = True, drop_last: bool = False,
+                 contiguous: bool = True):
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("MemmapBatchSampler: batch_size must be int >= 1")
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.contiguous = contiguous
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_samples // self.batch_size
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n, bsz = self.n_samples, self.batch_size
+        if not self.contiguous:
+            idx = torch.randperm(n) if self.shuffle else torch.arange(n)
+            for i in range(len(self)):
+                yield idx[i * bsz:(i + 1) * bsz].numpy()
+            return
+
+        starts = list(range(0, n, bsz))
+        if self.drop_last and n % bsz:
+            starts = starts[:-1]
+        if self.shuffle:
+            starts = [starts[i] for i in torch.randperm(len(starts)).tolist()]
+        for start in starts:
+            yield slice(start, min(start + bsz, n))
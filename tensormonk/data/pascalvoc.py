@@ -1,6 +1,9 @@
 """ TensorMONK :: data :: PascalVOC """
 
+import os
 import torch
+import warnings
+import multiprocessing
 import numpy as np
 import PIL.Image as ImPIL
 import xml.etree.ElementTree as ET
@@ -13,11 +16,55 @@ VOC_LABELS = ("BACKGROUND", "aeroplane", "bicycle", "bird", "boat", "bottle",
               "train", "tvmonitor")
 
 
-class PascalVOC(object):
+def parse_annotation(file_name: str):
+    r""" Returns labels, ltrb_boxes, difficult and image size (w, h) of all
+    the objects in a xml """
+    content = ET.parse(file_name)
+    size = content.find("size")
+    size = (0, 0) if size is None else \
+        (int(float(size.find("width").text)),
+         int(float(size.find("height").text)))
+
+    labels, ltrb_boxes, difficult = [], [], []
+    for x in content.findall("object"):
+        box = x.find("bndbox")
+        labels += [VOC_LABELS.index(x.find("name").text.lower().strip())]
+        ltrb_boxes += [[float(box.find(k).text)
+                        for k in ("xmin", "ymin", "xmax", "ymax")]]
+        flag = x.find("difficult")
+        difficult += [flag is not None and flag.text.strip() == "1"]
+
+    ltrb_boxes = np.array(ltrb_boxes, np.float32).reshape(-1, 4) - 1
+    return (np.array(labels, np.int64), ltrb_boxes,
+            np.array(difficult, np.bool_), size)
+
 
+class PascalVOC(object):
+    r"""PascalVOC detection dataset. Annotations are parsed once (in parallel)
+    into numpy arrays (boxes, labels, difficult and image sizes) and saved to
+    a cache file, so __getitem__ only reads the image. The cache is rebuilt
+    for annotations that are modified (size or mtime).
+
+    Args:
+        path (str): path to VOCdevkit/VOC2007 or VOCdevkit/VOC2012
+        tensor_size (tuple, optional): BCHW, default = (1, 3, 320, 320)
+        train (bool, optional): trainval when True, else val. default = True
+        retain_difficult (bool, optional): When False, difficult objects are
+            removed (filtered on the cached arrays). default = False
+        cache (str, optional): full path of cache file, default =
+            path/Annotations/.tensormonk_voc_{trainval/val}.npz
+        cpus (int, optional): processes used to parse, default = cpu_count
+
+    ** A cache that can not be written (read-only path) is ignored with a
+    warning.
+
+    ** With bucket_sampler, every sample is resized to the size of its aspect
+    ratio bucket (batches have a bucket size instead of tensor_size).
+    """
     def __init__(self, path: str = "../data/VOCdevkit/VOC2012",
                  tensor_size: tuple = (1, 3, 320, 320),
                  train: bool = True, retain_difficult: bool = False,
+                 cache: str = None, cpus: int = multiprocessing.cpu_count(),
                  **kwargs):
 
         assert tensor_size[2] == 300 or tensor_size[2] == 320
@@ -25,15 +72,25 @@ class PascalVOC(object):
         self.train = train
         self.retain_difficult = retain_difficult
 
-        with open(path + "/ImageSets/Main/" +
-                  ("trainval.txt" if train else "val.txt")) as txt:
+        split = "trainval" if train else "val"
+        with open(path + "/ImageSets/Main/" + split + ".txt") as txt:
             file_names = txt.readlines()
-        file_names = [x.strip() for x in file_names]
+        file_names = [x.strip() for x in file_names if x.strip()]
 
         # read all files
         self.images = [path + "/JPEGImages/" + x + ".jpg" for x in file_names]
         self.xmls = [path + "/Annotations/" + x + ".xml" for x in file_names]
 
+        # parse annotations (or load from cache)
+        if cache is None:
+            cache = os.path.join(path, "Annotations",
+                                 ".tensormonk_voc_" + split + ".npz")
+        self.cache = cache
+        self.cpus = cpus
+        self.load_annotations()
+        self.filter_difficult(retain_difficult)
+        self.sampler = None
+
         # random brightness, contrast, saturation, hue and grey transformations
         from torchvision import transforms
         self.random_transforms = transforms.RandomApply(
@@ -44,10 +101,102 @@ class PascalVOC(object):
     def __len__(self):
         return len(self.images)
 
+    def load_annotations(self):
+        r""" Loads annotations from cache and parses the annotations that are
+        not cached or modified. """
+        stats = [os.stat(x) for x in self.xmls]
+        file_sizes = np.array([x.st_size for x in stats], np.int64)
+        mtimes = np.array([x.st_mtime for x in stats], np.float64)
+
+        cached = {}
+        if os.path.isfile(self.cache):
+            try:
+                content = dict(np.load(self.cache))
+                offsets = content["offsets"].tolist()
+                labels, boxes, difficult, sizes = (
+                    content[x] for x in ("labels", "boxes", "difficult",
+                                         "sizes"))
+                for i, (xml, size, mtime) in enumerate(zip(
+                        content["xmls"].tolist(), content["file_sizes"],
+                        content["mtimes"])):
+                    s, e = offsets[i], offsets[i + 1]
+                    cached[xml] = (size, mtime, (
+                        labels[s:e], boxes[s:e], difficult[s:e],
+                        tuple(sizes[i].tolist())))
+            except (OSError, KeyError, ValueError):
+                cached = {}
+
+        parse = [i for i, xml in enumerate(self.xmls) if xml not in cached or
+                 cached[xml][0] != file_sizes[i] or
+                 cached[xml][1] != mtimes[i]]
+        if len(parse) > 256 and self.cpus > 1:
+            with multiprocessing.Pool(self.cpus) as pool:
+                parsed = pool.map(parse_annotation,
+                                  [self.xmls[i] for i in parse], 64)
+        else:
+            parsed = [parse_annotation(self.xmls[i]) for i in parse]
+        for i, annotation in zip(parse, parsed):
+            cached[self.xmls[i]] = (file_sizes[i], mtimes[i], annotation)
+        self.n_parsed = len(parse)
+
+        # compact arrays -- objects of idx are offsets[idx]:offsets[idx + 1]
+        annotations = [cached[x][2] for x in self.xmls]
+        counts = [x[0].size for x in annotations]
+        self.all_offsets = np.concatenate(([0], np.cumsum(counts))).astype(
+            np.int64)
+        self.all_labels = np.concatenate(
+            [x[0] for x in annotations] + [np.zeros(0, np.int64)])
+        self.all_boxes = np.concatenate(
+            [x[1] for x in annotations] + [np.zeros((0, 4), np.float32)])
+        self.difficult = np.concatenate(
+            [x[2] for x in annotations] + [np.zeros(0, np.bool_)])
+        self.sizes = np.array([x[3] for x in annotations],
+                              np.int64).reshape(-1, 2)
+        if self.n_parsed:
+            self.save_annotations(file_sizes, mtimes)
+
+    def save_annotations(self, file_sizes: np.ndarray, mtimes: np.ndarray):
+        try:
+            with open(self.cache + ".tmp", "wb") as f:
+                np.savez(f, xmls=np.array(self.xmls, dtype=str),
+                         file_sizes=file_sizes, mtimes=mtimes,
+                         offsets=self.all_offsets, labels=self.all_labels,
+                         boxes=self.all_boxes, difficult=self.difficult,
+                         sizes=self.sizes)
+            os.replace(self.cache + ".tmp", self.cache)
+        except OSError as e:
+            warnings.warn("PascalVOC: unable to save cache - {}".format(e))
+
+    def filter_difficult(self, retain_difficult: bool):
+        r""" Retains or removes difficult objects (on the cached arrays) """
+        self.retain_difficult = retain_difficult
+        keep = np.ones_like(self.difficult) if retain_difficult else \
+            ~self.difficult
+        self.labels, self.boxes = self.all_labels[keep], self.all_boxes[keep]
+        self.offsets = np.concatenate(([0], np.cumsum(keep)))[
+            self.all_offsets]
+
+    def annotation(self, idx: int):
+        r""" Returns labels and ltrb_boxes (pixel locations) of idx """
+        s, e = self.offsets[idx], self.offsets[idx + 1]
+        return self.labels[s:e].copy(), self.boxes[s:e].copy()
+
+    def bucket_sampler(self, batch_size: int, **kwargs):
+        r"""AspectRatioBatchSampler on image sizes (pixels of tensor_size per
+        bucket), __getitem__ resizes to the bucket size of a sample. kwargs
+        are passed to AspectRatioBatchSampler. """
+        from .samplers import AspectRatioBatchSampler
+        kwargs["pixels"] = kwargs.get("pixels",
+                                      self.t_size[2] * self.t_size[3])
+        self.sampler = AspectRatioBatchSampler(self.sizes, batch_size,
+                                               **kwargs)
+        return self.sampler
+
     def __getitem__(self, idx):
-        image, xml = self.images[idx], self.xmls[idx]
-        image = ImPIL.open(image).convert("RGB")
-        np_labels, ltrb_boxes = self.parse_xml(xml, self.retain_difficult)
+        t_size = self.t_size if self.sampler is None else \
+            tuple(self.t_size[:2]) + self.sampler.size_of(idx)
+        image = ImPIL.open(self.images[idx]).convert("RGB")
+        np_labels, ltrb_boxes = self.annotation(idx)
         if self.train:
             # image augmentations that require box adjustment
             image, ltrb_boxes = PillowUtils.random_pad(image, ltrb_boxes,
@@ -59,11 +208,11 @@ class PascalVOC(object):
             image = self.random_transforms(image)
 
         # resize and adjust boxes
-        image, ltrb_boxes = PillowUtils.to_pil(image, self.t_size, ltrb_boxes)
+        image, ltrb_boxes = PillowUtils.to_pil(image, t_size, ltrb_boxes)
 
         # normalize the boxes
-        ltrb_boxes = ObjectUtils.pixel_to_norm01(ltrb_boxes, self.t_size[3],
-                                                 self.t_size[2], "numpy")
+        ltrb_boxes = ObjectUtils.pixel_to_norm01(ltrb_boxes, t_size[3],
+                                                 t_size[2], "numpy")
 
         # to torch.Tensor's
         ltrb_boxes, labels, image = torch.from_numpy(ltrb_boxes).float(), \
@@ -72,18 +221,7 @@ class PascalVOC(object):
 
     @staticmethod
     def parse_xml(file_name, retain_difficult):
-        def np_box(x):
-            return map(float, [x.find("xmin").text, x.find("ymin").text,
-                               x.find("xmax").text, x.find("ymax").text])
-        content = ET.parse(file_name).findall("object")
-
-        labels, ltrb_boxes = [], []
-        for x in content:
-            if x.find("difficult").text == "1" and not retain_difficult:
-                continue
-            labels += [x.find("name").text.lower().strip()]
-            ltrb_boxes += [list(np_box(x.find("bndbox")))]
-
-        ltrb_boxes = np.array(ltrb_boxes).astype(np.float32) - 1
-        np_labels = np.array([VOC_LABELS.index(x) for x in labels])
-        return np_labels.astype(np.int64), ltrb_boxes
+        labels, ltrb_boxes, difficult, _ = parse_annotation(file_name)
+        if not retain_difficult:
+            labels, ltrb_boxes = labels[~difficult], ltrb_boxes[~difficult]
+        return labels, ltrb_boxes
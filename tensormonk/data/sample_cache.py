@@ -0,0 +1,306 @@
+""" TensorMONK :: data :: SampleCache """
+
+__all__ = ["SampleCache"]
+
+import os
+import fcntl
+import hashlib
+import weakref
+import tempfile
+import threading
+import functools
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image as ImPIL
+
+
+class SampleCache(object):
+    r"""LRU cache of decoded uint8 samples (HW/HWC arrays) in a shared memory
+    arena (a file in /dev/shm). The arena has budget // sample_bytes slots,
+    and a slot holds a sample of at most sample_bytes (larger samples are not
+    cached). Keys are ints in [0, n_keys), usually the dataset index.
+
+    Any process that opens a cache with the same name attaches to the same
+    arena -- DataLoader workers (fork or spawn) and other processes on the
+    node share samples, so only the first epoch decodes. Slots, LRU ticks and
+    counters (hits, misses, evictions and skipped) are in the arena, and are
+    updated under a file lock (flock), so stats() in the main process
+    includes all the workers. A thread lock is used along with flock, as
+    threads of a process share the flock.
+
+    Example:
+        >>> cache = SampleCache("train", len(dataset), 3 * 224 * 224,
+                                budget=8 * 1024 ** 3)
+        >>> image = cache.fetch_image(idx, lambda: open_image(file_name))
+        >>> cache.stats()
+
+    Args:
+        name (str): name of cache (file name in path)
+        n_keys (int): number of keys (samples)
+        sample_bytes (int): maximum bytes of a sample (slot size)
+        budget (int, optional): bytes of all the slots, default = 1GB
+        path (str, optional): folder of cache, default = "/dev/shm" (a
+            temporary folder when /dev/shm does not exist)
+        unlink_on_exit (bool, optional): When True, the arena is removed
+            when the cache (of this process, not the copies in workers) is
+            garbage collected or the process exits. default = False
+
+    ** Without unlink_on_exit, the arena is not removed when a process exits
+    (other processes can use it), call unlink() when it is no longer
+    required. A name must identify the samples and the decoding (see
+    name_of, stat_of and identity_of), else a later run attaches to stale
+    samples. A budget larger than the free memory in /dev/shm will crash the
+    workers (SIGBUS).
+    """
+    MAGIC = 0x6b6e6f4d726f736e
+    HEADER = ("magic", "n_keys", "n_slots", "slot_bytes", "tick", "hits",
+              "misses", "evictions", "skipped")
+    IMAGE_MODES = ("L", "RGB", "RGBA")
+
+    def __init__(self, name: str, n_keys: int, sample_bytes: int,
+                 budget: int = 1024 ** 3, path: str = None,
+                 unlink_on_exit: bool = False):
+        if not isinstance(name, str) or len(name) == 0:
+            raise TypeError("SampleCache: name must be a non-empty str")
+        if not isinstance(n_keys, int) or n_keys < 1:
+            raise ValueError("SampleCache: n_keys must be int >= 1")
+        if not isinstance(sample_bytes, int) or sample_bytes < 1:
+            raise ValueError("SampleCache: sample_bytes must be int >= 1")
+        if budget < sample_bytes:
+            raise ValueError("SampleCache: budget must be >= sample_bytes")
+        if path is None:
+            path = "/dev/shm" if os.path.isdir("/dev/shm") else \
+                tempfile.gettempdir()
+        if not os.path.isdir(path):
+            raise ValueError("SampleCache: path is not valid dir")
+
+        self.name = name
+        self.file_name = os.path.join(path, "tensormonk_cache_" + name)
+        self.n_keys = n_keys
+        self.slot_bytes = sample_bytes
+        self.n_slots = int(budget // sample_bytes)
+        self._attach()
+        self._finalizer = None
+        if unlink_on_exit:
+            self._finalizer = weakref.finalize(
+                self, SampleCache._remove, self.file_name, os.getpid())
+
+    @staticmethod
+    def _remove(file_name: str, pid: int):
+        # forked workers inherit the finalizer, only the creator removes
+        if os.getpid() != pid:
+            return
+        for x in (file_name, file_name + ".lock"):
+            if os.path.isfile(x):
+                os.remove(x)
+
+    @staticmethod
+    def name_of(*args):
+        r""" A short name from the hash of args (Ex: stat_of(paths),
+        identity_of(decoder) and size) """
+        return hashlib.md5(repr(args).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def stat_of(files: list, n_threads: int = 8):
+        r""" (file, size, mtime in ns) of files -- files changed in place
+        change the name """
+        def stat(x):
+            stat = os.stat(x)
+            return x, stat.st_size, stat.st_mtime_ns
+
+        with ThreadPoolExecutor(n_threads) as pool:
+            return list(pool.map(stat, files, chunksize=256))
+
+    @staticmethod
+    def identity_of(fn):
+        r""" A run independent identity of a decoder -- module, name and
+        code of functions (and args of partials), repr of other callables
+        """
+        if isinstance(fn, functools.partial):
+            return (SampleCache.identity_of(fn.func), fn.args,
+                    sorted(fn.keywords.items()))
+        code = getattr(fn, "__code__", None)
+        if code is None:
+            return repr(fn)
+        # code objects of nested functions have an address in their repr
+        consts = tuple(getattr(x, "co_code", x) for x in code.co_consts)
+        return fn.__module__, fn.__qualname__, code.co_code, consts
+
+    def _layout(self):
+        r""" {array: (offset, dtype, shape)} and size of the arena """
+        layout, offset = {}, 0
+        for key, dtype, shape in (
+                ("header", np.int64, (len(SampleCache.HEADER), )),
+                ("slot_of", np.int32, (self.n_keys, )),
+                ("key_of", np.int64, (self.n_slots, )),
+                ("last_used", np.int64, (self.n_slots, )),
+                ("shapes", np.int32, (self.n_slots, 4)),
+                ("data", np.uint8, (self.n_slots, self.slot_bytes))):
+            # 8 byte aligned arrays, and page aligned data
+            offset = -(-offset // (4096 if key == "data" else 8)) * \
+                (4096 if key == "data" else 8)
+            layout[key] = (offset, dtype, shape)
+            offset += np.dtype(dtype).itemsize * int(np.prod(shape))
+        return layout, offset
+
+    def _attach(self):
+        r""" Opens (creates, when missing) the arena and the lock """
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(self.file_name + ".lock", os.O_RDWR | os.O_CREAT,
+                           0o666)
+        layout, size = self._layout()
+        config = [SampleCache.MAGIC, self.n_keys, self.n_slots,
+                  self.slot_bytes]
+        with self._lock():
+            exists = os.path.isfile(self.file_name)
+            if exists:
+                header = np.fromfile(self.file_name, np.int64, 4)
+                if header.tolist() != config or \
+                   os.path.getsize(self.file_name) != size:
+                    raise ValueError(
+                        "SampleCache: {} exists with a different n_keys/"
+                        "sample_bytes/budget".format(self.file_name))
+            else:
+                with open(self.file_name, "wb") as f:
+                    f.truncate(size)
+            self._arena = np.memmap(self.file_name, np.uint8, "r+",
+                                    shape=(size, ))
+            for key, (offset, dtype, shape) in layout.items():
+                n = np.dtype(dtype).itemsize * int(np.prod(shape))
+                setattr(self, "_" + key, self._arena[offset:offset + n].view(
+                    dtype).reshape(shape))
+            if not exists:
+                self._reset()
+                self._header[:4] = config
+
+    def _reset(self):
+        self._slot_of[:] = -1
+        self._key_of[:] = -1
+        self._last_used[:] = -1
+        self._header[4:] = 0
+
+    @contextmanager
+    def _lock(self):
+        if self._pid != os.getpid():
+            # flock is per open file -- a forked process needs its own (and
+            # closes the one inherited from the parent)
+            if self._fd is not None:
+                os.close(self._fd)
+            self._pid = os.getpid()
+            self._thread_lock = threading.Lock()
+            self._fd = os.open(self.file_name + ".lock", os.O_RDWR)
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __len__(self):
+        return int((self._key_of >= 0).sum())
+
+    def __contains__(self, key: int):
+        return bool(self._slot_of[key] >= 0)
+
+    def __getstate__(self):
+        return {x: self.__dict__[x] for x in
+                ("name", "file_name", "n_keys", "slot_bytes", "n_slots")}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._attach()
+
+    def get(self, key: int):
+        r""" Returns a copy of the cached array of key (None on a miss) """
+        with self._lock():
+            slot = int(self._slot_of[key])
+            if slot < 0:
+                self._header[6] += 1
+                return None
+            self._header[4:6] += 1
+            self._last_used[slot] = self._header[4]
+            ndim, *shape = self._shapes[slot].tolist()
+            shape = shape[:ndim]
+            return self._data[slot, :int(np.prod(shape))].reshape(
+                shape).copy()
+
+    def put(self, key: int, array: np.ndarray):
+        r""" Caches a uint8 array (evicts the least recently used sample when
+        the arena is full). Returns False when the array is larger than
+        sample_bytes. """
+        array = np.ascontiguousarray(array)
+        if array.dtype != np.uint8 or not 1 <= array.ndim <= 3:
+            raise TypeError("SampleCache: array must be uint8 with 1-3 dims")
+        with self._lock():
+            if array.nbytes > self.slot_bytes:
+                self._header[8] += 1
+                return False
+            if self._slot_of[key] >= 0:
+                return True
+            # unused slots have last_used = -1
+            slot = int(self._last_used.argmin())
+            old = int(self._key_of[slot])
+            if old >= 0:
+                self._slot_of[old] = -1
+                self._header[7] += 1
+            self._data[slot, :array.nbytes] = array.reshape(-1)
+            self._shapes[slot] = [array.ndim] + list(array.shape) + \
+                [0] * (3 - array.ndim)
+            self._header[4] += 1
+            self._last_used[slot] = self._header[4]
+            self._key_of[slot] = key
+            self._slot_of[key] = slot
+        return True
+
+    def fetch_image(self, key: int, load):
+        r""" Returns the PIL image of key from the cache, else load() (must
+        return a PIL image) is decoded and cached. Images with modes other
+        than L/RGB/RGBA are not cached. """
+        array = self.get(key)
+        if array is not None:
+            return ImPIL.fromarray(array)
+        image = load()
+        if isinstance(image, ImPIL.Image) and \
+           image.mode in SampleCache.IMAGE_MODES:
+            self.put(key, np.asarray(image))
+        return image
+
+    def stats(self):
+        r""" Returns hits, misses, evictions, skipped (too large), n_cached,
+        n_slots and hit_rate across all the processes """
+        hits, misses, evictions, skipped = self._header[5:9].tolist()
+        return {"hits": hits, "misses": misses, "evictions": evictions,
+                "skipped": skipped, "n_cached": len(self),
+                "n_slots": self.n_slots,
+                "hit_rate": hits / max(1, hits + misses)}
+
+    def clear(self):
+        r""" Removes all the samples and resets the counters """
+        with self._lock():
+            self._reset()
+
+    def close(self):
+        r""" Releases the arena of this process """
+        for key in ("_arena", "_header", "_slot_of", "_key_of", "_last_used",
+                    "_shapes", "_data"):
+            self.__dict__.pop(key, None)
+        if getattr(self, "_fd", None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def unlink(self):
+        r""" Releases and deletes the arena (all the processes) """
+        self.close()
+        if getattr(self, "_finalizer", None) is not None:
+            self._finalizer.detach()
+        SampleCache._remove(self.file_name, os.getpid())
+
+
+# from tensormonk.data import SampleCache
+# cache = SampleCache("test", 1000, 3 * 64 * 64, budget=100 * 3 * 64 * 64)
+# cache.put(0, np.zeros((64, 64, 3), np.uint8))
+# cache.get(0).shape, cache.get(1), cache.stats()
+# %timeit cache.get(0)
+# cache.unlink()
@@ -0,0 +1,252 @@
+""" TensorMONK :: data :: samplers """
+
+__all__ = ["PKBatchSampler", "AspectRatioBatchSampler"]
+
+import numpy as np
+import torch
+
+
+def _rank_and_world_size(rank: int = None, world_size: int = None):
+    if rank is None or world_size is None:
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and \
+           torch.distributed.is_initialized():
+            rank = torch.distributed.get_rank()
+            world_size = torch.distributed.get_world_size()
+    return rank, world_size
+
+
+class PKBatchSampler(torch.utils.data.Sampler):
+    r"""Batch sampler that delivers P labels x K samples per label (used for
+    metric learning). On a dataset with 10 labels, with p = 3 and k = 2, an
+    example batch can yield the following labels 6 6 0 0 2 2
+
+    Labels are never repeated within a batch, all the labels are used before
+    any label repeats (when n_labels is a multiple of p), and K samples of a
+    label are distinct when the label has >= K samples. Batches are computed
+    with vectorized ops from a label to indices array, are deterministic per
+    epoch (seed + epoch) and are split across distributed ranks (every rank
+    gets different batches). The epoch is incremented after every complete
+    iteration, use set_epoch to override.
+
+    Example:
+        >>> sampler = PKBatchSampler(dataset.targets, p=16, k=4)
+        >>> loader = torch.utils.data.DataLoader(
+                dataset, batch_sampler=sampler, num_workers=8)
+
+    Args:
+        labels (list/tuple/np.ndarray/torch.Tensor): label of every sample in
+            the dataset
+        p (int): labels per batch
+        k (int): samples per label
+        n_batches (int, optional): batches per epoch (per rank), default =
+            len(labels) // (p * k * world_size)
+        seed (int, optional): default = 0
+        rank (int, optional): default = torch.distributed rank or 0
+        world_size (int, optional): default = torch.distributed world size or
+            1
+    """
+    def __init__(self, labels, p: int, k: int, n_batches: int = None,
+                 seed: int = 0, rank: int = None, world_size: int = None):
+        if isinstance(labels, torch.Tensor):
+            labels = labels.cpu().numpy()
+        labels = np.asarray(labels).astype(np.int64).reshape(-1)
+        if not isinstance(p, int) or p < 1:
+            raise ValueError("PKBatchSampler: p must be int >= 1")
+        if not isinstance(k, int) or k < 1:
+            raise ValueError("PKBatchSampler: k must be int >= 1")
+
+        # label to indices -- indices sorted by label, start & count per label
+        self.indices = np.argsort(labels, kind="stable")
+        self.unique, self.starts, self.counts = np.unique(
+            labels[self.indices], return_index=True, return_counts=True)
+        if p > self.unique.size:
+            raise ValueError("PKBatchSampler: p must be <= number of labels "
+                             "({})".format(self.unique.size))
+
+        self.p, self.k = p, k
+        self.rank, self.world_size = _rank_and_world_size(rank, world_size)
+        if n_batches is None:
+            n_batches = max(1, labels.size // (p * k * self.world_size))
+        self.n_batches = n_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.n_batches
+
+    def batches(self, epoch: int):
+        r""" All the batches (of all ranks) for an epoch """
+        rng = np.random.default_rng(self.seed + epoch)
+        n_labels, p, k = self.unique.size, self.p, self.k
+        n_batches = self.n_batches * self.world_size
+
+        # shuffle the indices within each label
+        keys = rng.random(self.indices.size)
+        owner = np.repeat(np.arange(n_labels), self.counts)
+        shuffled = self.indices[np.lexsort((keys, owner))]
+
+        # P distinct labels per batch -- a permutation of labels is truncated
+        # to a multiple of p so that a batch never spans two permutations
+        per_permutation = n_labels // p
+        n_permutations = -(-n_batches // per_permutation)
+        labels = np.argsort(rng.random((n_permutations, n_labels)), 1)
+        labels = labels[:, :per_permutation * p].reshape(-1, p)[:n_batches]
+
+        # K consecutive samples (with wrap around) from a random start
+        counts = self.counts[labels][..., None]
+        offset = (rng.random(labels.shape) * self.counts[labels]).astype(
+            np.int64)[..., None]
+        positions = (offset + np.arange(k)) % counts
+        positions += self.starts[labels][..., None]
+        return shuffled[positions].reshape(n_batches, p * k)
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)[self.rank::self.world_size]
+        for batch in batches:
+            yield batch.tolist()
+        self.epoch += 1
+
+
+class AspectRatioBatchSampler(torch.utils.data.Sampler):
+    r"""Batch sampler that groups images by aspect ratio (w / h) into
+    buckets. Every bucket has its own target size (height, width) with
+    w / h close to the bucket ratio and about the same number of pixels
+    (rounded to a multiple of stride), and a batch never spans buckets. So,
+    wide and tall images are neither distorted nor padded to a square, and
+    padding happens only within a bucket.
+
+    Use size_of(idx) in the dataset to resize a sample to its bucket size
+    (Ex: PascalVOC.bucket_sampler), and AnchorDetector computes anchors per
+    bucket size.
+
+    Batches are deterministic per epoch (seed + epoch), shuffled within and
+    across buckets, and split across distributed ranks (every rank gets the
+    same number of batches). The epoch is incremented after every complete
+    iteration, use set_epoch to override.
+
+    Example:
+        >>> sampler = AspectRatioBatchSampler(dataset.sizes, 16)
+        >>> sampler.padding()  # padding fraction with and without buckets
+        >>> loader = torch.utils.data.DataLoader(
+                dataset, batch_sampler=sampler, num_workers=8)
+
+    Args:
+        sizes (np.ndarray/torch.Tensor/list): (width, height) of every image
+        batch_size (int): samples per batch
+        pixels (int, optional): pixels per image (height x width) of every
+            bucket, default = 320 * 320
+        ratios (tuple, optional): aspect ratios (w / h) of buckets, an image
+            is assigned to the nearest ratio (log scale), default =
+            (1 / 2, 2 / 3, 3 / 4, 1, 4 / 3, 3 / 2, 2)
+        stride (int, optional): height and width of buckets are multiples of
+            stride (the network stride), default = 32
+        shuffle (bool, optional): default = True
+        drop_last (bool, optional): drops the incomplete batch of every
+            bucket, default = False
+        seed (int, optional): default = 0
+        rank (int, optional): default = torch.distributed rank or 0
+        world_size (int, optional): default = torch.distributed world size or
+            1
+    """
+    def __init__(self, sizes, batch_size: int, pixels: int = 320 * 320,
+                 ratios: tuple = (1 / 2, 2 / 3, 3 / 4, 1, 4 / 3, 3 / 2, 2),
+                 stride: int = 32, shuffle: bool = True,
+                 drop_last: bool = False, seed: int = 0, rank: int = None,
+                 world_size: int = None):
+        if isinstance(sizes, torch.Tensor):
+            sizes = sizes.cpu().numpy()
+        sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("AspectRatioBatchSampler: batch_size must be int "
+                             ">= 1")
+        if not (sizes > 0).all():
+            raise ValueError("AspectRatioBatchSampler: sizes must be > 0")
+        if not isinstance(stride, int) or stride < 1:
+            raise ValueError("AspectRatioBatchSampler: stride must be int >= "
+                             "1")
+
+        self.sizes = sizes
+        self.batch_size = batch_size
+        self.ratios = np.sort(np.asarray(ratios, dtype=np.float64))
+        # target size of every bucket
+        heights = np.sqrt(pixels / self.ratios)
+        widths = heights * self.ratios
+        self.bucket_sizes = [
+            (max(stride, int(round(h / stride)) * stride),
+             max(stride, int(round(w / stride)) * stride))
+            for h, w in zip(heights, widths)]
+        # nearest bucket in log scale
+        distance = np.abs(np.log(sizes[:, :1] / sizes[:, 1:]) -
+                          np.log(self.ratios)[None])
+        self.buckets = distance.argmin(1)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = _rank_and_world_size(rank, world_size)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def size_of(self, idx: int):
+        r""" (height, width) of the bucket of sample idx """
+        return self.bucket_sizes[self.buckets[idx]]
+
+    def __len__(self):
+        counts = np.bincount(self.buckets, minlength=self.ratios.size)
+        if self.drop_last:
+            n = (counts // self.batch_size).sum()
+        else:
+            n = (-(-counts // self.batch_size)).sum()
+        return int(n // self.world_size)
+
+    def batches(self, epoch: int):
+        r""" All the batches (of all ranks) for an epoch """
+        rng = np.random.default_rng(self.seed + epoch)
+        batches = []
+        for bucket in range(self.ratios.size):
+            indices = np.nonzero(self.buckets == bucket)[0]
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            for start in range(0, indices.size, self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if self.drop_last and batch.size < self.batch_size:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # same number of batches per rank
+        return batches[:len(self) * self.world_size]
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)[self.rank::self.world_size]
+        for batch in batches:
+            yield batch.tolist()
+        self.epoch += 1
+
+    def padding(self, t_size: tuple = None):
+        r"""Fraction of padded pixels when images are resized (retaining the
+        aspect ratio) to their bucket size vs to a single size (t_size, BCHW,
+        default = square of the same pixels). Returns a dict of bucketed,
+        single and saved (single - bucketed). """
+        if t_size is None:
+            side = self.bucket_sizes[int(np.abs(np.log(self.ratios)).argmin())]
+            t_size = (1, 3) + tuple(side)
+
+        def fraction(targets: np.ndarray):
+            # targets -- (height, width) per image
+            scale = np.minimum(targets[:, 1] / self.sizes[:, 0],
+                               targets[:, 0] / self.sizes[:, 1])
+            used = (self.sizes * scale[:, None]).prod(1)
+            return float(1 - used.sum() / targets.prod(1).sum())
+
+        bucketed = fraction(np.array(self.bucket_sizes,
+                                     dtype=np.float64)[self.buckets])
+        single = fraction(np.array([t_size[2:]] * len(self.buckets),
+                                   dtype=np.float64))
+        return {"bucketed": bucketed, "single": single,
+                "saved": single - bucketed}
@@ -0,0 +1,298 @@
+""" TensorMONK's :: data :: Shards """
+
+__all__ = ["ShardWriter", "ShardDataset"]
+
+import os
+import io
+import glob
+import queue
+import random
+import tarfile
+import threading
+import msgpack
+import numpy as np
+import torch
+from PIL import Image as ImPIL
+from torchvision import transforms
+
+
+def _pack(content: dict):
+    r""" Encodes labels/boxes/points (int/float/list/np.ndarray) to bytes """
+    out = {}
+    for key, value in content.items():
+        if isinstance(value, np.ndarray):
+            value = {b"dtype": value.dtype.str, b"shape": list(value.shape),
+                     b"content": value.tobytes()}
+        out[key] = value
+    return msgpack.packb(out, use_bin_type=True)
+
+
+def _unpack(content: bytes):
+    r""" Decodes bytes from _pack """
+    out = msgpack.unpackb(content, raw=False, use_list=True)
+    for key, value in out.items():
+        if isinstance(value, dict) and b"dtype" in value:
+            out[key] = np.frombuffer(
+                value[b"content"], dtype=np.dtype(value[b"dtype"])).reshape(
+                    value[b"shape"]).copy()
+    return out
+
+
+class ShardWriter(object):
+    r"""Writes samples (image bytes along with labels/boxes/points) to a
+    sequence of tar shards. Each sample is stored as two consecutive members
+    "{index:010}.{image extension}" and "{index:010}.msgpack", and a new
+    shard is started when the current shard exceeds max_size bytes.
+
+    Example:
+        >>> with ShardWriter("./shards/train-%06d.tar") as writer:
+        >>>     writer.write("./image1.jpg", label=2)
+        >>>     writer.write("./image2.jpg", label=4,
+                             boxes=np.array([[4, 6, 40, 60]], np.float32))
+
+    Args:
+        pattern (str): shard file name with a %d format, Ex:
+            "./shards/train-%06d.tar"
+        max_size (int): maximum size of a shard in bytes, default = 256MB
+    """
+    def __init__(self, pattern: str, max_size: int = 256 * 1024 * 1024):
+        if not isinstance(pattern, str):
+            raise TypeError("ShardWriter: pattern must be str")
+        if "%" not in pattern:
+            raise ValueError("ShardWriter: pattern must have %d format")
+        if not isinstance(max_size, int) or max_size < 1:
+            raise ValueError("ShardWriter: max_size must be int >= 1")
+
+        self.pattern = pattern
+        self.max_size = max_size
+        self.shards = []
+        self.n_samples = 0
+        self._tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.n_samples
+
+    def write(self, image, **kwargs):
+        r""" Writes a sample.
+
+        Args:
+            image (str/bytes/pil-image): full path of image, encoded image
+                bytes or pil-image (saved as png)
+            kwargs: int/float/str/list/np.ndarray values (Ex: label=2,
+                boxes=np.ndarray, points=np.ndarray)
+        """
+        if isinstance(image, str):
+            extension = os.path.splitext(image)[1][1:].lower()
+            with open(image, "rb") as f:
+                image = f.read()
+        elif isinstance(image, bytes):
+            extension = "image"
+        elif isinstance(image, ImPIL.Image):
+            buffer = io.BytesIO()
+            image.save(buffer, format="png")
+            image, extension = buffer.getvalue(), "png"
+        else:
+            raise TypeError("ShardWriter: image must be str/bytes/pil-image")
+
+        if self._tar is None or self._tar.fileobj.tell() >= self.max_size:
+            self._next_shard()
+        key = "{:010}".format(self.n_samples)
+        self._add(key + "." + extension, image)
+        self._add(key + ".msgpack", _pack(kwargs))
+        self.n_samples += 1
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def _add(self, name: str, content: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        self._tar.addfile(info, io.BytesIO(content))
+
+    def _next_shard(self):
+        self.close()
+        self.shards.append(self.pattern % len(self.shards))
+        self._tar = tarfile.open(self.shards[-1], "w")
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    r"""Streams samples from tar shards written by ShardWriter. Shards are
+    read sequentially (no random file access), and are split across
+    DataLoader workers and distributed ranks. A background thread reads
+    ahead of the decoding, and samples are shuffled using a buffer.
+
+    Args:
+        shards (str/list/tuple): a glob pattern (Ex: "./shards/train-*.tar")
+            or a list/tuple of shards
+        tensor_size (list/tuple, optional): BCHW, when not None images are
+            resized to tensor_size. default = None
+        attributes (list/tuple, optional): values returned per sample, "image"
+            is the decoded image tensor and the rest are keys used in
+            ShardWriter.write. default = ("image", "label")
+        shuffle_buffer (int, optional): size of shuffle buffer, 0 to disable
+            shuffle (shards are also not shuffled). default = 1024
+        read_ahead (int, optional): samples read ahead by the background
+            thread. default = 256
+        process_image (function, optional): None (decodes and resizes to
+            tensor_size) or a function that accepts image bytes and returns a
+            tensor. default = None
+        seed (int, optional): seed for shuffle, use set_epoch to change the
+            order every epoch. default = 0
+
+    ** When the number of shards is not a multiple of workers x ranks, some
+    workers get an additional shard.
+    """
+    def __init__(self,
+                 shards,
+                 tensor_size: tuple = None,
+                 attributes: tuple = ("image", "label"),
+                 shuffle_buffer: int = 1024,
+                 read_ahead: int = 256,
+                 process_image=None,
+                 seed: int = 0):
+        super(ShardDataset, self).__init__()
+
+        if isinstance(shards, str):
+            shards = sorted(glob.glob(shards))
+        if not isinstance(shards, (list, tuple)):
+            raise TypeError("ShardDataset: shards must be str/list/tuple")
+        if len(shards) == 0:
+            raise ValueError("ShardDataset: no shards")
+        if not isinstance(shuffle_buffer, int) or shuffle_buffer < 0:
+            raise ValueError("ShardDataset: shuffle_buffer must be int >= 0")
+        if not isinstance(read_ahead, int) or read_ahead < 1:
+            raise ValueError("ShardDataset: read_ahead must be int >= 1")
+
+        self.shards = list(shards)
+        self.tensor_size = tensor_size
+        self.attributes = attributes
+        self.shuffle_buffer = shuffle_buffer
+        self.read_ahead = read_ahead
+        self.seed = seed
+        self.epoch = 0
+        self.to_tensor = transforms.ToTensor()
+        if process_image is None:
+            process_image = self.decode_image
+        self.process_image = process_image
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def decode_image(self, content: bytes):
+        image = ImPIL.open(io.BytesIO(content))
+        t_size = self.tensor_size
+        if t_size is not None:
+            image = image.convert("L" if t_size[1] == 1 else "RGB")
+            if image.size != (t_size[3], t_size[2]):
+                image = image.resize((t_size[3], t_size[2]), ImPIL.BILINEAR)
+        return self.to_tensor(image)
+
+    def my_shards(self):
+        r""" Shards of current worker and rank (in the order of reading) """
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and \
+           torch.distributed.is_initialized():
+            rank = torch.distributed.get_rank()
+            world_size = torch.distributed.get_world_size()
+        worker_id, n_workers = 0, 1
+        info = torch.utils.data.get_worker_info()
+        if info is not None:
+            worker_id, n_workers = info.id, info.num_workers
+
+        shards = list(self.shards)
+        if self.shuffle_buffer > 0:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[rank * n_workers + worker_id::world_size * n_workers]
+
+    @staticmethod
+    def read_shard(shard: str):
+        r""" Streams (key, {extension: bytes}) from a shard """
+        key, sample = None, {}
+        with tarfile.open(shard, "r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name, extension = member.name.rsplit(".", 1)
+                if key is not None and name != key:
+                    yield key, sample
+                    sample = {}
+                key = name
+                sample[extension] = tar.extractfile(member).read()
+        if key is not None:
+            yield key, sample
+
+    @staticmethod
+    def _put(samples: queue.Queue, sample, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                samples.put(sample, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_ahead(self, shards: list, samples: queue.Queue,
+                    stop: threading.Event):
+        end = None
+        try:
+            for shard in shards:
+                for sample in self.read_shard(shard):
+                    if not self._put(samples, sample, stop):
+                        return
+        except Exception as error:
+            # raised by __iter__ -- a corrupt/truncated shard is not the end
+            # of samples
+            end = error
+        finally:
+            # end of samples
+            self._put(samples, end, stop)
+
+    def _decode(self, sample: tuple):
+        key, sample = sample
+        content = _unpack(sample.pop("msgpack"))
+        values = []
+        for attribute in self.attributes:
+            if attribute == "image":
+                values.append(self.process_image(list(sample.values())[0]))
+            else:
+                values.append(content[attribute])
+        return tuple(values)
+
+    def __iter__(self):
+        samples, stop = queue.Queue(self.read_ahead), threading.Event()
+        reader = threading.Thread(target=self._read_ahead, daemon=True,
+                                  args=(self.my_shards(), samples, stop))
+        reader.start()
+
+        rng = random.Random(self.seed + self.epoch + 1)
+        buffer = []
+        try:
+            while True:
+                sample = samples.get()
+                if sample is None:
+                    break
+                if isinstance(sample, Exception):
+                    raise sample
+                if self.shuffle_buffer == 0:
+                    yield self._decode(sample)
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                idx = rng.randrange(len(buffer))
+                buffer[idx], sample = sample, buffer[idx]
+                yield self._decode(sample)
+            rng.shuffle(buffer)
+            for sample in buffer:
+                yield self._decode(sample)
+        finally:
+            stop.set()
+            reader.join()
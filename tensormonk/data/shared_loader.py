@@ -0,0 +1,205 @@
+""" TensorMONK :: data :: SharedBatchLoader """
+
+__all__ = ["SharedBatchLoader"]
+
+import warnings
+import numpy as np
+import torch
+from PIL import Image as ImPIL
+
+
+class _NumberedBatches(torch.utils.data.Sampler):
+    r""" Yields (batch number, indices) of a batch sampler """
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        return enumerate(self.batch_sampler)
+
+    def set_epoch(self, epoch: int):
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+
+class _SlotWriter(torch.utils.data.Dataset):
+    r""" Writes the samples of a batch to slot (batch number % n_slots) of
+    the shared buffers and returns (slot, n_samples) """
+    def __init__(self, dataset, images: torch.Tensor, labels: torch.Tensor):
+        self.dataset = dataset
+        self.images = images
+        self.labels = labels
+
+    def __getitem__(self, batch: tuple):
+        batch_number, indices = batch
+        slot = batch_number % self.images.shape[0]
+        samples, labels = [], []
+        for idx in indices:
+            sample, label = self.dataset[idx]
+            samples.append(self.to_chw(sample))
+            labels.append(int(label))
+        n = len(labels)
+        if all(x.dtype == self.images.dtype for x in samples):
+            torch.stack(samples, out=self.images[slot, :n])
+        else:
+            for image, sample in zip(self.images[slot].unbind(0), samples):
+                image.copy_(sample)
+        self.labels[slot, :n] = torch.tensor(labels)
+        return slot, n
+
+    @staticmethod
+    def to_chw(image):
+        r""" CHW tensor of a CHW tensor, a HWC/HW ndarray or a pil image """
+        if isinstance(image, ImPIL.Image):
+            image = np.asarray(image)
+        if isinstance(image, np.ndarray):
+            image = torch.from_numpy(image)
+            image = image.permute(2, 0, 1) if image.dim() == 3 else \
+                image.unsqueeze(0)
+        return image
+
+
+class SharedBatchLoader(object):
+    r"""DataLoader that collates into a preallocated pool of shared memory
+    batches (n_slots x batch_size x tensor_size[1:]). A worker writes the
+    samples of a batch directly into slot (batch number % n_slots) and sends
+    only (slot, n_samples) to the main process -- batches are neither
+    allocated nor pickled. The pool is pinned once (cudaHostRegister), so
+    host-to-device copies (device) are async.
+
+    DataLoader dispatches a new batch only after a batch is delivered, so at
+    most num_workers * prefetch_factor batches are in flight, and
+    n_slots = num_workers * prefetch_factor + 1 slots ensure that a worker
+    never writes to the delivered batch.
+
+    Example:
+        >>> loader = SharedBatchLoader(dataset, (1, 3, 224, 224), 64,
+                                       shuffle=True, num_workers=8,
+                                       device="cuda")
+        >>> for images, labels in loader:
+        >>>     pass
+
+    Args:
+        dataset: an indexable dataset that returns (image, int label), where
+            image is a CHW tensor, HWC/HW ndarray or pil image of
+            tensor_size[1:]
+        tensor_size (list/tuple): BCHW of images
+        batch_size (int): samples per batch (maximum samples per batch when
+            batch_sampler is used)
+        shuffle (bool, optional): default = False
+        sampler (torch.utils.data.Sampler, optional): default = None
+        batch_sampler (torch.utils.data.Sampler, optional): default = None
+        drop_last (bool, optional): default = False
+        num_workers (int, optional): default = 0
+        prefetch_factor (int, optional): batches per worker, default = 2
+        dtype (torch.dtype, optional): dtype of images (torch.uint8 reduces
+            the memory and transfer by 4x). default = torch.float32
+        pin_memory (bool, optional): pins the pool when cuda is available,
+            default = True
+        device (str/torch.device, optional): When not None, batches are
+            copied to device. default = None
+
+    ** A delivered batch (on cpu) is valid until the next batch is requested,
+    clone it to retain.
+    """
+    def __init__(self,
+                 dataset,
+                 tensor_size: tuple,
+                 batch_size: int,
+                 shuffle: bool = False,
+                 sampler=None,
+                 batch_sampler=None,
+                 drop_last: bool = False,
+                 num_workers: int = 0,
+                 prefetch_factor: int = 2,
+                 dtype: torch.dtype = torch.float32,
+                 pin_memory: bool = True,
+                 device=None,
+                 **kwargs):
+
+        if not (isinstance(tensor_size, (list, tuple)) and
+                len(tensor_size) == 4):
+            raise TypeError("SharedBatchLoader: tensor_size must be BCHW")
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("SharedBatchLoader: batch_size must be int >= 1")
+        if not isinstance(num_workers, int) or num_workers < 0:
+            raise ValueError("SharedBatchLoader: num_workers must be int >= "
+                             "0")
+        if not isinstance(prefetch_factor, int) or prefetch_factor < 1:
+            raise ValueError("SharedBatchLoader: prefetch_factor must be int "
+                             ">= 1")
+
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = torch.utils.data.RandomSampler(dataset) if \
+                    shuffle else torch.utils.data.SequentialSampler(dataset)
+            batch_sampler = torch.utils.data.BatchSampler(
+                sampler, batch_size, drop_last)
+        self.batch_sampler = batch_sampler
+        self.batch_size = batch_size
+        self.n_slots = max(2, num_workers * prefetch_factor + 1)
+        self.images = torch.empty(
+            (self.n_slots, batch_size) + tuple(tensor_size[1:]),
+            dtype=dtype).share_memory_()
+        self.labels = torch.zeros(self.n_slots, batch_size,
+                                  dtype=torch.int64).share_memory_()
+        self.device = None if device is None else torch.device(device)
+        self.pinned = False
+        if pin_memory and torch.cuda.is_available():
+            self.pin()
+
+        if num_workers > 0:
+            kwargs["prefetch_factor"] = prefetch_factor
+        self.loader = torch.utils.data.DataLoader(
+            _SlotWriter(dataset, self.images, self.labels), batch_size=None,
+            sampler=_NumberedBatches(batch_sampler), num_workers=num_workers,
+            **kwargs)
+
+    def pin(self):
+        r""" Pins the pool (page-locked in place, no copy) """
+        if self.pinned:
+            return
+        try:
+            for x in (self.images, self.labels):
+                code = torch.cuda.cudart().cudaHostRegister(
+                    x.data_ptr(), x.numel() * x.element_size(), 0)
+                if int(code) != 0:
+                    raise RuntimeError("cudaHostRegister failed - "
+                                       "{}".format(code))
+            self.pinned = True
+        except (RuntimeError, AttributeError) as e:
+            warnings.warn("SharedBatchLoader: unable to pin - {}".format(e))
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        event = None
+        for slot, n in self.loader:
+            images, labels = self.images[slot, :n], self.labels[slot, :n]
+            if self.device is not None and self.device.type == "cuda":
+                non_blocking = self.pinned
+                images = images.to(self.device, non_blocking=non_blocking)
+                labels = labels.to(self.device, non_blocking=non_blocking)
+                if non_blocking:
+                    event = torch.cuda.Event()
+                    event.record()
+            elif self.device is not None:
+                images, labels = images.to(self.device), \
+                    labels.to(self.device)
+            yield images, labels
+            if event is not None:
+                # the slot can be rewritten once the next batch is requested
+                event.synchronize()
+                event = None
+
+
+# from tensormonk.data import SharedBatchLoader
+# dataset = torchvision.datasets.CIFAR10(
+#     "../data", train=True, transform=torchvision.transforms.ToTensor())
+# loader = SharedBatchLoader(dataset, (1, 3, 32, 32), 256, shuffle=True,
+#                            num_workers=4, device="cuda")
+# for images, labels in loader:
+#     pass
@@ -3,10 +3,42 @@
 __all__ = ["SuperResolutionData"]
 
 import os
+import json
+import multiprocessing
+import numpy as np
+import torch
 from PIL import Image as ImPIL
 from torchvision import transforms
 
 
+def _patch_positions(size: int, patch: int, stride: int):
+    r""" Patch starts along a dimension (the last patch ends at the edge) """
+    positions = list(range(0, size - patch + 1, stride))
+    if positions and positions[-1] != size - patch:
+        positions.append(size - patch)
+    return positions
+
+
+def _tile(args: tuple):
+    r""" Tiles an image into overlapping uint8 HR patches (CHW) and their
+    bicubic LR patches """
+    file_name, hr_size, lr_size, stride = args
+    image = ImPIL.open(file_name).convert("RGB")
+    w, h = image.size
+    hr, lr = [], []
+    for top in _patch_positions(h, hr_size[0], stride[0]):
+        for left in _patch_positions(w, hr_size[1], stride[1]):
+            patch = image.crop((left, top, left + hr_size[1],
+                                top + hr_size[0]))
+            hr.append(np.asarray(patch))
+            lr.append(np.asarray(patch.resize(lr_size[::-1], ImPIL.BICUBIC)))
+    if len(hr) == 0:
+        return (np.zeros((0, 3) + tuple(hr_size), np.uint8),
+                np.zeros((0, 3) + tuple(lr_size), np.uint8))
+    return (np.stack(hr).transpose(0, 3, 1, 2),
+            np.stack(lr).transpose(0, 3, 1, 2))
+
+
 class SuperResolutionData(object):
     r"""Super-Resolution train and test data.
 
@@ -38,6 +70,21 @@ class SuperResolutionData(object):
 
         add_flickr2k (bool, optional): When True, adds Flickr2K to training.
             default: True
+
+        patch_cache (str, optional): full path (prefix) of patch cache. When
+            not None (train only), every HR image is tiled once into
+            overlapping HR patches and their bicubic LR patches, which are
+            stored in memory-mapped files (patch_cache + ".hr.npy" and
+            patch_cache + ".lr.npy"). A sample is then a slice read with
+            random flips (RandomResizedCrop is not used).
+            default: None
+
+        patch_stride (float, optional): stride of tiles relative to HR patch
+            size (0.5 = 50% overlap).
+            default: 0.5
+
+        cpus (int, optional): processes used to build the patch cache.
+            default: cpu_count
     """
 
     def __init__(self,
@@ -45,7 +92,10 @@ class SuperResolutionData(object):
                  t_size: tuple = (1, 3, 32, 32),
                  n_upscale: int = 2,
                  test: bool = False,
-                 add_flickr2k: bool = True):
+                 add_flickr2k: bool = True,
+                 patch_cache: str = None,
+                 patch_stride: float = 0.5,
+                 cpus: int = multiprocessing.cpu_count()):
 
         if not isinstance(path, str):
             raise TypeError("SuperResolutionData: path must be str.")
@@ -63,6 +113,12 @@ class SuperResolutionData(object):
             raise TypeError("SuperResolutionData: test must be bool.")
         if not isinstance(add_flickr2k, bool):
             raise TypeError("SuperResolutionData: add_flickr2k must be bool.")
+        if not (patch_cache is None or isinstance(patch_cache, str)):
+            raise TypeError("SuperResolutionData: patch_cache must be "
+                            "None/str.")
+        if not (0 < patch_stride <= 1):
+            raise ValueError("SuperResolutionData: patch_stride must be in "
+                             "(0, 1].")
 
         self.__dict__.update(locals())
         self.dataset = []
@@ -87,10 +143,27 @@ class SuperResolutionData(object):
                 transforms.RandomVerticalFlip()])
         self.to_tensor = transforms.ToTensor()
 
+        self.hr_patches = self.lr_patches = None
+        if patch_cache is not None and not self.test:
+            self.build_patch_cache(sz)
+
     def __len__(self):
+        if self.hr_patches is not None:
+            return self.hr_patches.shape[0]
         return len(self.dataset)
 
     def __getitem__(self, index: int):
+        if self.hr_patches is not None:
+            hr = torch.from_numpy(self.hr_patches[index])
+            lr = torch.from_numpy(self.lr_patches[index])
+            flips = [d for d, p in zip((2, 1), torch.rand(2).tolist())
+                     if p < 0.5]
+            if flips:
+                hr, lr = hr.flip(flips), lr.flip(flips)
+            hr = hr.float().div_(255).add_(-0.5).div_(0.25)
+            lr = lr.float().div_(255).add_(-0.5).div_(0.25)
+            return hr, lr
+
         image = self.dataset[index % len(self.dataset)]
         hr = self.transforms(image)
         lr = hr.resize(reversed(self.t_size[-2:]), ImPIL.BICUBIC)
@@ -99,6 +172,51 @@ class SuperResolutionData(object):
         lr = self.to_tensor(lr).add_(-0.5).div_(0.25)
         return hr, lr
 
+    def build_patch_cache(self, hr_size: tuple):
+        r"""Tiles all the HR images into overlapping patches (HR & LR) and
+        saves them to memory-mapped files. An existing cache with the same
+        images, sizes and stride is reused."""
+        lr_size = tuple(self.t_size[-2:])
+        stride = tuple(max(1, int(x * self.patch_stride)) for x in hr_size)
+        config = {"images": sorted(self.dataset), "hr_size": list(hr_size),
+                  "lr_size": list(lr_size), "stride": list(stride)}
+        hr_name = self.patch_cache + ".hr.npy"
+        lr_name = self.patch_cache + ".lr.npy"
+        if os.path.isfile(self.patch_cache + ".json") and \
+           os.path.isfile(hr_name) and os.path.isfile(lr_name):
+            with open(self.patch_cache + ".json") as f:
+                if json.load(f) == config:
+                    self.hr_patches = np.load(hr_name, mmap_mode="c")
+                    self.lr_patches = np.load(lr_name, mmap_mode="c")
+                    return
+
+        # count patches (only image headers are read)
+        n = 0
+        for x in config["images"]:
+            with ImPIL.open(x) as image:
+                w, h = image.size
+            n += (len(_patch_positions(h, hr_size[0], stride[0])) *
+                  len(_patch_positions(w, hr_size[1], stride[1])))
+        hr = np.lib.format.open_memmap(hr_name, mode="w+", dtype=np.uint8,
+                                       shape=(n, 3) + tuple(hr_size))
+        lr = np.lib.format.open_memmap(lr_name, mode="w+", dtype=np.uint8,
+                                       shape=(n, 3) + lr_size)
+        args = [(x, tuple(hr_size), lr_size, stride)
+                for x in config["images"]]
+        start = 0
+        with multiprocessing.Pool(max(1, self.cpus)) as pool:
+            for hr_patches, lr_patches in pool.imap(_tile, args):
+                end = start + hr_patches.shape[0]
+                hr[start:end], lr[start:end] = hr_patches, lr_patches
+                start = end
+        hr.flush()
+        lr.flush()
+        del hr, lr
+        with open(self.patch_cache + ".json", "w") as f:
+            json.dump(config, f)
+        self.hr_patches = np.load(hr_name, mmap_mode="c")
+        self.lr_patches = np.load(lr_name, mmap_mode="c")
+
     def get_div2k(self):
         r"""DIV2K dataset.
 
@@ -52,13 +52,28 @@ class RandomBlur(nn.Module):
     r"""Does random blur with given a kernel size by varying sigma. Refer to
     GaussianKernel for details on kernel computation.
 
+    When per_sample is True, every sample gets its own 1D kernel (a random
+    kernel type from kernels) that is applied as two grouped depthwise 1D
+    convolutions (cost grows with width instead of width^2).
+        gaussian - sigma in the range of 1-6 (same as per_sample=False)
+        box - random odd length in the range of 3-width
+        motion - box along a random direction (horizontal or vertical)
+
     Args:
         width (int): width of kernel, default = 5.
+        per_sample (bool): When True, blur is different for every sample.
+            Else, a single random gaussian kernel is used for a batch.
+            default = True
+        kernels (tuple): kernel types used when per_sample is True, options
+            are "gaussian", "box" and "motion". default = ("gaussian", )
 
     Return:
         Blurred 4D BCHW torch.Tensor with size same as input tensor
     """
-    def __init__(self, width: int = 5):
+    KERNELS = ("gaussian", "box", "motion")
+
+    def __init__(self, width: int = 5, per_sample: bool = True,
+                 kernels: tuple = ("gaussian", )):
         super(RandomBlur, self).__init__()
 
         if not isinstance(width, int):
@@ -67,12 +82,25 @@ class RandomBlur(nn.Module):
         if width < 3:
             raise ValueError("RandomBlur: width must be >= 3"
                              ": {}".format(width))
+        if not isinstance(per_sample, bool):
+            raise TypeError("RandomBlur: per_sample must be bool: "
+                            "{}".format(type(per_sample).__name__))
+        if isinstance(kernels, str):
+            kernels = (kernels, )
+        if len(kernels) == 0 or \
+           any(x not in RandomBlur.KERNELS for x in kernels):
+            raise ValueError("RandomBlur: kernels must be a tuple of "
+                             "{}: {}".format(RandomBlur.KERNELS, kernels))
 
         # only odd kernels
         if width % 2 == 0:
             width += 1
-        # pre compute few random kernels
         self.pad = width // 2
+        self.per_sample = per_sample
+        self.kernel_types = tuple(kernels)
+        self.register_buffer("positions",
+                             torch.arange(-self.pad, self.pad + 1.))
+        # pre compute few random kernels
         self.register_buffer("kernels",
                              torch.cat([GaussianKernel(x, width)
                                         for x in np.arange(1., 6., 0.1)]))
@@ -83,6 +111,10 @@ class RandomBlur(nn.Module):
         self.n_kernels = self.rand_idx.numel()
 
     def forward(self, tensor):
+        if self.per_sample:
+            return self.separable(tensor, *self.random_kernels(
+                tensor.shape[0], tensor.device))
+
         n, c, h, w = tensor.shape
         if self.track + n >= self.n_kernels:
             self.track = 0
@@ -93,6 +125,40 @@ class RandomBlur(nn.Module):
             kernels = kernels.repeat(c, 1, 1, 1)
         return F.conv2d(tensor, kernels, padding=[self.pad]*2, groups=c)
 
+    def random_kernels(self, n: int, device: torch.device):
+        r""" Returns horizontal and vertical 1D kernels (n x width) """
+        x = self.positions.to(device)
+        kind = torch.tensor([self.KERNELS.index(k) for k in
+                             choices(self.kernel_types, k=n)], device=device)
+        # gaussian
+        sigma = torch.rand(n, 1, device=device) * 5 + 1
+        gaussian = torch.exp(- x.pow(2) / (2 * sigma.pow(2)))
+        # box (also used for motion)
+        length = torch.randint(1, self.pad + 1, (n, 1), device=device)
+        box = (x.abs() <= length).float()
+        delta = (x == 0).float().expand(n, -1)
+
+        horizontal = torch.rand(n, 1, device=device) < 0.5
+        motion = (kind == 2).view(-1, 1)
+        kx = torch.where((kind == 0).view(-1, 1), gaussian, box)
+        ky = kx.clone()
+        kx = torch.where(motion & ~horizontal, delta, kx)
+        ky = torch.where(motion & horizontal, delta, ky)
+        return (kx / kx.sum(1, keepdim=True), ky / ky.sum(1, keepdim=True))
+
+    def separable(self, tensor: torch.Tensor, kx: torch.Tensor,
+                  ky: torch.Tensor):
+        r""" Blurs every sample with its kernels (kx & ky of shape n x width)
+        using two grouped depthwise 1D convolutions """
+        n, c, h, w = tensor.shape
+        width = kx.shape[1]
+        kx = kx.to(tensor.dtype).repeat_interleave(c, 0).view(-1, 1, 1, width)
+        ky = ky.to(tensor.dtype).repeat_interleave(c, 0).view(-1, 1, width, 1)
+        tensor = tensor.reshape(1, n * c, h, w)
+        tensor = F.conv2d(tensor, kx, padding=(0, self.pad), groups=n * c)
+        tensor = F.conv2d(tensor, ky, padding=(self.pad, 0), groups=n * c)
+        return tensor.view(n, c, h, w)
+
 
 class RandomNoise(nn.Module):
     r"""Add Gaussian Noise to tensor.
@@ -168,6 +234,15 @@ class ElasticSimilarity(nn.Module):
             min(h, w)//4 is applied on both directions of height and width
             before transformation and then center cropped to minimize zero
             padding. Default = False
+        half (bool): When True, grid_sample is done in float16 (recommended
+            for GPU). Default = False
+        probability (float): probability of transformation per sample, only
+            the selected subset of the batch is transformed. Default = 1.
+
+    The identity grid is cached per (height, width, device, dtype), and the
+    similarity transformations (a bmm on the identity grid) and the elastic
+    offsets are composed into a single grid, so a batch needs one
+    grid_sample.
 
     ** reflective_pad is an expensive operation.
     ** Not recommended for CPU (Pillow/OpenCV based functions are faster).
@@ -182,7 +257,9 @@ class ElasticSimilarity(nn.Module):
                  horizontal_flip: bool = False,
                  vertical_flip: bool = False,
                  zoom_in_only: bool = True,
-                 reflective_pad: bool = False):
+                 reflective_pad: bool = False,
+                 half: bool = False,
+                 probability: float = 1.):
         super(ElasticSimilarity, self).__init__()
         # checks
         if not isinstance(elastic, float):
@@ -216,7 +293,17 @@ class ElasticSimilarity(nn.Module):
             raise TypeError("ElasticSimilarity: reflective_pad must be bool: "
                             "{}".format(type(reflective_pad).__name__))
 
+        if not isinstance(half, bool):
+            raise TypeError("ElasticSimilarity: half must be bool: "
+                            "{}".format(type(half).__name__))
+        if not (0. < probability <= 1.):
+            raise ValueError("ElasticSimilarity: 0. < probability <= 1."
+                             ": {}".format(probability))
+
         self.reflective_pad = reflective_pad
+        self.half = half
+        self.probability = probability
+        self._grids = {}
         if elastic > 0:
             self.elastic_factor = elastic
         if translation > 0:
@@ -268,7 +355,34 @@ class ElasticSimilarity(nn.Module):
         self.identity = torch.FloatTensor([1, 0, 0, 0, 1, 0]).view(1, 2, 3)
 
     def forward(self, tensor: torch.Tensor):
-
+        if self.probability < 1.:
+            # transform a random subset of the batch
+            idx = torch.rand(tensor.shape[0], device=tensor.device).lt(
+                self.probability).nonzero().view(-1)
+            if idx.numel() == 0:
+                return tensor
+            tensor = tensor.clone()
+            tensor[idx] = self.transform(tensor[idx])
+            return tensor
+        return self.transform(tensor)
+
+    def base_grid(self, h: int, w: int, device: torch.device,
+                  dtype: torch.dtype):
+        r""" Cached identity grid (h*w x 3 of x, y, 1), same as
+        F.affine_grid(identity, align_corners=False) """
+        key = (h, w, device, dtype)
+        if key not in self._grids:
+            xs = torch.arange(w, device=device, dtype=dtype).mul(2).add(1)
+            ys = torch.arange(h, device=device, dtype=dtype).mul(2).add(1)
+            xs, ys = xs.div(w).sub(1), ys.div(h).sub(1)
+            grid = torch.stack((xs.view(1, w).expand(h, w),
+                                ys.view(h, 1).expand(h, w),
+                                torch.ones(h, w, device=device,
+                                           dtype=dtype)), -1)
+            self._grids[key] = grid.view(1, h * w, 3)
+        return self._grids[key]
+
+    def transform(self, tensor: torch.Tensor):
         n, c, h, w = tensor.shape
         device = tensor.device
         if self.reflective_pad:
@@ -277,11 +391,10 @@ class ElasticSimilarity(nn.Module):
             tensor = F.pad(tensor, [pad]*4, "replicate")
             n, c, h, w = tensor.shape
 
-        # random similarity transformations
+        # random similarity transformations on the cached identity grid
         tms = self.random_tms(n).to(device)
-        sz = torch.Size((n, c, h, w))
-        # affine grid for similarity transformations
-        grid = F.affine_grid(tms, sz)
+        grid = torch.matmul(self.base_grid(h, w, device, torch.float32),
+                            tms.transpose(1, 2)).view(n, h, w, 2)
         if hasattr(self, "elastic_factor"):
             # edit affine grid to do elastic transformations
             factor = self.elastic_factor * 0.1
@@ -297,10 +410,16 @@ class ElasticSimilarity(nn.Module):
             offset_cols = few_180s.sin().mul(factor).view(n, 1, w)
 
             # random offsets added to the affine grid
-            grid[:, :, :, 0] = grid[:, :, :, 0] + offset_cols
-            grid[:, :, :, 1] = grid[:, :, :, 1] + offset_rows
+            grid[:, :, :, 0].add_(offset_cols)
+            grid[:, :, :, 1].add_(offset_rows)
         # apply transformations
-        tensor = F.grid_sample(tensor, grid)
+        if self.half:
+            dtype = tensor.dtype
+            tensor = F.grid_sample(tensor.half(), grid.half(),
+                                   align_corners=False).to(dtype)
+        else:
+            tensor = F.grid_sample(tensor, grid.to(tensor.dtype),
+                                   align_corners=False)
         if self.reflective_pad:
             # recrop if self.reflective_pad
             tensor = tensor[:, :, pad:-pad, pad:-pad]
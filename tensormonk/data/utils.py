@@ -1,6 +1,8 @@
 """ TensorMONK :: data :: utils """
 
 import os
+import io
+import time
 import errno
 import torch
 import torch.nn.functional as F
@@ -8,10 +10,32 @@ from PIL import Image as ImPIL
 from torchvision import transforms
 import threading
 import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 DEBUG = False
 _totensor = transforms.ToTensor()
 
 
+def open_image(file_name: str, size: tuple = None, mode: str = None):
+    r"""Opens an image and resizes to size. When a JPEG is at least 2x larger
+    than size, it is decoded at a reduced resolution (1/2, 1/4 or 1/8 with
+    PIL's draft -- DCT scaling) that is >= size, and then resized.
+
+    Args:
+        file_name (str/file object): full path of image
+        size (tuple, optional): (width, height) of output, default = None
+        mode (str, optional): "L"/"RGB", default = None (no conversion)
+    """
+    image = ImPIL.open(file_name)
+    if size is not None and image.format == "JPEG":
+        image.draft(mode, tuple(size))
+    if mode is not None and image.mode != mode:
+        image = image.convert(mode)
+    if size is not None and image.size != tuple(size):
+        image = image.resize(tuple(size), ImPIL.BILINEAR)
+    return image
+
+
 def totensor(input, t_size: tuple = None):
     r"""Converts image_file or PIL image to torch tensor.
 
@@ -30,9 +54,11 @@ def totensor(input, t_size: tuple = None):
         if not os.path.isfile(input):
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
                                     input)
-        input = ImPIL.open(input).convert("RGB")
+        mode = "L" if t_size is not None and t_size[1] == 1 else "RGB"
+        size = None if t_size is None else (t_size[3], t_size[2])
+        input = open_image(input, size, mode)
 
-    if ImPIL.isImageType(input):
+    if isinstance(input, ImPIL.Image):
         if t_size is not None:
             if t_size[1] == 1:
                 input = input.convert("L")
@@ -90,7 +116,195 @@ class ThreadedDownload(threading.Thread):
             check_download(file_name)
 
 
-def urls_2_images(file_names, urls, num_threads=64, redownload=False):
+class Downloader(object):
+    r"""Concurrent downloader. Uses a keep-alive requests.Session per host
+    (connection pool of max_per_host), at most n_threads downloads at a time
+    (and at most max_per_host per host), retries connection errors, timeouts
+    and 429/5xx responses with exponential backoff, and delivers results as
+    they arrive -- only a window of 2 x n_threads results is held in memory.
+    Files are streamed to disk in chunks. Invalid images are dropped.
+
+    Example:
+        >>> downloader = Downloader(n_threads=64)
+        >>> stats = downloader.to_files(file_names, urls)
+        >>> print(stats["images_per_second"])
+
+        >>> database = LMDB("./data.lmdb", ("image", "label"), 2**34)
+        >>> database.start(write=True)
+        >>> downloader.to_lmdb(database, urls, labels)
+        >>> database.stop()
+
+    Args:
+        n_threads (int, optional): maximum concurrent downloads, default = 32
+        max_per_host (int, optional): maximum concurrent downloads (and
+            connections) per host, default = 8
+        retries (int, optional): retries per url, default = 3
+        backoff (float, optional): seconds to wait before the first retry
+            (doubles with every retry), default = 0.5
+        timeout (float/tuple, optional): requests timeout (connect, read),
+            default = (5, 30)
+        chunk_size (int, optional): bytes per chunk, default = 65536
+        verify (bool, optional): When True, drops content that is not a valid
+            image, default = True
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self,
+                 n_threads: int = 32,
+                 max_per_host: int = 8,
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 timeout=(5, 30),
+                 chunk_size: int = 65536,
+                 verify: bool = True):
+        if not isinstance(n_threads, int) or n_threads < 1:
+            raise ValueError("Downloader: n_threads must be int >= 1")
+        if not isinstance(max_per_host, int) or max_per_host < 1:
+            raise ValueError("Downloader: max_per_host must be int >= 1")
+        if not isinstance(retries, int) or retries < 0:
+            raise ValueError("Downloader: retries must be int >= 0")
+
+        self.n_threads = n_threads
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.verify = verify
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def session(self, url: str):
+        r""" Returns (requests.Session, threading.Semaphore) of url's host """
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_per_host)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._hosts[host] = (
+                    session, threading.Semaphore(self.max_per_host))
+            return self._hosts[host]
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._hosts.values():
+                session.close()
+            self._hosts = {}
+
+    def fetch(self, url: str, file_name: str = None):
+        r"""Downloads url (with retries). Returns content (bytes) or True when
+        file_name is not None (streamed to file_name). Returns None on
+        failure -- connection errors, timeouts, broken streams and
+        RETRY_STATUS are retried, any other requests.RequestException (Ex:
+        invalid url) or OSError (Ex: writing file_name) is a failure."""
+        session, limit = self.session(url)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                with limit, session.get(url, stream=True,
+                                        timeout=self.timeout) as response:
+                    if response.status_code in Downloader.RETRY_STATUS:
+                        continue
+                    if response.status_code != 200:
+                        return None
+                    chunks = response.iter_content(self.chunk_size)
+                    if file_name is None:
+                        content = b"".join(chunks)
+                    else:
+                        with open(file_name + ".part", "wb") as f:
+                            for chunk in chunks:
+                                f.write(chunk)
+                if file_name is None:
+                    return content if self.valid(io.BytesIO(content)) \
+                        else None
+                if not self.valid(file_name + ".part"):
+                    break
+                os.replace(file_name + ".part", file_name)
+                return True
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                continue
+            except (requests.RequestException, OSError):
+                # RequestException is an OSError, transients are above
+                break
+        if file_name is not None and os.path.isfile(file_name + ".part"):
+            os.remove(file_name + ".part")
+        return None
+
+    def valid(self, content):
+        if not self.verify:
+            return True
+        try:
+            with ImPIL.open(content) as image:
+                image.verify()
+        except Exception:
+            return False
+        return True
+
+    def run(self, urls: list, callback=None, file_names: list = None):
+        r"""Downloads all the urls. callback(index, url, result) is called
+        in the calling thread as the results arrive (result is bytes, True
+        when streamed to file_names[index], or None on failure).
+
+        Return:
+            stats (dict) -- n_ok, n_failed, seconds and images_per_second
+        """
+        n_ok = n_failed = 0
+        start = time.perf_counter()
+        pending = iter(enumerate(urls))
+        with ThreadPoolExecutor(self.n_threads) as pool:
+            running = {}
+            while True:
+                # bounded window of downloads
+                for idx, url in pending:
+                    name = None if file_names is None else file_names[idx]
+                    running[pool.submit(self.fetch, url, name)] = (idx, url)
+                    if len(running) >= 2 * self.n_threads:
+                        break
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx, url = running.pop(future)
+                    result = future.result()
+                    if result is None:
+                        n_failed += 1
+                    else:
+                        n_ok += 1
+                    if callback is not None:
+                        callback(idx, url, result)
+        seconds = time.perf_counter() - start
+        self.stats = {"n_ok": n_ok, "n_failed": n_failed, "seconds": seconds,
+                      "images_per_second": n_ok / max(seconds, 1e-9)}
+        return self.stats
+
+    def to_files(self, file_names: list, urls: list,
+                 redownload: bool = False):
+        r""" Streams urls to file_names (existing files are skipped unless
+        redownload is True). """
+        if len(file_names) != len(urls):
+            raise ValueError("Downloader: len(file_names) != len(urls)")
+        todo = [i for i, x in enumerate(file_names)
+                if redownload or not os.path.isfile(x)]
+        return self.run([urls[i] for i in todo],
+                        file_names=[file_names[i] for i in todo])
+
+    def to_lmdb(self, database, urls: list, *attributes):
+        r""" Writes (image bytes, *attributes[index]) to a LMDB database
+        (started with write=True) as the downloads arrive. """
+        def callback(idx: int, url: str, content: bytes):
+            if content is not None:
+                database.write(content, *[x[idx] for x in attributes])
+        return self.run(urls, callback)
+
+
+def urls_2_images(file_names, urls, num_threads=64, redownload=False,
+                  max_per_host=None):
     """
     Image downloader for datasets like:
         Im2Text: Describing Images Using 1 Million Captioned Photographs
@@ -100,18 +314,15 @@ def urls_2_images(file_names, urls, num_threads=64, redownload=False):
     Args:
         file_names (list/tuple): A list/tuple of file name with full path.
         urls (list/tuple): A list/tuple of image url's
+        max_per_host (int, optional): concurrent requests per host, default
+            = num_threads
+
+    Return:
+        stats (see Downloader.run)
     """
-    threads = [ThreadedDownload([], [], redownload)for i in range(num_threads)]
-    while urls:
-        for t in threads:
-            try:
-                t.file_names.append(file_names.pop())
-                t.urls.append(urls.pop())
-            except IndexError as e:
-                print(e)
-                break
-    threads = [t for t in threads if t.urls]
-    for t in threads:
-        t.start()
-    for t in threads:
-        t.join()
+    if max_per_host is None:
+        max_per_host = num_threads
+    downloader = Downloader(n_threads=num_threads, max_per_host=max_per_host)
+    stats = downloader.to_files(list(file_names), list(urls), redownload)
+    downloader.close()
+    return stats
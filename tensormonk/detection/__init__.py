@@ -1,6 +1,6 @@
 """ TensorMONK's :: detection """
 
-__all__ = ["CONFIG", "Sample",
+__all__ = ["CONFIG", "Sample", "BatchAugment",
            "ObjectUtils",
            "AnchorDetector", "Classifier", "Responses",
            "BiFPNLayer", "FPNLayer", "PAFPNLayer", "NoFPNLayer",
@@ -8,6 +8,7 @@ __all__ = ["CONFIG", "Sample",
 
 from .config import CONFIG
 from .sample import Sample
+from .augment import BatchAugment
 from .utils import ObjectUtils
 from .nofpn_fpn import BiFPNLayer, FPNLayer, PAFPNLayer, NoFPNLayer, Block
 from .anchor_detector import AnchorDetector, Classifier
@@ -3,6 +3,8 @@
 
 __all__ = ["Classifier", "AnchorDetector", "Responses"]
 
+import types
+import collections
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -101,6 +103,188 @@ class Classifier(nn.Module):
                         self.config.is_centerness else None))
 
 
+def pad_objects(r_label: Union[list, tuple],
+                r_boxes: Union[list, tuple],
+                r_point: Union[list, tuple] = None):
+    r"""Pads per image labels (M), boxes (Mx4) and points (Mx(2*n_points)) to
+    BxM_max tensors. Returns padded label, boxes, point and valid (BxM_max
+    mask of objects).
+    """
+    assert isinstance(r_label, (list, tuple))
+    assert isinstance(r_boxes, (list, tuple))
+    assert isinstance(r_point, (list, tuple)) or r_point is None
+    n, m = len(r_label), max([1] + [x.numel() for x in r_label])
+    label = torch.zeros(n, m, dtype=torch.long)
+    boxes = torch.zeros(n, m, 4)
+    point = None if r_point is None else \
+        torch.zeros(n, m, r_point[0].reshape(r_point[0].size(0), -1).size(1))
+    valid = torch.zeros(n, m, dtype=torch.bool)
+    for i in range(n):
+        k = r_label[i].numel()
+        label[i, :k] = r_label[i].view(-1)
+        boxes[i, :k] = r_boxes[i].view(-1, 4)
+        if r_point is not None:
+            point[i, :k] = r_point[i].reshape(k, -1)
+        valid[i, :k] = True
+    return label, boxes, point, valid
+
+
+def encode_targets(config: CONFIG,
+                   anchors: tuple,
+                   r_label: Union[list, tuple, Tensor],
+                   r_boxes: Union[list, tuple, Tensor],
+                   r_point: Union[list, tuple, Tensor],
+                   valid: Tensor = None):
+    r"""Vectorized AnchorDetector.encode for a batch of images -- one batched
+    iou (BxAxM) of all the anchors against the padded objects of all the
+    images, and targets are gathered with the best object of each anchor.
+    Does not require the network, so can be used in DataLoader workers (see
+    AnchorDetector.target_encoder).
+
+    Args:
+        config (CONFIG): config of AnchorDetector (or any object with
+            encode_iou, hard_encode, boxes_encode_* and point_encode_*)
+        anchors (tuple): (centers, pix2pix_delta, anchor_wh) of the input
+            size (AnchorDetector.size_anchors)
+        r_label (list/tuple/Tensor): list/tuple of tensor's or a padded
+            tensor (BxM)
+        r_boxes (list/tuple/Tensor): list/tuple of tensor's or a padded
+            tensor (BxMx4)
+        r_point (list/tuple/Tensor): list/tuple of tensor's or a padded
+            tensor (BxMx(2*n_points)) or None
+        valid (Tensor, optional): BxM mask of padded objects. default = None
+
+    :rtype: :class:`tensormonk.detection.Responses`
+    """
+    if isinstance(r_label, (list, tuple)):
+        r_label, r_boxes, r_point, valid = pad_objects(
+            r_label, r_boxes, r_point)
+    assert isinstance(r_label, Tensor) and r_label.ndim == 2
+    assert isinstance(r_boxes, Tensor) and r_boxes.ndim == 3
+    assert isinstance(r_point, Tensor) or r_point is None
+
+    centers, pix2pix_delta, anchor_wh = anchors
+    device = centers.device
+    n, m = r_label.shape
+    n_anchors = centers.size(0)
+    with torch.no_grad():
+        r_label, r_boxes = r_label.to(device), r_boxes.to(device).float()
+        if valid is None:
+            valid = torch.ones(n, m, dtype=torch.bool, device=device)
+        valid = valid.to(device).bool()
+        r_boxes = r_boxes.masked_fill(~ valid[..., None], 0)
+        # images without objects -- no positives, zero centerness
+        has_objects = valid.any(1)
+
+        # max iou of each anchor (all images) -- BxAxM ious in chunks of
+        # anchors
+        best_iou, boxes2centers_mapping, _, _ = ObjectUtils.reduce_iou_batch(
+            torch.cat((centers - anchor_wh / 2, centers + anchor_wh / 2), 1),
+            r_boxes, valid=valid)
+        # objectness -- max intersection over foreground (padded objects
+        # have zero intersection)
+        objectness = ObjectUtils.reduce_iou_batch(torch.cat(
+            (centers - pix2pix_delta / 2, centers + pix2pix_delta / 2), 1),
+            r_boxes, method="iof")[0]
+
+        # boxes2centers_mapping of the flattened objects (B*M)
+        mapping = (boxes2centers_mapping +
+                   torch.arange(n, device=device)[:, None] * m).view(-1)
+        b_centers = centers.repeat(n, 1)
+        b_pix2pix_delta = pix2pix_delta.repeat(n, 1)
+        b_anchor_wh = anchor_wh.repeat(n, 1)
+        f_boxes = r_boxes.view(-1, 4)
+
+        # compute centerness
+        centerness = ObjectUtils.compute_centerness(
+            b_centers, f_boxes, mapping).view(n, n_anchors)
+        centerness[~ has_objects] = 0
+
+        # Filter 1: targets based on encode_iou
+        t_label = r_label.gather(1, boxes2centers_mapping)
+        t_label[best_iou < config.encode_iou] = 0
+
+        # Filter 2: check if center lies within -1 to 1 pixel (same as
+        # encode, applied on images where all the centers are invalid)
+        positive = t_label.gt(0)
+        if positive.any():
+            b_idx, a_idx = positive.nonzero(as_tuple=True)
+            idx = boxes2centers_mapping[b_idx, a_idx]
+            o_centers = r_boxes[b_idx, idx].view(-1, 2, 2).mean(1)
+            delta = (centers[a_idx] - o_centers).abs()
+            limits = pix2pix_delta if config.hard_encode else anchor_wh
+            valid_centers = (delta < limits[a_idx]).all(1)
+            n_valid = torch.zeros(n, dtype=torch.long, device=device)
+            n_valid.index_add_(0, b_idx, valid_centers.long())
+            invalid = n_valid[b_idx].eq(0)
+            t_label[b_idx[invalid], idx[invalid]] = 0
+
+        # encode boxes
+        positive = t_label.view(-1).gt(0)
+        t_boxes = torch.zeros(n * n_anchors, 4, device=device)
+        if positive.any():
+            t_boxes[positive] = ObjectUtils.encode_boxes(
+                config.boxes_encode_format,
+                b_centers[positive], b_pix2pix_delta[positive],
+                b_anchor_wh[positive], f_boxes, mapping[positive],
+                config.boxes_encode_var1, config.boxes_encode_var2)
+
+        # encode points
+        t_point = None
+        if r_point is not None:
+            t_point = ObjectUtils.encode_point(
+                config.point_encode_format, b_centers, b_pix2pix_delta,
+                b_anchor_wh, r_point.to(device).view(n * m, -1), mapping,
+                config.point_encode_var)
+            t_point[~ positive] = 0.
+            t_point = t_point.view(n, n_anchors, -1, 2)
+
+    return Responses(label=t_label,
+                     score=None,
+                     boxes=t_boxes.view(n, n_anchors, 4),
+                     point=t_point,
+                     objectness=objectness,
+                     centerness=centerness)
+
+
+class TargetEncoder(object):
+    r"""Picklable encode_targets with the anchors (on cpu) of input sizes,
+    to encode targets in DataLoader workers (see
+    AnchorDetector.target_encoder). Anchors are picked with the size of
+    images in the batch.
+
+    Args:
+        config: encoding settings of AnchorDetector (see encode_targets)
+        anchors (dict): {(height, width): (centers, pix2pix_delta,
+            anchor_wh)}
+    """
+    def __init__(self, config, anchors: dict):
+        self.config = config
+        self.anchors = anchors
+
+    def __call__(self,
+                 r_label: Union[list, tuple, Tensor],
+                 r_boxes: Union[list, tuple, Tensor],
+                 r_point: Union[list, tuple, Tensor],
+                 valid: Tensor = None,
+                 size: tuple = None):
+        r"""See encode_targets -- size is (height, width) or shape of the
+        images (BCHW), and is optional when the encoder has a single size.
+        """
+        if size is None:
+            if len(self.anchors) != 1:
+                raise ValueError("TargetEncoder: size is required when the "
+                                 "encoder has multiple sizes")
+            size = next(iter(self.anchors))
+        size = tuple(int(x) for x in size[-2:])
+        if size not in self.anchors:
+            raise ValueError("TargetEncoder: no anchors for size {}, use "
+                             "AnchorDetector.target_encoder(sizes)".format(
+                                 size))
+        return encode_targets(self.config, self.anchors[size], r_label,
+                              r_boxes, r_point, valid)
+
+
 class AnchorDetector(nn.Module):
     r""" A common detection module on top of base network with NoFPN,
     BiFPN, FPN, and PAFPN.
@@ -174,13 +358,15 @@ class AnchorDetector(nn.Module):
         # ------------------------------------------------------------------- #
         # Body
         # ------------------------------------------------------------------- #
-        if "_nofpn" in config.body_network:
+        # CONFIG.body_network drops the "anchor_" prefix
+        body_network = config.body_network.split("_")[-1]
+        if body_network == "nofpn":
             Body = NoFPNLayer
-        elif "_bifpn" in config.body_network:
+        elif body_network == "bifpn":
             Body = BiFPNLayer
-        elif "_fpn" in config.body_network:
+        elif body_network == "fpn":
             Body = FPNLayer
-        elif "_pafpn" in config.body_network:
+        elif body_network == "pafpn":
             Body = PAFPNLayer
         else:
             raise NotImplementedError
@@ -201,12 +387,14 @@ class AnchorDetector(nn.Module):
 
         self.compute_anchors()
         self.register_buffer("_counter", torch.tensor(0))
+        # maximum input sizes in the anchor cache (see size_anchors)
+        self.anchor_cache_size = 16
 
     def forward(self, tensor: Tensor):
         responses = self.base(tensor)
 
-        if self.config.t_size[2:] != tensor.shape[2:]:
-            # update for input size changes during prediction
+        if tuple(self.t_size[2:]) != tuple(tensor.shape[2:]):
+            # update for input size changes (prediction/bucketed batches)
             self.t_size = tensor.shape
             self.c_sizes = [x.shape for x in responses]
 
@@ -245,12 +433,13 @@ class AnchorDetector(nn.Module):
                      r_boxes: tuple,
                      r_point: tuple):
 
+        # forward first -- targets are encoded for the size of tensor
+        responses, body_network_responses = self(tensor)
         with torch.no_grad():
             # encoding raw label/boxes/point to targets for network
             targets = self.batch_encode(r_label, r_boxes, r_point)
             valid = targets.label.view(-1).gt(0)
 
-        responses, body_network_responses = self(tensor)
         losses = {"label": None, "boxes": None, "point": None,
                   "objectness": None, "centerness": None}
         losses["label"] = self.label_loss(predictions=responses.label,
@@ -264,7 +453,7 @@ class AnchorDetector(nn.Module):
             losses["point"] = self.point_loss(p_point=responses.point,
                                               t_point=targets.point,
                                               t_label=targets.label,
-                                              anchor_wh=self.anchor_wh)
+                                              anchor_wh=self.size_anchors()[2])
         if self.config.is_objectness:
             losses["objectness"] = F.binary_cross_entropy(
                 responses.objectness.view(-1), targets.objectness.view(-1))
@@ -277,45 +466,63 @@ class AnchorDetector(nn.Module):
         return losses
 
     def batch_encode(self,
-                     r_label: Union[list, tuple],
-                     r_boxes: Union[list, tuple],
-                     r_point: Union[list, tuple]):
-        r"""Encode's raw labels, boxes and points of a batch of images.
+                     r_label: Union[list, tuple, Tensor],
+                     r_boxes: Union[list, tuple, Tensor],
+                     r_point: Union[list, tuple, Tensor],
+                     valid: Tensor = None):
+        r"""Encode's raw labels, boxes and points of a batch of images. All the
+        images are matched against the anchors at once (see encode_targets).
 
         Args:
-            r_label (list/tuple): list/tuple of tensor's to encode.
-                See encode for more information
-            r_boxes (list/tuple): list/tuple of tensor's to encode.
-                See encode for more information
-            r_point (list/tuple): list/tuple of tensor's to encode.
-                See encode for more information
+            r_label (list/tuple/Tensor): list/tuple of tensor's or a padded
+                tensor (BxM) to encode. See encode for more information
+            r_boxes (list/tuple/Tensor): list/tuple of tensor's or a padded
+                tensor (BxMx4) to encode. See encode for more information
+            r_point (list/tuple/Tensor): list/tuple of tensor's or a padded
+                tensor (BxMx(2*n_points)) to encode. See encode for more
+                information
+            valid (Tensor, optional): BxM mask of padded objects, required
+                when padded tensors have invalid objects. default = None
 
         :rtype: :class:`tensormonk.detection.Responses`
         """
+        return encode_targets(self.config, self.size_anchors(), r_label,
+                              r_boxes, r_point, valid)
 
-        # batch encode
-        assert isinstance(r_label, (list, tuple))
-        assert isinstance(r_boxes, (list, tuple))
-        assert isinstance(r_point, (list, tuple)) or r_point is None
-
-        t_label, t_boxes, t_point = [], [], []
-        t_objectness, t_centerness = [], []
-        for i in range(len(r_label)):
-            targets = self.encode(r_label[i].clone(), r_boxes[i].clone(),
-                                  None if r_point is None else
-                                  r_point[i].clone())
-            t_label.append(targets.label)
-            t_boxes.append(targets.boxes)
-            t_point.append(targets.point)
-            t_objectness.append(targets.objectness)
-            t_centerness.append(targets.centerness)
-        return Responses(
-            label=torch.stack(t_label),
-            score=None,
-            boxes=torch.stack(t_boxes),
-            point=None if r_point is None else torch.stack(t_point),
-            objectness=torch.stack(t_objectness),
-            centerness=torch.stack(t_centerness))
+    def target_encoder(self, sizes: Union[list, tuple] = None):
+        r"""Returns a picklable batch_encode (TargetEncoder) with the anchors
+        (on cpu) of input sizes, to encode targets in DataLoader workers.
+        Anchors are picked with the size of images in the batch.
+
+            >>> encoder = detector.target_encoder(sampler.bucket_sizes)
+            >>> targets = encoder(r_label, r_boxes, r_point,
+                                  size=images.shape)
+
+        Args:
+            sizes (list/tuple, optional): list of (height, width), Ex:
+                AspectRatioBatchSampler.bucket_sizes. default = None (the
+                current input size)
+        """
+        # CONFIG is not picklable, only the encoding settings are required
+        config = types.SimpleNamespace(**{
+            x: getattr(self.config, x) for x in (
+                "encode_iou", "hard_encode", "boxes_encode_format",
+                "boxes_encode_var1", "boxes_encode_var2",
+                "point_encode_format", "point_encode_var")})
+        if sizes is None:
+            sizes = [self.t_size[2:]]
+        anchors = {}
+        for h, w in sizes:
+            size = (int(h), int(w))
+            if size == tuple(self.config.t_size[2:]):
+                x = (self.centers, self.pix2pix_delta, self.anchor_wh)
+            else:
+                # one at a time -- more sizes than anchor_cache_size
+                self.precompute_anchors([size])
+                x = self._anchor_cache[size + (self.centers.device,
+                                               self.centers.dtype)]
+            anchors[size] = tuple(y.cpu() for y in x)
+        return TargetEncoder(config, anchors)
 
     def encode(self,
                r_label: Tensor,
@@ -336,22 +543,23 @@ class AnchorDetector(nn.Module):
 
         assert isinstance(r_label, Tensor) and isinstance(r_boxes, Tensor)
         assert isinstance(r_point, Tensor) or r_point is None
-        device = self.centers.device
+        centers, pix2pix_delta, anchor_wh = self.size_anchors()
+        device = centers.device
         r_label, r_boxes = r_label.to(device), r_boxes.to(device)
 
         # compute ious
         ious = ObjectUtils.compute_iou(
-            torch.cat((self.centers - self.anchor_wh / 2,
-                       self.centers + self.anchor_wh / 2), 1), r_boxes)
+            torch.cat((centers - anchor_wh / 2,
+                       centers + anchor_wh / 2), 1), r_boxes)
         boxes2centers_mapping = ious.max(1)[1].view(-1)
 
         # compute objectness -- intersection over foreground
         objectness = ObjectUtils.compute_objectness(
-            self.centers, self.pix2pix_delta, r_boxes)
+            centers, pix2pix_delta, r_boxes)
 
         # compute centerness
         centerness = ObjectUtils.compute_centerness(
-            self.centers, r_boxes, boxes2centers_mapping)
+            centers, r_boxes, boxes2centers_mapping)
 
         # Filter 1: targets based on encode_iou
         t_label = r_label[boxes2centers_mapping]
@@ -363,26 +571,26 @@ class AnchorDetector(nn.Module):
         valid = t_label.nonzero().view(-1)
         if valid.numel() != 0:
             idx = ious[valid].max(1)[1].view(-1)
-            x_delta = self.centers[valid, 0] - r_boxes[idx, 0::2].mean(1)
-            y_delta = self.centers[valid, 1] - r_boxes[idx, 1::2].mean(1)
+            x_delta = centers[valid, 0] - r_boxes[idx, 0::2].mean(1)
+            y_delta = centers[valid, 1] - r_boxes[idx, 1::2].mean(1)
             if self.config.hard_encode:
                 valid_centers = (
-                    (x_delta.abs() < self.pix2pix_delta[valid, 0]) *
-                    (y_delta.abs() < self.pix2pix_delta[valid, 1]))
+                    (x_delta.abs() < pix2pix_delta[valid, 0]) *
+                    (y_delta.abs() < pix2pix_delta[valid, 1]))
             else:
                 valid_centers = (
-                    (x_delta.abs() < self.anchor_wh[valid, 0]) *
-                    (y_delta.abs() < self.anchor_wh[valid, 1]))
+                    (x_delta.abs() < anchor_wh[valid, 0]) *
+                    (y_delta.abs() < anchor_wh[valid, 1]))
             if (~ valid_centers).all():
                 t_label[idx[~ valid_centers]] = 0
 
         # encode boxes
         valid = t_label.nonzero().view(-1)
-        t_boxes = torch.zeros(self.centers.size(0), 4).to(device)
+        t_boxes = torch.zeros(centers.size(0), 4).to(device)
         if valid.numel() != 0:
             t_boxes[valid] = ObjectUtils.encode_boxes(
                 self.config.boxes_encode_format,
-                self.centers, self.pix2pix_delta, self.anchor_wh,
+                centers, pix2pix_delta, anchor_wh,
                 r_boxes, boxes2centers_mapping,
                 self.config.boxes_encode_var1,
                 self.config.boxes_encode_var2)[valid]
@@ -391,8 +599,8 @@ class AnchorDetector(nn.Module):
         t_point = None
         if r_point is not None:
             t_point = ObjectUtils.encode_point(
-                self.config.point_encode_format, self.centers,
-                self.pix2pix_delta, self.anchor_wh,
+                self.config.point_encode_format, centers,
+                pix2pix_delta, anchor_wh,
                 r_point, boxes2centers_mapping,
                 self.config.point_encode_var)
             t_point[t_label.eq(0)] = 0.
@@ -404,30 +612,136 @@ class AnchorDetector(nn.Module):
                          objectness=objectness,
                          centerness=centerness)
 
-    def batch_detect(self, p_label: Tensor, p_boxes: Tensor, p_point: Tensor):
-        r"""A list of Responses from detect.
+    def batch_detect(self,
+                     p_label: Tensor,
+                     p_boxes: Tensor,
+                     p_point: Tensor,
+                     top_k: int = None,
+                     per_class: bool = False,
+                     padded: bool = False):
+        r"""Detects labels, boxes and points of a batch of images -- same as
+        detect on each image, with a single decode and nms for the batch.
+        Locations are pre-filtered (see select_candidates), only the
+        retained are decoded, and boxes are offset per image (and per label
+        when per_class=True) so that one nms call suppresses within each
+        image.
 
         Args:
             p_label (Tensor): label predictions at each pixel for all levels
             p_boxes (Tensor): boxes predictions at each pixel for all levels
             p_point (Tensor): boxes predictions at each pixel for all levels
+            top_k (int, optional): maximum locations per image before nms,
+                default = None (all the locations)
+            per_class (bool, optional): When True, nms is per label, else
+                across labels (same as detect). default = False
+            padded (bool, optional): When True, returns Responses of padded
+                tensors (BxK, where K is top_k or the maximum detections of
+                an image, label = 0 for padding) and the number of
+                detections per image. default = False
 
             p_label.size(0) == p_boxes.size(0) == p_point.size(0) ==
                 self.centers.size(0)
 
         :rtype: [:class:`tensormonk.detection.Responses`,
-            :class:`tensormonk.detection.Responses`, ...]
+            :class:`tensormonk.detection.Responses`, ...] or
+            (:class:`tensormonk.detection.Responses`, Tensor) when padded
         """
         # batch detect
         assert isinstance(p_label, Tensor) and isinstance(p_boxes, Tensor)
         assert isinstance(p_point, Tensor) or p_point is None
         assert p_label.size(1) == p_boxes.size(1)
+        centers, pix2pix_delta, anchor_wh = self.size_anchors()
+        assert p_label.size(1) == centers.size(0)
+        n, device = p_label.size(0), p_label.device
+
+        if p_label.ndim == 3 and p_label.size(2) == 1:
+            p_label = p_label.view(n, -1)
+        logits = None
+        if p_label.ndim == 3:
+            # pick best non-background per location
+            score, label = p_label[:, :, 1:].max(2)
+            label += 1
+        else:
+            score = p_label
+            # images with logits are activated after pre-filtering
+            logits = (score.max(1)[0] > 1) | (score.min(1)[0] < 0)
+            label = torch.ones_like(score, dtype=torch.long)
+
+        # pre-filter -- score thresholding, candidates per level and top_k
+        # per image
+        keep = self.select_candidates(score, logits, top_k)
+        b_idx, a_idx = keep.nonzero(as_tuple=True)
+        score, label = score[b_idx, a_idx], label[b_idx, a_idx]
+        if logits is not None:
+            score = torch.where(logits[b_idx], score.sigmoid(), score)
+
+        # decode boxes
+        boxes = ObjectUtils.decode_boxes(
+            self.config.boxes_encode_format,
+            centers[a_idx], pix2pix_delta[a_idx], anchor_wh[a_idx],
+            p_boxes[b_idx, a_idx],
+            self.config.boxes_encode_var1,
+            self.config.boxes_encode_var2)
+        # nms -- boxes of a group (image or image & label) are offset by
+        # group * span, so groups never overlap (float64 to retain precision)
+        retain = torch.zeros(0, dtype=torch.long, device=device)
+        if boxes.numel():
+            group = b_idx * (label.max() + 1) + label if per_class else b_idx
+            if boxes.size(0) <= (4000 if device.type == "cpu" else 20000):
+                span = (boxes.max() - boxes.min()).double() + 1
+                retain = torchvision.ops.nms(
+                    boxes.double() + (group * span)[:, None],
+                    score.double(), self.config.detect_iou)
+            else:
+                # nms is quadratic in boxes, a call per group is faster
+                retain = []
+                for g in group.unique():
+                    idx = (group == g).nonzero().view(-1)
+                    retain.append(idx[torchvision.ops.nms(
+                        boxes[idx], score[idx], self.config.detect_iou)])
+                retain = torch.cat(retain)
+                retain = retain[score[retain].sort(
+                    descending=True, stable=True)[1]]
+        # sorted by score -- a stable sort retains the order per image
+        retain = retain[b_idx[retain].sort(stable=True)[1]]
+        counts = torch.bincount(b_idx[retain], minlength=n)
+
+        point = None
+        if p_point is not None:
+            a = a_idx[retain]
+            point = ObjectUtils.decode_point(
+                self.config.point_encode_format,
+                centers[a], pix2pix_delta[a], anchor_wh[a],
+                p_point[b_idx[retain], a], self.config.point_encode_var)
+
+        label, score, boxes = label[retain], score[retain], boxes[retain]
+        if padded:
+            k = top_k if top_k is not None else max(1, int(counts.max()))
+            starts = counts.cumsum(0) - counts
+            b = b_idx[retain]
+            i = torch.arange(b.numel(), device=device) - starts[b]
+            p_label = torch.zeros(n, k, dtype=label.dtype, device=device)
+            p_label[b, i] = label
+            p_score = score.new_zeros(n, k)
+            p_score[b, i] = score
+            p_boxes = boxes.new_zeros(n, k, 4)
+            p_boxes[b, i] = boxes
+            if point is not None:
+                p_point = point.new_zeros((n, k) + point.shape[1:])
+                p_point[b, i] = point
+            return Responses(label=p_label, score=p_score, boxes=p_boxes,
+                             point=p_point if point is not None else None,
+                             objectness=None, centerness=None), counts
 
         detections = []
-        for i in range(p_label.size(0)):
-            detections.append(self.detect(
-                p_label[i], p_boxes[i],
-                None if p_point is None else p_point[i]))
+        counts = counts.tolist()
+        for x in zip(*[x.split(counts) if x is not None else
+                       [None] * n for x in (label, score, boxes, point)]):
+            if x[0].numel() == 0:
+                x = (None, None, None, None)
+            detections.append(Responses(
+                label=x[0], score=x[1], boxes=x[2], point=x[3],
+                objectness=None, centerness=None))
         return detections
 
     def detect(self, p_label: Tensor, p_boxes: Tensor, p_point: Tensor):
@@ -443,11 +757,7 @@ class AnchorDetector(nn.Module):
 
         :rtype: :class:`tensormonk.detection.Responses`
         """
-        if self.t_size[1:] != self.config.t_size[1:]:
-            centers, pix2pix_delta, anchor_wh = self.compute_anchors()
-        else:
-            centers, pix2pix_delta, anchor_wh = self.centers, \
-                self.pix2pix_delta, self.anchor_wh
+        centers, pix2pix_delta, anchor_wh = self.size_anchors()
 
         assert isinstance(p_label, Tensor) and isinstance(p_boxes, Tensor)
         assert p_label.ndim == 1 or p_label.ndim == 2
@@ -458,63 +768,197 @@ class AnchorDetector(nn.Module):
         if p_label.ndim == 2 and p_label.size(1) == 1:
             p_label = p_label.view(-1)
 
+        logits = None
         if p_label.ndim == 2:
-            # pick top_n objects
-            sorted_scores, sorted_idx = torch.sort(p_label, dim=1)
-            sorted_scores = sorted_scores[:, -2:]
-            sorted_idx = sorted_idx[:, -2:]
             # pick best non-background per location
-            label = sorted_idx[:, 1]
-            label[label == 0] = sorted_idx[:, 0][label == 0]
-            score = p_label.gather(1, label.view(-1, 1)).view(-1)
+            score, label = p_label[:, 1:].max(1)
+            label += 1
         else:
             score = p_label
-            if not (score.max() <= 1 and score.min() >= 0):
-                score = torch.sigmoid(score)
+            logits = not (score.max() <= 1 and score.min() >= 0)
             label = p_label.mul(0).add(1).long()
 
+        # score thresholding (when no objects pass score threshold, pick best
+        # available) and candidates per level -- nms retains the same boxes
+        # above score threshold, as a box is only suppressed by a box with a
+        # higher score
+        retain = self.select_candidates(
+            score.view(1, -1), None if logits is None else
+            torch.tensor([logits], device=score.device)).view(-1)
+        retain = retain.nonzero().view(-1)
+        score, label = score[retain], label[retain]
+        if logits:
+            score = torch.sigmoid(score)
+
         # decode boxes
         boxes = ObjectUtils.decode_boxes(
             self.config.boxes_encode_format,
-            centers, pix2pix_delta, anchor_wh, p_boxes,
+            centers[retain], pix2pix_delta[retain], anchor_wh[retain],
+            p_boxes[retain],
             self.config.boxes_encode_var1,
             self.config.boxes_encode_var2)
         # nms
-        retain = torchvision.ops.nms(boxes, score, self.config.detect_iou)
-
-        # score thresholding
-        if self.config.score_threshold > 0 and retain.numel() > 0:
-            valid_score = (score[retain] > self.config.score_threshold)
-            valid_score = valid_score.view(-1)
-            if valid_score.sum() == 0:
-                # when no objects pass score threshold, pick best available
-                valid_score = score[retain] == score[retain].max()
-            retain = retain[valid_score]
+        keep = torchvision.ops.nms(boxes, score, self.config.detect_iou)
+        if keep.numel() == 0:
+            return Responses(label=None, score=None, boxes=None, point=None,
+                             objectness=None, centerness=None)
 
+        point = None
         if p_point is not None:
+            a = retain[keep]
             point = ObjectUtils.decode_point(
                 self.config.point_encode_format,
-                centers, pix2pix_delta, anchor_wh, p_point,
+                centers[a], pix2pix_delta[a], anchor_wh[a], p_point[a],
                 self.config.point_encode_var)
 
-        if retain.numel() == 0:
-            return Responses(label=None, score=None, boxes=None, point=None,
-                             objectness=None, centerness=None)
-
-        return Responses(label=label[retain],
-                         score=score[retain],
-                         boxes=boxes[retain],
-                         point=point[retain] if p_point is not None else None,
+        return Responses(label=label[keep],
+                         score=score[keep],
+                         boxes=boxes[keep],
+                         point=point,
                          objectness=None,
                          centerness=None)
 
-    def compute_anchors(self):
-        assert len(self.c_sizes) == len(self.config.anchors_per_layer)
+    def select_candidates(self,
+                          score: Tensor,
+                          logits: Tensor = None,
+                          top_k: int = None):
+        r"""Locations that are decoded during detection -- scores above
+        config.score_threshold (the best location of an image is retained
+        when none pass), the top config.detect_candidates_per_level per
+        level, and top_k per image.
+
+        Args:
+            score (Tensor): BxN scores (best non-background) of all levels
+            logits (Tensor, optional): B booleans, True when the scores of an
+                image are logits (thresholded with the logit of
+                score_threshold, so only the candidates are activated).
+                default = None
+            top_k (int, optional): maximum locations per image, default =
+                None
+
+        :rtype: BxN bool Tensor
+        """
+        keep = torch.ones_like(score, dtype=torch.bool)
+        threshold = self.config.score_threshold
+        if threshold > 0:
+            if logits is not None:
+                threshold = torch.where(
+                    logits, torch.tensor(threshold).logit().item(),
+                    threshold).to(score.dtype)[:, None]
+            keep = score > threshold
+            # when no objects pass score threshold, pick best available
+            best = score == score.max(1, keepdim=True)[0]
+            keep = torch.where(keep.any(1, keepdim=True), keep, best)
+
+        limits = self.config.detect_candidates_per_level
+        if limits is not None:
+            sizes = [c_size[2] * c_size[3] * len(anchors) for c_size, anchors
+                     in zip(self.c_sizes, self.config.anchors_per_layer)]
+            if not isinstance(limits, (list, tuple)):
+                limits = [limits] * len(sizes)
+            if len(limits) != len(sizes):
+                raise ValueError("AnchorDetector: detect_candidates_per_level "
+                                 "must have a limit per level")
+            assert sum(sizes) == score.size(1)
+            masked = score.masked_fill(~ keep, -float("inf"))
+            start = 0
+            for size, limit in zip(sizes, limits):
+                if limit is not None and limit < size:
+                    top_idx = masked[:, start:start + size].topk(limit, 1)[1]
+                    level = keep[:, start:start + size]
+                    level.copy_(torch.zeros_like(level).scatter_(
+                        1, top_idx, level.gather(1, top_idx)))
+                start += size
+
+        if top_k is not None and top_k < score.size(1):
+            top_idx = score.masked_fill(~ keep, -float("inf")).topk(
+                top_k, 1)[1]
+            keep = torch.zeros_like(keep).scatter_(
+                1, top_idx, keep.gather(1, top_idx))
+        return keep
+
+    def size_anchors(self):
+        r"""Returns (centers, pix2pix_delta, anchor_wh) for the current input
+        size (self.t_size). Anchors of sizes other than config.t_size (Ex:
+        aspect ratio buckets) are in an LRU cache of anchor_cache_size
+        entries keyed by (height, width, device, dtype), so a size switch
+        neither recomputes nor transfers the anchors. See anchor_stats and
+        precompute_anchors.
+        """
+        centers = self.centers
+        key = tuple(self.t_size[2:]) + (centers.device, centers.dtype)
+        if not hasattr(self, "_anchor_cache"):
+            self._anchor_cache = collections.OrderedDict()
+            self._anchor_stats = {"hits": 0, "misses": 0, "evictions": 0}
+        if tuple(self.t_size[2:]) == tuple(self.config.t_size[2:]):
+            self._anchor_stats["hits"] += 1
+            return self.centers, self.pix2pix_delta, self.anchor_wh
+        if key in self._anchor_cache:
+            self._anchor_stats["hits"] += 1
+            self._anchor_cache.move_to_end(key)
+            return self._anchor_cache[key]
+        self._anchor_stats["misses"] += 1
+        return self._cache_anchors(key, self.compute_anchors())
+
+    def _cache_anchors(self, key: tuple, anchors: tuple):
+        self._anchor_cache[key] = anchors
+        while len(self._anchor_cache) > max(1, self.anchor_cache_size):
+            self._anchor_cache.popitem(last=False)
+            self._anchor_stats["evictions"] += 1
+        return anchors
+
+    def precompute_anchors(self, sizes: Union[list, tuple]):
+        r"""Computes and caches the anchors of a list of input sizes (height,
+        width) on the device and dtype of the detector -- call after moving
+        the detector (Ex: detector.cuda()) and before training with aspect
+        ratio buckets (AspectRatioBatchSampler.bucket_sizes).
+
+        Args:
+            sizes (list/tuple): list of (height, width)
+        """
+        if not hasattr(self, "_anchor_cache"):
+            self.size_anchors()
+        centers = self.centers
+        was_training = self.training
+        self.eval()
+        with torch.no_grad():
+            for h, w in sizes:
+                key = (int(h), int(w), centers.device, centers.dtype)
+                if key in self._anchor_cache or \
+                   (h, w) == tuple(self.config.t_size[2:]):
+                    continue
+                t_size = (1, self.config.t_size[1], int(h), int(w))
+                c_sizes = [x.shape for x in self.base(
+                    torch.zeros(*t_size, device=centers.device,
+                                dtype=centers.dtype))]
+                self._cache_anchors(key, self.compute_anchors(t_size,
+                                                              c_sizes))
+        self.train(was_training)
+
+    def anchor_stats(self):
+        r""" Returns hits, misses, evictions, n_cached and hit_rate of the
+        anchor cache """
+        if not hasattr(self, "_anchor_cache"):
+            self.size_anchors()
+        stats = dict(self._anchor_stats)
+        stats["n_cached"] = len(self._anchor_cache)
+        stats["hit_rate"] = stats["hits"] / max(
+            1, stats["hits"] + stats["misses"])
+        return stats
+
+    def compute_anchors(self, t_size: tuple = None, c_sizes: list = None):
+        r"""Computes (centers, pix2pix_delta, anchor_wh) for an input size
+        (t_size) and the sizes of base network outputs (c_sizes), default =
+        self.t_size and self.c_sizes. Registers the buffers on the first
+        call.
+        """
+        t_size = self.t_size if t_size is None else t_size
+        c_sizes = self.c_sizes if c_sizes is None else c_sizes
+        assert len(c_sizes) == len(self.config.anchors_per_layer)
         centers, pix2pix_delta, anchor_wh = [], [], []
 
-        for c_size, anchors in zip(self.c_sizes,
-                                   self.config.anchors_per_layer):
-            cs = ObjectUtils.centers_per_layer(self.t_size, c_size,
+        for c_size, anchors in zip(c_sizes, self.config.anchors_per_layer):
+            cs = ObjectUtils.centers_per_layer(t_size, c_size,
                                                self.config.is_pad)
             for an_anchor in anchors:
                 zeros = torch.zeros(cs.size(0))
@@ -529,10 +973,10 @@ class AnchorDetector(nn.Module):
 
         if hasattr(self, "centers"):
             # For on the fly computation when input size changes
-            device = self.centers.device
-            return (torch.cat(centers).to(device),
-                    torch.cat(pix2pix_delta).to(device),
-                    torch.cat(anchor_wh).to(device))
+            device, dtype = self.centers.device, self.centers.dtype
+            return (torch.cat(centers).to(device, dtype),
+                    torch.cat(pix2pix_delta).to(device, dtype),
+                    torch.cat(anchor_wh).to(device, dtype))
         self.register_buffer("centers", torch.cat(centers))
         self.register_buffer("pix2pix_delta", torch.cat(pix2pix_delta))
         self.register_buffer("anchor_wh", torch.cat(anchor_wh))
@@ -0,0 +1,288 @@
+""" TensorMONK's :: detection :: BatchAugment """
+
+__all__ = ["BatchAugment"]
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BatchAugment(nn.Module):
+    r"""Batched augmentation for object detection (a tensor alternative to
+    Sample.augmented). Accepts a uint8 batch of images with padded boxes,
+    and does random crop, resize, horizontal flip and photometric jitter
+    (brightness, contrast, saturation and grayscale) with batched tensor
+    ops. Boxes are adjusted accordingly.
+
+    Crop candidates (n_attempts per image) follow Sample._crop -- a crop is
+    valid when at least one box is >= 90% within the crop and has
+    min(w, h) > min_object_side after resize. All candidates of all images
+    are validated with a single vectorized intersection, and the first valid
+    candidate is picked. When none is valid, a crop is built around a random
+    box. On cpu, crop (integer pixels), resize and flip are done per image on
+    the input dtype (uint8), so only the output is converted to float. On
+    other devices, crop, resize and flip are a single grid_sample per batch.
+
+    Args:
+        osize (tuple): (width, height) of output images
+        crop (bool, optional): Does random cropping, default = True
+        min_side (float, optional): Minimum percentage of min(w, h) retained
+            by a crop, default = 0.3
+        min_object_side (int, optional): see Sample.CROP_MIN_OBJECT_SIDE,
+            default = 16
+        n_attempts (int, optional): crop candidates per image, default = 16
+        retain_area (float, optional): A box is valid only if its visible
+            area >= original area * retain_area, default = 0.5
+        flip (float, optional): probability of horizontal flip,
+            default = 0.5
+        jitter (float, optional): maximum brightness, contrast and saturation
+            change, default = 0.4
+        p_jitter (float, optional): probability of jitter, default = 0.8
+        p_gray (float, optional): probability of grayscale, default = 0.1
+
+    Return:
+        images (float NCHW in the range of 0-1 of size osize), boxes (pixel
+        ltrb of shape N x n_boxes x 4 on output images) and valid (bool
+        N x n_boxes)
+
+    ** points are not supported, use Sample.augmented.
+    """
+    def __init__(self,
+                 osize: tuple,
+                 crop: bool = True,
+                 min_side: float = 0.3,
+                 min_object_side: int = 16,
+                 n_attempts: int = 16,
+                 retain_area: float = 0.5,
+                 flip: float = 0.5,
+                 jitter: float = 0.4,
+                 p_jitter: float = 0.8,
+                 p_gray: float = 0.1):
+        super(BatchAugment, self).__init__()
+
+        if not (isinstance(osize, (list, tuple)) and len(osize) == 2):
+            raise TypeError("BatchAugment: osize must be (width, height)")
+        if not 0 < min_side <= 1:
+            raise ValueError("BatchAugment: min_side must be in (0, 1]")
+        if not isinstance(n_attempts, int) or n_attempts < 1:
+            raise ValueError("BatchAugment: n_attempts must be int >= 1")
+
+        self.osize = tuple(osize)
+        self.crop = crop
+        self.min_side = min_side
+        self.min_object_side = min_object_side
+        self.n_attempts = n_attempts
+        self.retain_area = retain_area
+        self.flip = flip
+        self.jitter = jitter
+        self.p_jitter = p_jitter
+        self.p_gray = p_gray
+
+    def forward(self, images: torch.Tensor, boxes: torch.Tensor,
+                valid: torch.Tensor = None, sizes: torch.Tensor = None):
+        r"""
+        Args:
+            images (torch.Tensor): uint8/float NCHW (uint8 in 0-255 and float
+                in 0-1)
+            boxes (torch.Tensor): pixel ltrb boxes of shape N x n_boxes x 4
+                (padded)
+            valid (torch.Tensor, optional): bool N x n_boxes, False for
+                padded boxes. default = all boxes are valid
+            sizes (torch.Tensor, optional): (width, height) of each image when
+                images are padded to a common size. default = (W, H)
+        """
+        n, c, h, w = images.shape
+        device = images.device
+        boxes = boxes.to(device).float()
+        if valid is None:
+            valid = torch.ones(boxes.shape[:2], dtype=torch.bool,
+                               device=device)
+        valid = valid.to(device)
+        if sizes is None:
+            sizes = torch.tensor([[w, h]], device=device).expand(n, 2)
+        sizes = sizes.to(device).float()
+
+        if self.crop:
+            crops = self.random_crops(boxes, valid, sizes)
+        else:
+            crops = torch.cat((torch.zeros_like(sizes), sizes), 1)
+        flip = torch.rand(n, device=device) < self.flip
+
+        ow, oh = self.osize
+        if device.type == "cpu":
+            # uint8 to float of the full batch costs more than the resampling
+            # on cpu -- crops are rounded (boxes use the rounded crops)
+            crops = crops.round()
+            crops[:, 2:] = torch.max(crops[:, 2:], crops[:, :2] + 1)
+            tensor = self.crop_resize_flip(images, crops, flip).float()
+            cw, ch = crops[:, 2] - crops[:, 0], crops[:, 3] - crops[:, 1]
+        else:
+            # crop + resize + flip as one grid_sample
+            cw, ch = crops[:, 2] - crops[:, 0], crops[:, 3] - crops[:, 1]
+            theta = torch.zeros(n, 2, 3, device=device)
+            theta[:, 0, 0] = cw / w * torch.where(flip, -1., 1.)
+            theta[:, 0, 2] = (2 * crops[:, 0] + cw) / w - 1
+            theta[:, 1, 1] = ch / h
+            theta[:, 1, 2] = (2 * crops[:, 1] + ch) / h - 1
+            grid = F.affine_grid(theta, (n, c, oh, ow), align_corners=False)
+            tensor = F.grid_sample(images.float(), grid, mode="bilinear",
+                                   padding_mode="zeros", align_corners=False)
+        # uint8 to 0-1 is fused with photometric
+        tensor = self.photometric(
+            tensor, 1 / 255 if images.dtype == torch.uint8 else 1.)
+
+        # adjust boxes
+        scale = torch.stack((ow / cw, oh / ch), 1).repeat(1, 2)
+        boxes = (boxes - crops[:, None, :2].repeat(1, 1, 2)) * scale[:, None]
+        flipped = torch.stack((ow - boxes[..., 2], boxes[..., 1],
+                               ow - boxes[..., 0], boxes[..., 3]), -1)
+        boxes = torch.where(flip[:, None, None], flipped, boxes)
+
+        # visible area
+        area = ((boxes[..., 2] - boxes[..., 0]) *
+                (boxes[..., 3] - boxes[..., 1]))
+        visible = torch.stack((boxes[..., 0::2].clamp(0, ow),
+                               boxes[..., 1::2].clamp(0, oh)), -1)
+        visible = ((visible[..., 1, 0] - visible[..., 0, 0]) *
+                   (visible[..., 1, 1] - visible[..., 0, 1]))
+        valid = valid & (visible / (area + 1e-6) > self.retain_area)
+        return tensor, boxes, valid
+
+    def crop_resize_flip(self, images: torch.Tensor, crops: torch.Tensor,
+                         flip: torch.Tensor):
+        r""" Crops (integer ltrb, zeros outside the image), resizes
+        (bilinear, same as grid_sample) and flips each image on the dtype of
+        images """
+        n, c, h, w = images.shape
+        ow, oh = self.osize
+        tensor = images.new_empty((n, c, oh, ow))
+        for i, ((l, t, r, b), flipped) in enumerate(zip(
+                crops.long().tolist(), flip.tolist())):
+            x = images[i:i + 1, :, min(max(t, 0), h):min(b, h),
+                       min(max(l, 0), w):min(r, w)]
+            left, top = min(max(-l, 0), r - l), min(max(-t, 0), b - t)
+            pad = (left, r - l - x.size(3) - left,
+                   top, b - t - x.size(2) - top)
+            if any(pad):
+                x = F.pad(x, pad)
+            x = F.interpolate(x, (oh, ow), mode="bilinear",
+                              align_corners=False)
+            tensor[i] = x[0].flip(-1) if flipped else x[0]
+        return tensor
+
+    def random_crops(self, boxes: torch.Tensor, valid: torch.Tensor,
+                     sizes: torch.Tensor):
+        r""" Returns a ltrb crop per image (N x 4) """
+        n, a, device = boxes.shape[0], self.n_attempts, boxes.device
+        (ow, oh), w, h = self.osize, sizes[:, [0]], sizes[:, [1]]
+
+        # random side of crop (n x a) that matches osize aspect ratio
+        side = torch.where(
+            torch.rand(n, a, device=device) <= 0.2,
+            torch.ones(n, a, device=device),
+            torch.empty(n, a, device=device).uniform_(self.min_side, 1.))
+        side = torch.min(w, h) * side
+        if ow / oh >= 1:
+            nw, nh = side, side * oh / ow
+        else:
+            nw, nh = side * ow / oh, side
+        # aspect ratio variation
+        p = torch.rand(n, a, device=device)
+        variation = torch.empty(n, a, device=device).uniform_(0.8, 1.)
+        nw = torch.where(p < 0.4, nw * variation, nw)
+        nh = torch.where((p >= 0.4) & (p < 0.8), nh * variation, nh)
+        left = torch.rand(n, a, device=device) * (w - nw)
+        top = torch.rand(n, a, device=device) * (h - nh)
+        crops = torch.stack((left, top, left + nw, top + nh), -1)
+
+        # n x a x n_boxes -- fraction of each box within each crop
+        lt = torch.max(boxes[:, None, :, :2], crops[:, :, None, :2])
+        rb = torch.min(boxes[:, None, :, 2:], crops[:, :, None, 2:])
+        intersection = (rb - lt).clamp(0).prod(-1)
+        bw = boxes[..., 2] - boxes[..., 0]
+        bh = boxes[..., 3] - boxes[..., 1]
+        iof = intersection / (bw * bh + 1e-15)[:, None]
+        # at least one box has minimum required size after resize
+        resized = torch.min(bw[:, None] / nw[..., None] * ow,
+                            bh[:, None] / nh[..., None] * oh)
+        ok = ((iof >= 0.9) & (resized > self.min_object_side) &
+              valid[:, None]).any(-1)
+        pick = ok.float().argmax(1)
+        crops = crops[torch.arange(n, device=device), pick]
+
+        # fallback -- a crop around a random box
+        failed = ~ok.any(1)
+        if failed.any():
+            crops[failed] = self.crops_around_boxes(
+                boxes[failed], valid[failed], sizes[failed])
+        return crops
+
+    def crops_around_boxes(self, boxes: torch.Tensor, valid: torch.Tensor,
+                           sizes: torch.Tensor):
+        r""" Returns a ltrb crop around a random valid box per image (full
+        image when there are no valid boxes) """
+        n, device = boxes.shape[0], boxes.device
+        ow, oh = self.osize
+        weights = valid.float()
+        no_boxes = weights.sum(1) == 0
+        weights[no_boxes] = 1
+        pick = torch.multinomial(weights, 1).squeeze(1)
+        anchor = boxes[torch.arange(n, device=device), pick]
+
+        # side such that the box is 80% of the crop to min_object_side * 1.25
+        nw = (anchor[:, 2:] - anchor[:, :2]).mean(1)
+        low, high = nw * 1.25, nw * ow / (self.min_object_side * 1.25)
+        nw = low + torch.rand(n, device=device) * (high - low).clamp(0)
+        nh = nw * oh / ow
+        left = torch.max(torch.zeros_like(nw), anchor[:, 2] - nw)
+        left = left + torch.rand(n, device=device) * \
+            (anchor[:, 0] - left).clamp(0)
+        top = torch.max(torch.zeros_like(nh), anchor[:, 3] - nh)
+        top = top + torch.rand(n, device=device) * \
+            (anchor[:, 1] - top).clamp(0)
+        crops = torch.stack((left, top, left + nw, top + nh), 1)
+        full = torch.cat((torch.zeros_like(sizes), sizes), 1)
+        return torch.where(no_boxes[:, None], full, crops)
+
+    def photometric(self, tensor: torch.Tensor, scale: float = 1.):
+        r""" Random brightness, contrast, saturation and grayscale on a float
+        NCHW tensor (tensor * scale must be in 0-1). All the four are linear,
+        and are fused into a color matrix and bias per image (a single bmm),
+        so the tensor is clamped only once. """
+        n, c, h, w = tensor.shape
+        device = tensor.device
+        weights = torch.tensor([0.299, 0.587, 0.114] if c == 3 else [1.],
+                               device=device)
+        matrix = torch.eye(c, device=device).mul(scale).repeat(n, 1, 1)
+        bias = torch.zeros(n, 1, 1, device=device)
+        if self.jitter > 0 and self.p_jitter > 0:
+            apply = (torch.rand(n, 3, device=device) <
+                     self.p_jitter).float()
+            factors = 1 + apply * torch.empty(n, 3, device=device).uniform_(
+                -self.jitter, self.jitter)
+            brightness, contrast, saturation = \
+                factors.view(n, 3, 1, 1).unbind(1)
+            # contrast is a blend with mean of gray (after brightness)
+            mean = (tensor.mean((2, 3)) @ weights).view(n, 1, 1)
+            mean = mean * brightness * scale
+            matrix = matrix * (brightness * contrast)
+            bias = (1 - contrast) * mean
+            if c == 3:
+                # saturation is a blend with gray
+                gray = weights.view(1, 1, 3).expand(n, 3, 3)
+                matrix = torch.lerp(gray, torch.eye(3, device=device),
+                                    saturation) @ matrix
+        if self.p_gray > 0 and c == 3:
+            gray = torch.rand(n, 1, 1, device=device) < self.p_gray
+            matrix = torch.where(
+                gray, (weights @ matrix).unsqueeze(1).expand(n, 3, 3), matrix)
+        tensor = torch.baddbmm(bias, matrix, tensor.view(n, c, h * w))
+        return tensor.clamp_(0, 1).view(n, c, h, w)
+
+
+# from tensormonk.detection import BatchAugment
+# images = torch.randint(0, 256, (32, 3, 480, 640), dtype=torch.uint8)
+# boxes = torch.Tensor([[[40, 60, 240, 300], [300, 200, 420, 360]]] * 32)
+# valid = torch.ones(32, 2).bool()
+# augment = BatchAugment((320, 320))
+# tensor, boxes, valid = augment(images, boxes, valid)
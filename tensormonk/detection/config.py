@@ -159,6 +159,7 @@ class CONFIG:
         self._encode_iou = 0.5
         self._detect_iou = 0.2
         self._score_threshold = 0.1
+        self._detect_candidates_per_level = None
 
         # ------------------------------------------------------------------- #
         self._boxes_encode_var1 = 0.1
@@ -705,6 +706,27 @@ class CONFIG:
         assert isinstance(value, float)
         self._score_threshold = value
 
+    @property
+    def detect_candidates_per_level(self):
+        r"""Maximum locations per level (top scores above score_threshold)
+        that are decoded and passed to nms during detection. An int limits
+        all the levels, a list/tuple has a limit per level (None for no
+        limit). Bounds the nms cost when most of the locations pass
+        score_threshold.
+
+        Args:
+            value (int/list/tuple, optional): default = :obj:`None`.
+        """
+        return self._detect_candidates_per_level
+
+    @detect_candidates_per_level.setter
+    def detect_candidates_per_level(self, value):
+        if value is not None:
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for x in values:
+                assert x is None or (isinstance(x, int) and x > 0)
+        self._detect_candidates_per_level = value
+
     @property
     def boxes_encode_var1(self):
         r"""Variance used to encode boxes - `SSD: Single Shot MultiBox
@@ -14,6 +14,8 @@ class Sample(object):
     augment data (random 90/180/270 rotates, random pad and random cropping)
     during training -- boxes and points are adjusted accordingly. The image can
     be resized along with boxes and points if Sample.OSIZE is initialized.
+    For batches of images without points, BatchAugment does crop, resize,
+    flip and color jitter with batched tensor ops.
 
     Attributes (are set once):
         INVALID (float): In cases where some points are not available set the
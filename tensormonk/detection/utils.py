@@ -4,6 +4,9 @@ __all__ = ["pixel_to_norm01", "norm01_to_pixel", "auto_convert",
            "ltrb_to_cxcywh", "cxcywh_to_ltrb",
            "compute_intersection", "compute_area",
            "compute_iou", "compute_iof", "nms",
+           "compute_intersection_batch", "compute_iou_batch",
+           "reduce_iou_batch",
+           "hard_nms", "soft_nms", "matrix_nms", "weighted_boxes_fusion",
            "centers_per_layer",
            "encode_boxes", "decode_boxes",
            "encode_point", "decode_point",
@@ -11,11 +14,14 @@ __all__ = ["pixel_to_norm01", "norm01_to_pixel", "auto_convert",
            "ObjectUtils"]
 
 
+import math
 import torch
 from torch import Tensor
 import numpy as np
 from typing import Type, Union
 
+IOU_METHODS = ("iou", "giou", "diou", "ciou", "iof")
+
 
 def pixel_to_norm01(boxes: Type[Union[Tensor, np.ndarray]], w: int, h: int):
     r"""Normalizes bounding boxes (ltrb/cxcywh) from pixel coordinates to
@@ -201,6 +207,150 @@ def compute_iou(ltrb_boxes1: Type[Union[Tensor, np.ndarray]],
     return iou
 
 
+def compute_intersection_batch(ltrb_boxes1: Tensor, ltrb_boxes2: Tensor):
+    r"""Computes intersection of a set (or a batch) of ltrb boxes with a
+    batch of ltrb boxes.
+
+    Args:
+        ltrb_boxes1 (torch.Tensor): Nx4/BxNx4 Tensor of boxes (Ex: anchors)
+        ltrb_boxes2 (torch.Tensor): BxMx4 Tensor of boxes (Ex: padded boxes
+            of a batch)
+
+    Return:
+        BxNxM Tensor of intersection
+    """
+    if ltrb_boxes1.ndim == 2:
+        ltrb_boxes1 = ltrb_boxes1[None]
+    # per coordinate BxNxM (contiguous, in-place) -- faster than BxNxMx2
+    l1, t1, r1, b1 = (x[:, :, None] for x in ltrb_boxes1.unbind(2))
+    l2, t2, r2, b2 = (x[:, None] for x in ltrb_boxes2.unbind(2))
+    intersection = torch.min(r1, r2).sub_(torch.max(l1, l2)).clamp_(0)
+    intersection.mul_(torch.min(b1, b2).sub_(torch.max(t1, t2)).clamp_(0))
+    return intersection
+
+
+def compute_iou_batch(ltrb_boxes1: Tensor,
+                      ltrb_boxes2: Tensor,
+                      return_iof: bool = False,
+                      method: str = "iou"):
+    r"""Computes all combinations of intersection over union of a set (or a
+    batch) of boxes with a batch of boxes. Accepts torch.Tensor.
+
+    Args:
+        ltrb_boxes1 (torch.Tensor): Nx4/BxNx4 Tensor of boxes (Ex: anchors)
+        ltrb_boxes2 (torch.Tensor): BxMx4 Tensor of boxes (Ex: padded boxes
+            of a batch)
+        return_iof (bool): When True, returns iou and iof (intersection over
+            foreground)
+
+            default: False
+        method (str): "iou" | "giou" (generalized iou) | "diou" (distance
+            iou) | "ciou" (complete iou) | "iof" (intersection over
+            foreground, ltrb_boxes1 is foreground)
+
+            default: "iou"
+
+    Return:
+        BxNxM Tensor of iou's
+    """
+    if method not in IOU_METHODS:
+        raise NotImplementedError("method = {}?".format(method))
+    intersection = compute_intersection_batch(ltrb_boxes1, ltrb_boxes2)
+    area_1 = compute_area_pt(ltrb_boxes1.reshape(-1, 4)).view(
+        ltrb_boxes1.shape[:-1])[..., None]
+    if method == "iof":
+        return intersection.div_(area_1 + 1e-15)
+    area_2 = compute_area_pt(ltrb_boxes2.reshape(-1, 4)).view(
+        ltrb_boxes2.shape[:2])[:, None]
+
+    union = (area_2 + area_1).sub_(intersection)
+    if method == "iou":
+        iou = torch.div(intersection, union, out=union)
+        if return_iof:
+            iof = intersection.div_(area_1 + 1e-15)
+            return iou, iof
+        return iou
+
+    iou = intersection / union
+    if ltrb_boxes1.ndim == 2:
+        ltrb_boxes1 = ltrb_boxes1[None]
+    l1, t1, r1, b1 = (x[:, :, None] for x in ltrb_boxes1.unbind(2))
+    l2, t2, r2, b2 = (x[:, None] for x in ltrb_boxes2.unbind(2))
+    # width and height of enclosing box
+    w = torch.max(r1, r2).sub_(torch.min(l1, l2))
+    h = torch.max(b1, b2).sub_(torch.min(t1, t2))
+    if method == "giou":
+        enclosing = w.mul_(h)
+        iou.sub_((enclosing - union).div_(enclosing + 1e-15))
+    else:
+        # squared distance of centers over squared diagonal of enclosing box
+        distance = ((l2 + r2) - (l1 + r1)).pow_(2).add_(
+            ((t2 + b2) - (t1 + b1)).pow_(2)).div_(4)
+        iou.sub_(distance.div_(w.pow_(2).add_(h.pow_(2)).add_(1e-15)))
+        if method == "ciou":
+            # aspect ratio consistency (atan per box)
+            v = _aspect(ltrb_boxes2)[:, None] - \
+                _aspect(ltrb_boxes1)[:, :, None]
+            v = v.pow_(2).mul_(4 / math.pi ** 2)
+            alpha = v / (1 - intersection.div_(union) + v).clamp_(min=1e-15)
+            iou.sub_(alpha.mul_(v))
+    if return_iof:
+        return iou, compute_iou_batch(ltrb_boxes1, ltrb_boxes2, method="iof")
+    return iou
+
+
+def _aspect(ltrb_boxes: Tensor):
+    r""" atan(width / height) of boxes (Nx4/BxNx4) for ciou """
+    return torch.atan((ltrb_boxes[..., 2] - ltrb_boxes[..., 0]) /
+                      (ltrb_boxes[..., 3] - ltrb_boxes[..., 1] + 1e-15))
+
+
+def reduce_iou_batch(ltrb_boxes1: Tensor,
+                     ltrb_boxes2: Tensor,
+                     method: str = "iou",
+                     valid: Tensor = None,
+                     chunk_size: int = 4096):
+    r"""Reductions of compute_iou_batch, computed in chunks of ltrb_boxes1
+    (Ex: anchors) -- the BxNxM matrix is never in memory (peak memory is
+    B x chunk_size x M). The results are the same as the reductions of
+    compute_iou_batch.
+
+    Args:
+        ltrb_boxes1 (torch.Tensor): Nx4/BxNx4 Tensor of boxes (Ex: anchors)
+        ltrb_boxes2 (torch.Tensor): BxMx4 Tensor of boxes (Ex: padded boxes
+            of a batch)
+        method (str): See compute_iou_batch. default = "iou"
+        valid (torch.Tensor, optional): BxM mask of ltrb_boxes2, invalid
+            boxes are -inf. default = None
+        chunk_size (int): boxes of ltrb_boxes1 per chunk, default = 4096
+
+    Return:
+        max iou (BxN) and argmax (BxN) of each box in ltrb_boxes1, and max
+        iou (BxM) and argmax (BxM) of each box in ltrb_boxes2
+    """
+    if method not in IOU_METHODS:
+        raise NotImplementedError("method = {}?".format(method))
+    n, (b, m) = ltrb_boxes1.shape[-2], ltrb_boxes2.shape[:2]
+    device = ltrb_boxes2.device
+    best1 = torch.empty(b, n, device=device)
+    best1_idx = torch.zeros(b, n, dtype=torch.long, device=device)
+    best2 = torch.full((b, m), -float("inf"), device=device)
+    best2_idx = torch.zeros(b, m, dtype=torch.long, device=device)
+    for start in range(0, n, chunk_size):
+        end = min(n, start + chunk_size)
+        iou = compute_iou_batch(ltrb_boxes1[..., start:end, :], ltrb_boxes2,
+                                method=method)
+        if valid is not None:
+            iou.masked_fill_(~ valid[:, None], -float("inf"))
+        best1[:, start:end], best1_idx[:, start:end] = iou.max(2)
+        value, idx = iou.max(1)
+        # strictly greater -- retains the first (same as max)
+        update = value > best2
+        best2 = torch.where(update, value, best2)
+        best2_idx = torch.where(update, idx + start, best2_idx)
+    return best1, best1_idx, best2, best2_idx
+
+
 def compute_iof(ltrb_boxes1: Type[Union[Tensor, np.ndarray]],
                 ltrb_boxes2: Type[Union[Tensor, np.ndarray]]):
     r"""Computes intersection over foreground - ltrb_boxes1 is foreground.
@@ -217,57 +367,302 @@ def compute_iof(ltrb_boxes1: Type[Union[Tensor, np.ndarray]],
     return iof
 
 
+def _sorted_iou_chunks(boxes: Tensor, chunk_size: int):
+    r"""Yields (start, end, iou) of score sorted boxes (BxNx4) -- iou (Bx
+    end x (end - start)) of boxes[:, :end] with boxes[:, start:end], the
+    columns of an upper-triangular iou matrix in chunks of chunk_size.
+    Memory is B x N x chunk_size.
+    """
+    n = boxes.size(1)
+    for start in range(0, n, chunk_size):
+        end = min(n, start + chunk_size)
+        yield start, end, compute_iou_batch(boxes[:, :end],
+                                            boxes[:, start:end])
+
+
+def _upper(start: int, end: int, device, diagonal: int = 1):
+    r""" end x (end - start) mask of row < column (row <= column when
+    diagonal = 0) """
+    rows = torch.arange(end, device=device)[:, None]
+    cols = torch.arange(start, end, device=device)[None]
+    return rows <= cols - diagonal
+
+
+def _sort_boxes(boxes: Tensor, scores: Tensor):
+    r""" Adds batch dimension and sorts boxes and scores by scores """
+    if boxes.ndim == 2:
+        boxes, scores = boxes[None], scores.reshape(1, -1)
+    assert boxes.ndim == 3 and boxes.size(-1) == 4
+    assert scores.shape == boxes.shape[:2]
+    scores, order = scores.sort(dim=1, descending=True, stable=True)
+    boxes = boxes.gather(1, order[..., None].expand(-1, -1, 4))
+    return boxes, scores, order
+
+
+def _compact(mask: Tensor, *args):
+    r""" Gathers the positions of mask (BxN) first (retains the order), and
+    trims to the maximum positions of a row. Returns the positions, mask and
+    args (BxNx...) at the positions. """
+    order = mask.sort(dim=1, descending=True, stable=True)[1]
+    order = order[:, :int(mask.sum(1).max())]
+    return (order, mask.gather(1, order)) + tuple(
+        x.gather(1, order[..., None].expand(-1, -1, x.size(-1)))
+        for x in args)
+
+
+def _hard_nms_sorted(boxes: Tensor, iou_threshold: float, chunk_size: int):
+    r""" BxN keep mask of score sorted boxes (BxNx4) """
+    n = boxes.size(1)
+    keep = torch.zeros(boxes.shape[:2], device=boxes.device)
+    # retained boxes of previous chunks (padded with zero area boxes that
+    # do not overlap)
+    retained = boxes[:, :0]
+    for start in range(0, n, chunk_size):
+        end = min(n, start + chunk_size)
+        chunk = boxes[:, start:end]
+        # suppressed by the retained boxes of previous chunks
+        candidates = torch.ones_like(keep[:, start:end])
+        if retained.size(1):
+            iou = compute_iou_batch(retained, chunk) > iou_threshold
+            candidates = (~ iou.any(1)).to(keep.dtype)
+        # within chunk (only the candidates) -- a box is retained when no
+        # retained box above it overlaps. Iterating to the fixed point is
+        # exact (same as greedy), the first i boxes are final after i
+        # iterations.
+        order, candidates, chunk = _compact(candidates, chunk)
+        iou = (compute_iou_batch(chunk, chunk) > iou_threshold).to(
+            keep.dtype).triu_(1)
+        retain = candidates
+        while True:
+            update = torch.bmm(retain[:, None], iou)[:, 0].eq(0) * candidates
+            if torch.equal(update, retain):
+                break
+            retain = update
+        keep[:, start:end].scatter_(1, order, retain)
+        # retained boxes first, and trimmed to the maximum of an image
+        _, retain, chunk = _compact(retain, chunk)
+        retained = torch.cat((retained, chunk * retain[..., None]), 1)
+    return keep.bool()
+
+
+def hard_nms(boxes: Tensor,
+             scores: Tensor,
+             iou_threshold: float = 0.5,
+             chunk_size: int = 256):
+    r"""Vectorized non-maximal suppression (same as torchvision.ops.nms, a
+    box is suppressed by a retained box of higher score with iou >
+    iou_threshold). The upper-triangular iou matrix of score sorted boxes is
+    computed in chunks of chunk_size columns.
+
+    Args:
+        boxes (torch.Tensor): Nx4 or BxNx4 ltrb boxes
+        scores (torch.Tensor): N or BxN scores
+        iou_threshold (float, optional): default = 0.5
+        chunk_size (int, optional): columns of iou matrix per chunk, memory
+            is B x N x chunk_size. default = 256
+
+    Returns:
+        Retained indices sorted by score (Nx4 boxes) or a BxN mask of
+        retained boxes (BxNx4 boxes)
+    """
+    batched = boxes.ndim == 3
+    boxes, scores, order = _sort_boxes(boxes, scores)
+    keep = _hard_nms_sorted(boxes, iou_threshold, chunk_size)
+    if not batched:
+        return order[0][keep[0]]
+    return torch.zeros_like(keep).scatter_(1, order, keep)
+
+
+def soft_nms(boxes: Tensor,
+             scores: Tensor,
+             iou_threshold: float = 0.3,
+             sigma: float = 0.5,
+             method: str = "linear",
+             score_threshold: float = 0.001):
+    r"""Soft-NMS -- scores of boxes are decayed by the iou with the selected
+    box (highest decayed score), instead of suppressing them.
+    Paper: Soft-NMS -- Improving Object Detection With One Line of Code
+    URL:   https://arxiv.org/pdf/1704.04503.pdf
+
+    Selection is sequential, a step selects a box per image for all the
+    images, and stops when the remaining scores are below score_threshold.
+
+    Args:
+        boxes (torch.Tensor): Nx4 or BxNx4 ltrb boxes
+        scores (torch.Tensor): N or BxN scores
+        iou_threshold (float, optional): linear decay (1 - iou) for iou >
+            iou_threshold. default = 0.3
+        sigma (float, optional): gaussian decay exp(-iou^2 / sigma).
+            default = 0.5
+        method (str, optional): "linear" | "gaussian". default = "linear"
+        score_threshold (float, optional): boxes with decayed scores below
+            score_threshold are removed (score = 0). default = 0.001
+
+    Returns:
+        Decayed scores (N or BxN)
+    """
+    if method not in ("linear", "gaussian"):
+        raise NotImplementedError("method = {}?".format(method))
+    batched = boxes.ndim == 3
+    if not batched:
+        boxes, scores = boxes[None], scores.reshape(1, -1)
+    scores = scores.clone().float()
+    decayed = torch.zeros_like(scores)
+    pending = scores >= score_threshold
+    area = compute_area_pt(boxes.reshape(-1, 4)).view(boxes.shape[:2])
+    b_idx = torch.arange(boxes.size(0), device=boxes.device)
+    while pending.any():
+        best = scores.masked_fill(~ pending, -1).argmax(1)
+        valid = pending[b_idx, best]
+        decayed[b_idx[valid], best[valid]] = scores[b_idx[valid],
+                                                    best[valid]]
+        pending[b_idx, best] = False
+        # iou of selected box with all the boxes of an image
+        selected = boxes[b_idx, best][:, None]
+        intersection = compute_intersection_batch(selected, boxes)[:, 0]
+        iou = intersection / (area[b_idx, best][:, None] + area -
+                              intersection)
+        if method == "linear":
+            decay = torch.where(iou > iou_threshold, 1 - iou,
+                                torch.ones_like(iou))
+        else:
+            decay = torch.exp(- iou.pow(2) / sigma)
+        scores = torch.where(valid[:, None], scores * decay, scores)
+        pending &= scores >= score_threshold
+    return decayed if batched else decayed[0]
+
+
+def matrix_nms(boxes: Tensor,
+               scores: Tensor,
+               sigma: float = 0.5,
+               method: str = "gaussian",
+               score_threshold: float = 0.001,
+               chunk_size: int = 256):
+    r"""Matrix NMS -- parallel soft-NMS, the decay of a box is the minimum
+    over boxes with higher score of f(iou) / f(compensate), where
+    compensate is the maximum iou of the higher scored box (with boxes of
+    higher score than it).
+    Paper: SOLOv2: Dynamic and Fast Instance Segmentation
+    URL:   https://arxiv.org/pdf/2003.10152.pdf
+
+    Args:
+        boxes (torch.Tensor): Nx4 or BxNx4 ltrb boxes
+        scores (torch.Tensor): N or BxN scores
+        sigma (float, optional): gaussian decay exp(-iou^2 / sigma).
+            default = 0.5
+        method (str, optional): "linear" | "gaussian". default = "gaussian"
+        score_threshold (float, optional): boxes with decayed scores below
+            score_threshold are removed (score = 0). default = 0.001
+        chunk_size (int, optional): columns of iou matrix per chunk, memory
+            is B x N x chunk_size. default = 256
+
+    Returns:
+        Decayed scores (N or BxN)
+    """
+    if method not in ("linear", "gaussian"):
+        raise NotImplementedError("method = {}?".format(method))
+    batched = boxes.ndim == 3
+    boxes, scores, order = _sort_boxes(boxes, scores)
+    compensate = torch.zeros_like(scores)
+    decay = torch.ones_like(scores)
+    for start, end, iou in _sorted_iou_chunks(boxes, chunk_size):
+        iou.mul_(_upper(start, end, boxes.device))
+        compensate[:, start:end] = iou.max(1)[0]
+        # lower-triangle (iou = 0) is >= 1, and row 0 (compensate = 0) is
+        # 1, so minimum is not affected
+        c = compensate[:, :end, None]
+        if method == "gaussian":
+            iou = torch.exp((c.pow(2) - iou.pow(2)) / sigma)
+        else:
+            iou = (1 - iou) / (1 - c).clamp(min=1e-6)
+        decay[:, start:end] = iou.min(1)[0]
+    scores = scores * decay
+    scores[scores < score_threshold] = 0
+    scores = torch.zeros_like(scores).scatter_(1, order, scores)
+    return scores if batched else scores[0]
+
+
+def weighted_boxes_fusion(boxes: Tensor,
+                          scores: Tensor,
+                          iou_threshold: float = 0.55,
+                          chunk_size: int = 256):
+    r"""Weighted boxes fusion of a set of boxes -- boxes retained by hard_nms
+    are replaced by the score weighted average of its cluster (the boxes it
+    suppressed and itself), and the score is the average score of cluster.
+    Paper: Weighted boxes fusion: Ensembling boxes from different object
+        detection models
+    URL:   https://arxiv.org/pdf/1910.13302.pdf
+
+    ** Clusters are from hard_nms (a box joins the first retained box of
+    higher score with iou > iou_threshold), fused boxes are not used for
+    matching as in the paper.
+
+    Args:
+        boxes (torch.Tensor): Nx4 or BxNx4 ltrb boxes
+        scores (torch.Tensor): N or BxN scores
+        iou_threshold (float, optional): default = 0.55
+        chunk_size (int, optional): columns of iou matrix per chunk, memory
+            is B x N x chunk_size. default = 256
+
+    Returns:
+        Fused boxes (Kx4) and scores (K) of retained boxes sorted by score
+        (Nx4 boxes), or fused boxes (BxNx4, boxes that are not retained are
+        not changed) and scores (BxN, 0 for boxes that are not retained)
+    """
+    batched = boxes.ndim == 3
+    boxes, scores, order = _sort_boxes(boxes, scores)
+    keep = _hard_nms_sorted(boxes, iou_threshold, chunk_size)
+    # iou of retained boxes with all the boxes -- a box joins the first
+    # retained box (a retained box is its own first)
+    positions, valid, retained = _compact(keep, boxes)
+    positions = positions.masked_fill(~ valid, boxes.size(1))
+    cluster = torch.zeros_like(order)
+    for start in range(0, boxes.size(1), chunk_size):
+        end = min(boxes.size(1), start + chunk_size)
+        columns = torch.arange(start, end, device=boxes.device)
+        member = (compute_iou_batch(retained, boxes[:, start:end]) >
+                  iou_threshold) & (positions[..., None] <= columns)
+        cluster[:, start:end] = positions.gather(
+            1, member.byte().argmax(1))
+    weights = scores.clamp(min=0)
+    total = torch.zeros_like(weights).scatter_add_(1, cluster, weights)
+    fused = torch.zeros_like(boxes).scatter_add_(
+        1, cluster[..., None].expand(-1, -1, 4), boxes * weights[..., None])
+    fused = fused / total[..., None].clamp(min=1e-15)
+    count = torch.zeros_like(weights).scatter_add_(
+        1, cluster, torch.ones_like(weights))
+    fused_scores = torch.zeros_like(weights).scatter_add_(
+        1, cluster, scores) / count.clamp(min=1)
+    if not batched:
+        return fused[0][keep[0]], fused_scores[0][keep[0]]
+    fused = torch.where(keep[..., None], fused, boxes)
+    fused_scores = fused_scores * keep
+    index = order[..., None].expand(-1, -1, 4)
+    return (torch.zeros_like(fused).scatter_(1, index, fused),
+            torch.zeros_like(fused_scores).scatter_(1, order, fused_scores))
+
+
 def nms_pt(boxes: Tensor, scores: Tensor,
            iou_threshold: float = 0.5, n_objects: int = -1):
-
     if not boxes.numel():
         return torch.Tensor([]).long()
-    retain = []
-    scores.squeeze_()
-    l, t, r, b = [boxes[:, x] for x in range(4)]
-    area = compute_area_pt(boxes)
-    idx = torch.sort(scores)[1]
-    while idx.numel():
-        # add best scored
-        retain.append(idx[-1].item())
-        if idx.numel() == 1 or len(retain) == n_objects:
-            break
-        # compute iou
-        intersection = intersection_pt(boxes[idx[:-1]], boxes[[idx[-1]]])
-        iou = intersection / (area[idx[:-1]] + area[idx[-1]] - intersection)
-        # remove boxes with iou above iou_threshold
-        idx = idx[:-1][iou < iou_threshold]
-    return torch.Tensor(retain).long().to(boxes.device)
+    retain = hard_nms(boxes, scores.reshape(-1), iou_threshold)
+    return retain[:n_objects] if n_objects > 0 else retain
 
 
 def nms_np(boxes: np.ndarray, scores: np.ndarray,
            iou_threshold: float = 0.5, n_objects: int = -1):
     if not boxes.size:
         return np.array([]).astype(np.int32)
-
-    retain = []
-    scores = scores.squeeze()
-    l, t, r, b = [boxes[:, x] for x in range(4)]
-    area = compute_area(boxes)
-    idx = np.argsort(scores)
-    while idx.size:
-        # add best scored
-        retain.append(idx[-1])
-        if idx.size == 1 or len(retain) == n_objects:
-            break
-        # compute iou
-        intersection = intersection_np(boxes[idx[:-1]], boxes[[idx[-1]]])
-        iou = intersection / (area[idx[:-1]] + area[idx[-1]] -
-                              intersection)
-        # remove boxes with iou above iou_threshold
-        idx = idx[:-1][iou < iou_threshold]
-    return np.array(retain).astype(np.int32)
+    return nms_pt(torch.from_numpy(boxes), torch.from_numpy(scores),
+                  iou_threshold, n_objects).numpy().astype(np.int32)
 
 
 def nms(boxes: Type[Union[Tensor, np.ndarray]],
         scores: Type[Union[Tensor, np.ndarray]],
         iou_threshold: float = 0.5, n_objects: int = -1):
-    r"""Non-maximal suppression.
+    r"""Non-maximal suppression (see hard_nms, a box is suppressed when iou
+    with a retained box of higher score is > iou_threshold).
 
     Args:
         boxes (np.ndarray/torch.Tensor): Nx4 ltrb boxes (left, top, right,
@@ -593,7 +988,16 @@ class ObjectUtils:
                            boxes
     compute_iof          - Computes intersection of foreground given two sets
                            of boxes
+    compute_intersection_batch - Computes intersection given a set of boxes
+                           and a batch of boxes
+    compute_iou_batch    - Computes intersection of union (iou/giou/diou/ciou)
+                           given a set of boxes and a batch of boxes
+    reduce_iou_batch     - Max/argmax of compute_iou_batch in chunks
     nms                  - Non-maximal suppression
+    hard_nms             - Vectorized non-maximal suppression (batched)
+    soft_nms             - Soft-NMS, linear/gaussian (batched)
+    matrix_nms           - Matrix NMS from SOLOv2 (batched)
+    weighted_boxes_fusion - Weighted boxes fusion (batched)
     centers_per_layer    - Centers of each location per layer
     encode_boxes         - Encodes raw boxes
     decode_boxes         - Decodes predicted boxes
@@ -618,9 +1022,16 @@ class ObjectUtils:
     compute_iou = compute_iou
     compute_iou_np = compute_iou
     compute_iof = compute_iof
+    compute_intersection_batch = compute_intersection_batch
+    compute_iou_batch = compute_iou_batch
+    reduce_iou_batch = reduce_iou_batch
     compute_iof_np = compute_iof
     nms_np = nms_np
     nms = nms
+    hard_nms = hard_nms
+    soft_nms = soft_nms
+    matrix_nms = matrix_nms
+    weighted_boxes_fusion = weighted_boxes_fusion
     centers_per_layer_np = centers_per_layer_np
     centers_per_layer = centers_per_layer
     encode_boxes = encode_boxes
@@ -27,7 +27,7 @@ class PillowUtils:
             ltrb_boxes (np.ndarray, optional)
                 Must be pixel locations in (left, top, right, bottom).
         """
-        if ImPIL.isImageType(image):
+        if isinstance(image, ImPIL.Image):
             o = image
         elif isinstance(image, str):
             o = ImPIL.open(image).convert("RGB")
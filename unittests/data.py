@@ -0,0 +1,708 @@
+""" TensorMONK's :: unittests :: data """
+
+import os
+import gc
+import json
+import time
+import shutil
+import tarfile
+import tempfile
+import unittest
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import numpy as np
+from PIL import Image as ImPIL
+import sys
+sys.path.append("../TensorMONK")
+
+
+def create_folders(path: str, n_labels: int = 3, n_per_label: int = 4,
+                   size: tuple = (48, 40)):
+    r""" Creates a folder of class folders with random images """
+    for i in range(n_labels):
+        os.mkdir(os.path.join(path, "label{}".format(i)))
+        for j in range(n_per_label):
+            image = np.random.randint(0, 255, size[::-1] + (3, ), np.uint8)
+            ImPIL.fromarray(image).save(
+                os.path.join(path, "label{}".format(i), "{}.png".format(j)))
+
+
+def create_voc(path: str, n_images: int = 3):
+    r""" Creates a VOC like folder with random images and annotations """
+    for folder in ("Annotations", "ImageSets/Main", "JPEGImages"):
+        os.makedirs(os.path.join(path, folder))
+    obj = ("<object><name>{}</name><difficult>{}</difficult><bndbox>"
+           "<xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax><ymax>{}</ymax>"
+           "</bndbox></object>")
+    for i in range(n_images):
+        image = np.random.randint(0, 255, (60, 80, 3), np.uint8)
+        ImPIL.fromarray(image).save(
+            os.path.join(path, "JPEGImages", "{}.jpg".format(i)))
+        objects = "".join([obj.format("dog", 0, 11, 11, 41, 31),
+                           obj.format("person", int(i > 0), 21, 6, 61, 51)])
+        with open(os.path.join(path, "Annotations", "{}.xml".format(i)),
+                  "w") as f:
+            f.write("<annotation><size><width>80</width><height>60</height>"
+                    "<depth>3</depth></size>" + objects + "</annotation>")
+    with open(os.path.join(path, "ImageSets/Main/trainval.txt"), "w") as f:
+        f.write("\n".join(map(str, range(n_images))))
+
+
+class FlakyHandler(SimpleHTTPRequestHandler):
+    r""" Serves files, fails the first request to /flaky/* with 503 """
+    failed = set()
+
+    def do_GET(self):
+        if self.path.startswith("/flaky/") and \
+           self.path not in FlakyHandler.failed:
+            FlakyHandler.failed.add(self.path)
+            self.send_error(503)
+            return
+        self.path = self.path.replace("/flaky/", "/")
+        super(FlakyHandler, self).do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class Tester(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.images = os.path.join(self.path, "images")
+        os.mkdir(self.images)
+        create_folders(self.images)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_folder_to_lmdb(self):
+        print("\tcheck -- tensormonk.data.FolderToLMDB")
+        file_name = os.path.join(self.path, "test.lmdb")
+        database, labels = FolderToLMDB(
+            self.images, file_name, 1024 * 1024, tensor_size=(1, 3, 20, 24),
+            encrypt=True, key_file_name=file_name + ".key", cpus=2,
+            commit_every=5)
+        self.assertEqual(labels, ["label0", "label1", "label2"])
+        self.assertEqual(len(database), 12)
+
+        # resume does not duplicate samples
+        database, labels = FolderToLMDB(
+            self.images, file_name, 1024 * 1024, tensor_size=(1, 3, 20, 24),
+            encrypt=True, key_file_name=file_name + ".key", cpus=2)
+        database.start(write=False)
+        self.assertEqual(len(database), 12)
+        image, label = database.read(11)
+        self.assertEqual(image.size, (24, 20))
+        self.assertEqual(label, 2)
+        database.stop()
+
+        # a new class after the existing ones is appended
+        os.mkdir(os.path.join(self.images, "label3"))
+        shutil.copy(os.path.join(self.images, "label0", "0.png"),
+                    os.path.join(self.images, "label3", "0.png"))
+        database, labels = FolderToLMDB(
+            self.images, file_name, 1024 * 1024, tensor_size=(1, 3, 20, 24),
+            encrypt=True, key_file_name=file_name + ".key", cpus=2)
+        self.assertEqual(labels[-1], "label3")
+        database.start(write=False)
+        self.assertEqual(len(database), 13)
+        self.assertEqual(database.read(12)[1], 3)
+        database.stop()
+
+        # a new class before the existing ones changes the labels
+        os.mkdir(os.path.join(self.images, "first"))
+        shutil.copy(os.path.join(self.images, "label0", "0.png"),
+                    os.path.join(self.images, "first", "0.png"))
+        self.assertRaises(ValueError, FolderToLMDB, self.images, file_name,
+                          1024 * 1024, tensor_size=(1, 3, 20, 24),
+                          encrypt=True, key_file_name=file_name + ".key",
+                          cpus=2)
+        shutil.rmtree(os.path.join(self.images, "first"))
+        # different tensor_size
+        self.assertRaises(ValueError, FolderToLMDB, self.images, file_name,
+                          1024 * 1024, tensor_size=(1, 3, 24, 24),
+                          encrypt=True, key_file_name=file_name + ".key",
+                          cpus=2)
+        with open(file_name + ".labels.json") as txt:
+            self.assertEqual(len(json.load(txt)["labels"]), 4)
+
+    def test_lmdb_cipher(self):
+        for cipher in ("fernet", "aesgcm", "chacha20"):
+            print("\tcheck -- tensormonk.data.LMDB "
+                  "(cipher={})".format(cipher))
+            file_name = os.path.join(self.path, cipher + ".lmdb")
+            database = LMDB(file_name, ("image", "label"), 1024 * 1024,
+                            show_image_name=True, encrypt=True,
+                            key_file_name=file_name + ".key", cipher=cipher)
+            database.start(write=True)
+            image = os.path.join(self.images, "label1", "0.png")
+            for i in range(4):
+                database.write(image, i)
+            database.stop()
+
+            database = LMDB(file_name, ("image", "label"), 1024 * 1024,
+                            show_image_name=True, encrypt=True,
+                            key_file_name=file_name + ".key")
+            database.start(write=False)
+            self.assertEqual(database.cipher, cipher)
+            samples = database.read_batch([3, 1])
+            self.assertEqual([x[1] for x in samples], [3, 1])
+            self.assertEqual(samples[0][0][1], image)
+            self.assertTrue((np.array(samples[0][0][0]) ==
+                             np.array(ImPIL.open(image))).all())
+            database.stop()
+
+        # databases without cipher (older databases) are fernet
+        env = lmdb.open(os.path.join(self.path, "fernet.lmdb"),
+                        subdir=False, lock=False)
+        with env.begin(write=True) as f:
+            f.delete(b"cipher")
+        env.close()
+        database = LMDB(os.path.join(self.path, "fernet.lmdb"),
+                        ("image", "label"), 1024 * 1024, encrypt=True,
+                        key_file_name=os.path.join(self.path,
+                                                   "fernet.lmdb.key"))
+        database.start(write=False)
+        self.assertEqual(database.cipher, "fernet")
+        self.assertEqual(database.read(2)[1], 2)
+        database.stop()
+
+    def test_shards(self):
+        print("\tcheck -- tensormonk.data.ShardWriter")
+        pattern = os.path.join(self.path, "train-%06d.tar")
+        with ShardWriter(pattern, max_size=16 * 1024) as writer:
+            for i in range(12):
+                image = os.path.join(self.images, "label{}".format(i // 4),
+                                     "{}.png".format(i % 4))
+                writer.write(image, label=i,
+                             boxes=np.array([[i, i, 20, 20]], np.float32))
+        self.assertTrue(len(writer.shards) > 1)
+
+        print("\tcheck -- tensormonk.data.ShardDataset")
+        data = ShardDataset(os.path.join(self.path, "train-*.tar"),
+                            tensor_size=(1, 3, 20, 24),
+                            attributes=("image", "label", "boxes"),
+                            shuffle_buffer=4, read_ahead=2)
+        samples = list(data)
+        self.assertEqual(sorted(x[1] for x in samples), list(range(12)))
+        self.assertEqual(tuple(samples[0][0].shape), (3, 20, 24))
+        self.assertTrue(all(x[2][0, 0] == x[1] for x in samples))
+
+        loader = torch.utils.data.DataLoader(data, batch_size=4,
+                                             num_workers=2)
+        labels = torch.cat([y for x, y, z in loader])
+        self.assertEqual(sorted(labels.tolist()), list(range(12)))
+
+        # a truncated shard raises (not a shorter epoch)
+        with open(writer.shards[0], "r+b") as f:
+            f.truncate(1024)
+        with self.assertRaises(tarfile.ReadError):
+            list(data)
+
+    def test_memmap(self):
+        print("\tcheck -- tensormonk.data.ToMemmap")
+        file_name = os.path.join(self.path, "train.npy")
+        ToMemmap(torchvision.datasets.ImageFolder(self.images), file_name,
+                 (1, 3, 20, 24), cpus=2, batch_size=5)
+
+        print("\tcheck -- tensormonk.data.MemmapDataset")
+        data = MemmapDataset(file_name, mean=(0.5, 0.5, 0.5),
+                             std=(0.25, 0.25, 0.25))
+        self.assertEqual(len(data), 12)
+        self.assertEqual(data.tensor_size, (1, 3, 20, 24))
+        tensor, labels = data[2:7]
+        self.assertEqual(tuple(tensor.shape), (5, 3, 20, 24))
+        expected = (torch.from_numpy(np.array(data.images[2:7])).float() /
+                    255 - 0.5) / 0.25
+        self.assertTrue(torch.allclose(tensor, expected, atol=1e-5))
+        # negative index
+        tensor, label = data[-1]
+        self.assertTrue(torch.equal(tensor, data[11][0]))
+        self.assertEqual(label, data.labels[11])
+        with self.assertRaises(IndexError):
+            data[-13]
+        with self.assertRaises(IndexError):
+            data[12]
+
+        print("\tcheck -- tensormonk.data.MemmapBatchSampler")
+        loader = torch.utils.data.DataLoader(
+            data, batch_size=None, num_workers=2,
+            sampler=MemmapBatchSampler(len(data), 5, shuffle=True))
+        labels = torch.cat([y for x, y in loader])
+        self.assertEqual(sorted(labels.tolist()), [0] * 4 + [1] * 4 + [2] * 4)
+
+    def test_datasets_in_memory(self):
+        print("\tcheck -- tensormonk.data.datasets.TensorLoader")
+        data = type("CIFAR", (), {})()
+        data.data = np.random.randint(0, 255, (10, 32, 32, 3), np.uint8)
+        data.targets = list(range(10))
+        tensor, targets = load_in_memory(data, (1, 3, 16, 16), (0.5,) * 3,
+                                         (0.25,) * 3)
+        self.assertEqual(tuple(tensor.shape), (10, 3, 16, 16))
+        loader = TensorLoader(tensor, targets, 4, shuffle=True,
+                              augment=RandomTransforms([Flip()], [0.5]))
+        self.assertEqual(len(loader), 3)
+        batches = list(loader)
+        self.assertEqual([x.size(0) for x, y in batches], [4, 4, 2])
+        labels = torch.cat([y for x, y in batches])
+        self.assertEqual(sorted(labels.tolist()), list(range(10)))
+        self.assertTrue(torch.equal(tensor[:, 0, 0, 0], load_in_memory(
+            data, (1, 3, 16, 16), (0.5,) * 3, (0.25,) * 3)[0][:, 0, 0, 0]))
+
+    def test_pk_batch_sampler(self):
+        print("\tcheck -- tensormonk.data.PKBatchSampler")
+        labels = np.repeat(np.arange(10), [1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+        sampler = PKBatchSampler(labels, p=5, k=2, n_batches=6, seed=1,
+                                 rank=0, world_size=2)
+        batches = list(sampler)
+        self.assertEqual(len(batches), 6)
+        for batch in batches:
+            batch_labels = labels[batch].reshape(5, 2)
+            self.assertTrue((batch_labels[:, 0] == batch_labels[:, 1]).all())
+            self.assertEqual(len(set(batch_labels[:, 0])), 5)
+            for pair in np.array(batch).reshape(5, 2):
+                if labels[pair[0]] > 0:
+                    self.assertNotEqual(pair[0], pair[1])
+        # deterministic per epoch and different across ranks
+        other = PKBatchSampler(labels, p=5, k=2, n_batches=6, seed=1,
+                               rank=1, world_size=2)
+        self.assertTrue((sampler.batches(0) == other.batches(0)).all())
+        self.assertNotEqual(list(other), batches)
+        self.assertEqual(sampler.epoch, 1)
+
+        print("\tcheck -- tensormonk.data.FewPerLabel.batch_sampler")
+        data = FewPerLabel(self.images, (1, 3, 20, 24), 2, n_samples=24)
+        loader = torch.utils.data.DataLoader(
+            data, batch_sampler=data.batch_sampler(3), num_workers=2)
+        for tensor, targets in loader:
+            self.assertEqual(tuple(tensor.shape), (6, 3, 20, 24))
+            self.assertTrue((targets[0::2] == targets[1::2]).all())
+            self.assertEqual(len(set(targets.tolist())), 3)
+
+    def test_aspect_ratio_batch_sampler(self):
+        print("\tcheck -- tensormonk.data.AspectRatioBatchSampler")
+        sizes = np.random.randint(100, 800, (203, 2))
+        sampler = AspectRatioBatchSampler(sizes, 8, pixels=256 * 256)
+        self.assertEqual(sampler.size_of(int(np.argmax(
+            sizes[:, 0] / sizes[:, 1]))), (192, 352))
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertEqual(sorted(sum(batches, [])), list(range(203)))
+        for batch in batches:
+            self.assertEqual(len(set(sampler.buckets[batch].tolist())), 1)
+        self.assertNotEqual(batches, list(sampler))
+        padding = sampler.padding()
+        self.assertLess(padding["bucketed"], padding["single"])
+        # equal batches per rank
+        n = [len(list(AspectRatioBatchSampler(sizes, 8, rank=r,
+                                              world_size=3)))
+             for r in range(3)]
+        self.assertEqual(n, [len(sampler) // 3] * 3)
+
+    def test_folder_index(self):
+        print("\tcheck -- tensormonk.data.FolderIndex")
+        index = FolderIndex(self.images)
+        self.assertEqual(index.n_rescanned, 3)
+        self.assertTrue(os.path.isfile(os.path.join(self.images,
+                                                    FolderIndex.CACHE)))
+        self.assertEqual(len(index), 12)
+        self.assertEqual(index.labels.tolist(), [0] * 4 + [1] * 4 + [2] * 4)
+
+        # only changed folders are rescanned
+        index = FolderIndex(self.images)
+        self.assertEqual(index.n_rescanned, 0)
+        self.assertEqual(len(index), 12)
+        shutil.copy(os.path.join(self.images, "label1", "0.png"),
+                    os.path.join(self.images, "label1", "4.png"))
+        index = FolderIndex(self.images)
+        self.assertEqual(index.n_rescanned, 1)
+        self.assertEqual([len(x) for x in index.per_label()], [4, 5, 4])
+
+        print("\tcheck -- tensormonk.data.IndexedImageFolder")
+        data = IndexedImageFolder(self.images)
+        self.assertEqual(len(data), 13)
+        self.assertEqual(data.classes, ["label0", "label1", "label2"])
+        self.assertEqual(data[5][1], 1)
+
+        # same samples as ImageFolder -- all IMG_EXTENSIONS, sub folders and
+        # is_valid_file
+        image = ImPIL.open(os.path.join(self.images, "label0", "0.png"))
+        image.save(os.path.join(self.images, "label0", "5.webp"))
+        os.makedirs(os.path.join(self.images, "label2", "more"))
+        image.save(os.path.join(self.images, "label2", "more", "6.ppm"))
+        data = IndexedImageFolder(self.images)
+        self.assertEqual(
+            data.samples,
+            torchvision.datasets.ImageFolder(self.images).samples)
+        self.assertEqual(len(data), 15)
+        image.save(os.path.join(self.images, "label2", "more", "7.pgm"))
+        index = FolderIndex(self.images)
+        self.assertEqual(index.n_rescanned, 1)
+        self.assertEqual([len(x) for x in index.per_label()], [5, 5, 6])
+
+        def is_valid_file(x):
+            return x.endswith(".png")
+
+        data = IndexedImageFolder(self.images, is_valid_file=is_valid_file)
+        self.assertEqual(data.samples, torchvision.datasets.ImageFolder(
+            self.images, is_valid_file=is_valid_file).samples)
+        self.assertEqual(len(data), 13)
+        with self.assertRaises(FileNotFoundError):
+            IndexedImageFolder(self.images,
+                               is_valid_file=lambda x: "label2" in x)
+
+    def test_open_image(self):
+        print("\tcheck -- tensormonk.data.utils.open_image")
+        file_name = os.path.join(self.path, "large.jpg")
+        image = np.random.randint(0, 255, (320, 400, 3), np.uint8)
+        ImPIL.fromarray(image).save(file_name)
+        image = ImPIL.open(file_name)
+        image.draft("RGB", (48, 40))
+        self.assertEqual(image.size, (50, 40))  # 1/8 decode
+        image = open_image(file_name, (48, 40), "L")
+        self.assertEqual((image.size, image.mode), ((48, 40), "L"))
+        self.assertEqual(tuple(totensor(file_name, (1, 3, 40, 48)).shape),
+                         (3, 40, 48))
+
+    def test_pascal_voc(self):
+        print("\tcheck -- tensormonk.data.PascalVOC")
+        path = os.path.join(self.path, "VOC2012")
+        create_voc(path)
+        data = PascalVOC(path, (1, 3, 320, 320), train=True)
+        self.assertEqual(data.n_parsed, 3)
+        self.assertTrue(os.path.isfile(data.cache))
+        self.assertEqual(data.sizes.tolist(), [[80, 60]] * 3)
+        # difficult objects are removed
+        self.assertEqual(data.annotation(0)[0].tolist(), [12, 15])
+        self.assertEqual(data.annotation(1)[0].tolist(), [12])
+        self.assertEqual(data.annotation(1)[1].tolist(), [[10, 10, 40, 30]])
+        data.filter_difficult(True)
+        self.assertEqual(data.annotation(2)[0].tolist(), [12, 15])
+
+        # cached and only modified annotations are parsed
+        data = PascalVOC(path, (1, 3, 320, 320), train=True,
+                         retain_difficult=True)
+        self.assertEqual(data.n_parsed, 0)
+        self.assertEqual(data.annotation(1)[0].tolist(), [12, 15])
+        with open(os.path.join(path, "Annotations", "2.xml"), "w") as f:
+            f.write("<annotation><size><width>80</width><height>60</height>"
+                    "</size></annotation>")
+        data = PascalVOC(path, (1, 3, 320, 320), train=True)
+        self.assertEqual(data.n_parsed, 1)
+        self.assertEqual(data.annotation(2)[1].shape, (0, 4))
+
+        data.train = False
+        image, boxes, labels = data[1]
+        self.assertEqual(tuple(image.shape), (3, 320, 320))
+        self.assertEqual(labels.tolist(), [12])
+        self.assertTrue(torch.allclose(
+            boxes, torch.Tensor([[10 / 80, 10 / 60, 40 / 80, 30 / 60]])))
+
+        # aspect ratio buckets -- 4:3 images are resized to 288x384
+        sampler = data.bucket_sampler(2)
+        self.assertEqual(tuple(data[1][0].shape), (3, 288, 384))
+        self.assertEqual(sampler.padding(),
+                         {"bucketed": 0., "single": 0.25, "saved": 0.25})
+
+    def test_sr_patch_cache(self):
+        print("\tcheck -- tensormonk.data.SuperResolutionData (patch_cache)")
+        os.mkdir(os.path.join(self.path, "DIV2K_train_HR"))
+        for i, size in enumerate(((96, 64), (64, 64), (40, 64))):
+            image = np.random.randint(0, 255, size[::-1] + (3, ), np.uint8)
+            ImPIL.fromarray(image).save(os.path.join(
+                self.path, "DIV2K_train_HR", "{}.png".format(i)))
+        cache = os.path.join(self.path, "patches")
+        data = SuperResolutionData(self.path, (1, 3, 8, 8), 2,
+                                   add_flickr2k=False, patch_cache=cache,
+                                   cpus=2)
+        # (3 x 5) + (3 x 3) + (3 x 2) patches of 32x32 with a stride of 16
+        self.assertEqual(len(data), 30)
+        hr, lr = data[6]
+        self.assertEqual((tuple(hr.shape), tuple(lr.shape)),
+                         ((3, 32, 32), (3, 8, 8)))
+        patch = ImPIL.open(os.path.join(self.path, "DIV2K_train_HR",
+                                        "0.png")).crop((16, 16, 48, 48))
+        self.assertTrue((data.hr_patches[6].transpose(1, 2, 0) ==
+                         np.asarray(patch)).all())
+        # cache is reused
+        mtime = os.stat(cache + ".hr.npy").st_mtime
+        data = SuperResolutionData(self.path, (1, 3, 8, 8), 2,
+                                   add_flickr2k=False, patch_cache=cache)
+        self.assertEqual(os.stat(cache + ".hr.npy").st_mtime, mtime)
+        self.assertEqual(len(data), 30)
+
+    def test_downloader(self):
+        print("\tcheck -- tensormonk.data.utils.Downloader")
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(FlakyHandler, directory=self.images))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        host = "http://127.0.0.1:{}/".format(server.server_address[1])
+        try:
+            urls = [host + "label{}/{}.png".format(i // 4, i % 4)
+                    for i in range(12)]
+            urls += [host + "flaky/label0/0.png", host + "missing.png"]
+            downloads = os.path.join(self.path, "downloads")
+            os.mkdir(downloads)
+            file_names = [os.path.join(downloads, "{}.png".format(i))
+                          for i in range(len(urls))]
+            downloader = Downloader(n_threads=4, max_per_host=2, retries=2,
+                                    backoff=0.01)
+            stats = downloader.to_files(file_names, urls)
+            self.assertEqual((stats["n_ok"], stats["n_failed"]), (13, 1))
+            self.assertGreater(stats["images_per_second"], 0)
+            self.assertEqual(len(downloader._hosts), 1)
+            self.assertEqual(sorted(os.listdir(downloads)),
+                             sorted("{}.png".format(i) for i in range(13)))
+            with open(os.path.join(self.images, "label2", "3.png"),
+                      "rb") as f:
+                with open(file_names[11], "rb") as g:
+                    self.assertEqual(f.read(), g.read())
+            # existing files are skipped
+            self.assertEqual(downloader.to_files(file_names, urls)["n_ok"],
+                             0)
+            # invalid urls and unwritable files are failures, not errors
+            names = [os.path.join(downloads, "bad0.png"),
+                     os.path.join(downloads, "bad1.png"),
+                     os.path.join(self.path, "missing", "bad2.png"),
+                     os.path.join(downloads, "good.png")]
+            stats = urls_2_images(names, ["not a url", "htp://x/y.jpg",
+                                          urls[0], urls[1]], num_threads=2)
+            self.assertEqual((stats["n_ok"], stats["n_failed"]), (1, 3))
+            self.assertEqual(len(os.listdir(downloads)), 14)
+
+            file_name = os.path.join(self.path, "downloads.lmdb")
+            database = LMDB(file_name, ("image", "label"), 1024 * 1024)
+            database.start(write=True)
+            stats = downloader.to_lmdb(database, urls[:12],
+                                       [i // 4 for i in range(12)])
+            self.assertEqual(len(database), 12)
+            database.stop()
+            database.start(write=False)
+            labels = sorted(database.read(i)[1] for i in range(12))
+            self.assertEqual(labels, [0] * 4 + [1] * 4 + [2] * 4)
+            self.assertEqual(database.read(0)[0].size, (48, 40))
+            database.stop()
+            downloader.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_camera(self):
+        print("\tcheck -- tensormonk.data.live.Camera")
+        file_name = os.path.join(self.path, "video.avi")
+        writer = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*"MJPG"),
+                                 100, (64, 48))
+        for i in range(24):
+            writer.write(np.full((48, 64, 3), i * 10, np.uint8))
+        writer.release()
+
+        with Camera(file_name, buffer_size=4) as camera:
+            frames = list(camera)
+        # frames are in order (slower consumer can skip frames)
+        values = [int(round(x.mean() / 10)) for x in frames]
+        self.assertEqual(values, sorted(set(values)))
+        self.assertEqual(values[-1], 23)
+        self.assertEqual(frames[0].shape, (48, 64, 3))
+        self.assertIsNone(camera.get(timeout=0.01))
+
+        # a stall (longer than the get timeout) does not end the iterator
+        camera = Camera(file_name, buffer_size=4)
+        grab, calls = camera._grab_a_frame, []
+
+        def stalled_grab():
+            calls.append(1)
+            if len(calls) == 5:
+                time.sleep(0.3)
+            return grab()
+
+        camera._grab_a_frame = stalled_grab
+        with camera:
+            values = [int(round(x.mean() / 10)) for x in camera]
+        self.assertEqual(values[-1], 23)
+
+        camera = Camera(file_name, buffer_size=6, realtime=False).start()
+        batch = camera.get_batch(3)
+        self.assertEqual(tuple(batch.shape), (3, 48, 64, 3))
+        values = batch.float().mean((1, 2, 3)).div(10).round().tolist()
+        self.assertEqual(values, sorted(values))
+        camera.stop()
+        with self.assertRaises(ValueError):
+            Camera(os.path.join(self.path, "missing.avi"))
+
+    def test_random_blur(self):
+        print("\tcheck -- tensormonk.data.RandomBlur (per_sample)")
+        blur = RandomBlur(7, kernels=("gaussian", "box", "motion"))
+        tensor = torch.rand(8, 3, 24, 24)
+        output = blur(tensor)
+        self.assertEqual(output.shape, tensor.shape)
+        # separable gaussian == 2D gaussian
+        x = blur.positions
+        kernel = torch.exp(- x.pow(2) / 8)
+        kernel = (kernel / kernel.sum()).view(1, -1).expand(8, -1)
+        expected = torch.nn.functional.conv2d(
+            tensor, GaussianKernel(2., 7).repeat(3, 1, 1, 1), padding=3,
+            groups=3)
+        self.assertTrue(torch.allclose(
+            blur.separable(tensor, kernel, kernel), expected, atol=1e-5))
+        # kernels are normalized and differ across samples
+        kx, ky = blur.random_kernels(8, tensor.device)
+        self.assertTrue(torch.allclose(kx.sum(1), torch.ones(8)))
+        self.assertGreater(len(set(map(tuple, kx.tolist()))), 1)
+
+    def test_elastic_similarity(self):
+        print("\tcheck -- tensormonk.data.ElasticSimilarity (cached grid)")
+        transform = ElasticSimilarity(elastic=0.)
+        tensor = torch.rand(4, 3, 20, 16)
+        tms = transform.random_tms(4)
+        grid = torch.matmul(transform.base_grid(20, 16, tensor.device,
+                                                torch.float32),
+                            tms.transpose(1, 2)).view(4, 20, 16, 2)
+        expected = torch.nn.functional.affine_grid(
+            tms, (4, 3, 20, 16), align_corners=False)
+        self.assertTrue(torch.allclose(grid, expected, atol=1e-6))
+        self.assertEqual(len(transform._grids), 1)
+        # half precision and subset of batch
+        output = ElasticSimilarity(half=True)(tensor)
+        self.assertEqual((output.shape, output.dtype),
+                         (tensor.shape, tensor.dtype))
+        output = ElasticSimilarity(probability=0.5)(torch.rand(64, 3, 8, 8))
+        self.assertEqual(output.shape, (64, 3, 8, 8))
+        with self.assertRaises(ValueError):
+            ElasticSimilarity(probability=0.)
+
+    def test_sample_cache(self):
+        print("\tcheck -- tensormonk.data.SampleCache")
+        cache = SampleCache("test", 10, 48, budget=3 * 48, path=self.path)
+        for i in range(3):
+            self.assertTrue(cache.put(i, np.full((4, 4, 3), i, np.uint8)))
+        self.assertEqual(cache.get(0).shape, (4, 4, 3))
+        # key 1 is the least recently used
+        cache.put(3, np.full((4, 12), 3, np.uint8))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(3).tolist(), [[3] * 12] * 4)
+        self.assertFalse(cache.put(4, np.zeros((7, 7), np.uint8)))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"],
+                          stats["skipped"], stats["n_cached"]),
+                         (2, 1, 1, 1, 3))
+        with self.assertRaises(ValueError):
+            SampleCache("test", 11, 48, budget=3 * 48, path=self.path)
+
+        # shared across workers -- the second epoch is all hits
+        cache.unlink()
+        data = FewPerLabel(self.images, (1, 3, 20, 24), 2, n_samples=12,
+                           shared_cache=1024 * 1024)
+        loader = torch.utils.data.DataLoader(data, batch_size=4,
+                                             num_workers=2)
+        first = torch.cat([x for x, _ in loader])
+        second = torch.cat([x for x, _ in loader])
+        self.assertTrue(torch.equal(first, second))
+        stats = data.sample_cache.stats()
+        self.assertEqual((stats["misses"], stats["hits"]), (12, 12))
+        # name changes with files (changed in place) and decoding
+        file_name = data.sample_cache.file_name
+        image = data.samples[0]
+        os.utime(image, ns=(0, os.stat(image).st_mtime_ns + 10 ** 9))
+        other = FewPerLabel(self.images, (1, 3, 20, 24), 2, n_samples=12,
+                            shared_cache=1024 * 1024)
+        self.assertNotEqual(other.sample_cache.file_name, file_name)
+        resized = FewPerLabel(self.images, (1, 3, 20, 24), 2, n_samples=12,
+                              shared_cache=1024 * 1024,
+                              process_image=partial(open_image, size=(8, 8)))
+        self.assertNotEqual(resized.sample_cache.file_name,
+                            other.sample_cache.file_name)
+        # the arena is removed with the dataset
+        file_names = [x.sample_cache.file_name
+                      for x in (data, other, resized)]
+        del data, loader, other, resized
+        gc.collect()
+        self.assertFalse(any(map(os.path.isfile, file_names)))
+
+        # lmdb
+        file_name = os.path.join(self.path, "test.lmdb")
+        database, _ = FolderToLMDB(self.images, file_name, 1024 * 1024,
+                                   tensor_size=(1, 3, 20, 24))
+        database.sample_cache = SampleCache(
+            "lmdb", len(database) * 2, 20 * 24 * 3, path=self.path)
+        database.start(False)
+        first = [np.asarray(x[0]) for x in database.read_batch([0, 1, 2])]
+        second = [np.asarray(database.read(i)[0]) for i in range(3)]
+        database.stop()
+        self.assertTrue(all((x == y).all() for x, y in zip(first, second)))
+        self.assertEqual(database.sample_cache.stats()["hits"], 3)
+        database.sample_cache.unlink()
+
+    def test_shared_batch_loader(self):
+        print("\tcheck -- tensormonk.data.SharedBatchLoader")
+        # image of sample i is filled with i
+        dataset = [(torch.full((3, 8, 6), float(i)), i) for i in range(50)]
+        loader = SharedBatchLoader(dataset, (1, 3, 8, 6), 16, shuffle=True,
+                                   num_workers=2)
+        self.assertEqual((len(loader), loader.n_slots), (4, 5))
+        for _ in range(2):
+            labels = []
+            for images, targets in loader:
+                self.assertTrue(torch.equal(
+                    images[:, 0, 0, 0].long(), targets))
+                labels += targets.tolist()
+            self.assertEqual(sorted(labels), list(range(50)))
+
+        # uint8 from pil images with a batch sampler
+        dataset = FewPerLabel(self.images, (1, 3, 20, 24), 2, n_samples=12)
+        loader = SharedBatchLoader(dataset, (1, 3, 20, 24), 6,
+                                   batch_sampler=dataset.batch_sampler(3),
+                                   dtype=torch.uint8)
+        loader.loader.dataset.dataset = [
+            (open_image(x, (24, 20)), int(y))
+            for x, y in zip(dataset.samples, dataset.targets)]
+        images, labels = next(iter(loader))
+        self.assertEqual((images.shape, images.dtype),
+                         ((6, 3, 20, 24), torch.uint8))
+        self.assertEqual(labels.view(3, 2)[:, 0].tolist(),
+                         labels.view(3, 2)[:, 1].tolist())
+
+    def test_thread_loader(self):
+        print("\tcheck -- tensormonk.data.ThreadLoader")
+        dataset = [(torch.full((2, 3), float(i)), i) for i in range(50)]
+        loader = ThreadLoader(dataset, 8, num_threads=3)
+        labels = [y for _, y in loader]
+        self.assertEqual(len(labels), len(loader))
+        self.assertEqual(torch.cat(labels).tolist(), list(range(50)))
+        loader = ThreadLoader(dataset, 8, shuffle=True, ordered=False,
+                              drop_last=True)
+        labels = torch.cat([y for _, y in loader]).tolist()
+        self.assertEqual(len(set(labels)), 48)
+        for x, _ in loader:
+            break
+
+        # batch_size=None -- slices of MemmapDataset
+        file_name = os.path.join(self.path, "train.npy")
+        ToMemmap(IndexedImageFolder(self.images), file_name, (1, 3, 8, 8),
+                 cpus=0, shuffle=False)
+        data = MemmapDataset(file_name, normalize=False)
+        loader = ThreadLoader(data, batch_size=None,
+                              sampler=MemmapBatchSampler(len(data), 5, False))
+        labels = [y.tolist() for _, y in loader]
+        self.assertEqual(labels, [[0] * 4 + [1], [1] * 3 + [2] * 2, [2] * 2])
+
+
+if __name__ == '__main__':
+    import cv2
+    import lmdb
+    import torch
+    import torchvision
+    from tensormonk.data import FolderToLMDB, LMDB, ShardWriter, \
+        ShardDataset, ToMemmap, MemmapDataset, MemmapBatchSampler, Flip, \
+        RandomTransforms, PKBatchSampler, FewPerLabel, FolderIndex, \
+        IndexedImageFolder, PascalVOC, SuperResolutionData, RandomBlur, \
+        ElasticSimilarity, SampleCache, SharedBatchLoader, ThreadLoader, \
+        AspectRatioBatchSampler
+    from tensormonk.layers.dog import GaussianKernel
+    from tensormonk.data.datasets import TensorLoader, load_in_memory
+    from tensormonk.data.utils import open_image, totensor, Downloader, \
+        urls_2_images
+    from tensormonk.data.live import Camera
+    unittest.main()
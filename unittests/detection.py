@@ -2,10 +2,47 @@
 
 import unittest
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 import sys
 sys.path.append("../TensorMONK")
 
 
+class Tiny(nn.Module):
+    r""" A tiny base network (strides 8, 16 and 32) """
+    def __init__(self, **kwargs):
+        super(Tiny, self).__init__()
+        self._layer_1 = nn.Sequential(
+            nn.Conv2d(3, 16, 3, stride=4, padding=1), nn.PReLU(),
+            nn.Conv2d(16, 24, 3, stride=2, padding=1), nn.PReLU())
+        self._layer_2 = nn.Sequential(
+            nn.Conv2d(24, 32, 3, stride=2, padding=1), nn.PReLU())
+        self._layer_3 = nn.Sequential(
+            nn.Conv2d(32, 48, 3, stride=2, padding=1), nn.PReLU())
+
+    def forward(self, tensor: torch.Tensor):
+        x1 = self._layer_1(tensor)
+        x2 = self._layer_2(x1)
+        x3 = self._layer_3(x2)
+        return (x1, x2, x3)
+
+
+def tiny_detector(t_size: tuple = (1, 3, 128, 128), n_label: int = 3):
+    r""" AnchorDetector with Tiny as base network """
+    config = CONFIG("tiny")
+    config.base_network = Tiny
+    config.t_size = t_size
+    config.encoding_depth = 16
+    config.body_network = "nofpn"
+    config.n_label = n_label
+    config.label_loss_kwargs = {"method": "ce_with_negative_mining"}
+    config.boxes_loss_kwargs = {"method": "smooth_l1"}
+    config.anchors_per_layer = (
+        (config.an_anchor(16, 16), config.an_anchor(24, 24)),
+        (config.an_anchor(32, 32), ), (config.an_anchor(64, 64), ))
+    return AnchorDetector(config)
+
+
 class Tester(unittest.TestCase):
 
     def test_utils_pixel_norm01(self):
@@ -75,7 +112,238 @@ class Tester(unittest.TestCase):
         output = ObjectUtils.compute_iof(ltrb1, ltrb1)
         self.assertEqual(output.squeeze().item(), 1.0)
 
+    def test_utils_reduce_iou_batch(self):
+        print("\tcheck -- tensormonk.detection.ObjectUtils.reduce_iou_batch")
+        lt = torch.rand(300, 2) * 128
+        anchors = torch.cat((lt, lt + torch.rand(300, 2) * 32 + 2), 1)
+        boxes = torch.cat((anchors[None, :6], anchors[None, :6] + 4))
+        valid = torch.rand(2, 6) > 0.3
+        for method in ("iou", "giou", "diou", "ciou", "iof"):
+            iou = ObjectUtils.compute_iou_batch(anchors, boxes, method=method)
+            if method != "iof":
+                self.assertTrue(torch.allclose(iou[0, :6].diagonal(),
+                                               torch.ones(6)))
+            iou.masked_fill_(~ valid[:, None], -float("inf"))
+            # chunked reductions are same as reductions of dense iou
+            reductions = ObjectUtils.reduce_iou_batch(
+                anchors, boxes, method, valid, chunk_size=64)
+            for x, y in zip(iou.max(2) + iou.max(1), reductions):
+                self.assertTrue(torch.equal(x, y))
+
+    def test_utils_nms(self):
+        print("\tcheck -- tensormonk.detection.ObjectUtils.*nms")
+        import torchvision
+        lt = torch.rand(2, 600, 2) * 256
+        boxes = torch.cat((lt, lt + torch.rand(2, 600, 2) * 48 + 4), 2)
+        scores = torch.rand(2, 600)
+        keep = ObjectUtils.hard_nms(boxes, scores, 0.5, chunk_size=128)
+        for i in range(2):
+            retain = torchvision.ops.nms(boxes[i], scores[i], 0.5)
+            self.assertTrue(torch.equal(retain, ObjectUtils.nms(
+                boxes[i], scores[i], 0.5)))
+            self.assertTrue(torch.equal(retain.sort()[0],
+                                        keep[i].nonzero().view(-1)))
+        self.assertEqual(ObjectUtils.nms(boxes[0].numpy(), scores[0].numpy(),
+                                         0.5, n_objects=3).shape, (3, ))
+        # decayed scores -- a box that does not overlap is not decayed
+        boxes[:, 0] = torch.Tensor([400, 400, 420, 420])
+        for decayed in (ObjectUtils.soft_nms(boxes, scores),
+                        ObjectUtils.soft_nms(boxes, scores,
+                                             method="gaussian"),
+                        ObjectUtils.matrix_nms(boxes, scores,
+                                               chunk_size=128)):
+            self.assertEqual(decayed.shape, scores.shape)
+            self.assertTrue((decayed <= scores + 1e-6).all().item())
+            self.assertTrue(torch.allclose(decayed[:, 0], scores[:, 0]))
+        fused, fused_scores = ObjectUtils.weighted_boxes_fusion(
+            boxes, scores, 0.5)
+        keep = ObjectUtils.hard_nms(boxes, scores, 0.5)
+        self.assertTrue(torch.equal(fused_scores.gt(0), keep))
+        self.assertTrue(torch.allclose(fused[:, 0], boxes[:, 0]))
+
+    def test_batch_augment(self):
+        print("\tcheck -- tensormonk.detection.BatchAugment")
+        images = torch.zeros(6, 3, 120, 160, dtype=torch.uint8)
+        images[:, :, 30:90, 40:100] = 255
+        boxes = torch.Tensor([[[40, 30, 100, 90], [0, 0, 0, 0]]] * 6)
+        valid = torch.Tensor([[1, 0]] * 6).bool()
+        augment = BatchAugment((64, 48), jitter=0., p_gray=0.)
+        tensor, new_boxes, new_valid = augment(images, boxes, valid)
+        self.assertEqual(tuple(tensor.shape), (6, 3, 48, 64))
+        self.assertFalse(new_valid[:, 1].any().item())
+        # the white box follows the adjusted boxes
+        for x, box, v in zip(tensor, new_boxes[:, 0], new_valid[:, 0]):
+            if not v:
+                continue
+            box = box.round().long().tolist()
+            inside = x[:, max(box[1], 0) + 1:box[3] - 1,
+                       max(box[0], 0) + 1:box[2] - 1]
+            if inside.numel():
+                self.assertGreater(inside.min().item(), 0.9)
+
+        # without crop, flip and jitter -- a plain resize
+        augment = BatchAugment((80, 60), crop=False, flip=0., jitter=0.,
+                               p_gray=0.)
+        tensor, new_boxes, _ = augment(images, boxes, valid)
+        self.assertTrue(torch.allclose(new_boxes[0, 0],
+                                       torch.Tensor([20, 15, 50, 45])))
+        self.assertEqual(tensor[0, 0, 30, 35].item(), 1.)
+        self.assertEqual(tensor[0, 0, 5, 5].item(), 0.)
+
+        # cpu crop, resize and flip (per image) is same as grid_sample
+        images = torch.rand(3, 3, 120, 160)
+        crops = torch.Tensor([[10, 20, 90, 80], [-10, -6, 70, 54],
+                              [100, 60, 180, 120]])
+        flip = torch.Tensor([0, 1, 1]).bool()
+        cw, ch = crops[:, 2] - crops[:, 0], crops[:, 3] - crops[:, 1]
+        theta = torch.zeros(3, 2, 3)
+        theta[:, 0, 0] = cw / 160 * torch.where(flip, -1., 1.)
+        theta[:, 0, 2] = (2 * crops[:, 0] + cw) / 160 - 1
+        theta[:, 1, 1] = ch / 120
+        theta[:, 1, 2] = (2 * crops[:, 1] + ch) / 120 - 1
+        grid = F.affine_grid(theta, (3, 3, 60, 80), align_corners=False)
+        target = F.grid_sample(images, grid, align_corners=False)
+        self.assertTrue(torch.allclose(
+            augment.crop_resize_flip(images, crops, flip), target,
+            atol=1e-2))
+
+    def test_anchor_detector_sizes(self):
+        print("\tcheck -- tensormonk.detection.AnchorDetector (input sizes)")
+        detector = tiny_detector()
+        r_label = [torch.tensor([1, 2]), torch.tensor([1])]
+        r_boxes = [torch.Tensor([[10, 10, 40, 40], [50, 60, 110, 90]]),
+                   torch.Tensor([[30, 30, 62, 62]])]
+        # aspect ratio buckets -- anchors are computed once per size
+        for h, w in ((128, 128), (96, 160), (160, 96), (96, 160)):
+            losses = detector.compute_loss(torch.rand(2, 3, h, w), r_label,
+                                           r_boxes, None)
+            self.assertTrue(torch.isfinite(losses["label"]).item())
+            centers = detector.size_anchors()[0]
+            self.assertEqual(centers.shape[0],
+                             (h // 8) * (w // 8) * 2 + (h // 16) * (w // 16) +
+                             (h // 32) * (w // 32))
+        stats = detector.anchor_stats()
+        self.assertEqual((stats["misses"], stats["n_cached"]), (2, 2))
+        self.assertGreater(stats["hits"], stats["misses"])
+        # precomputed anchors are the same as anchors computed on the fly
+        centers = detector.size_anchors()
+        detector = tiny_detector()
+        detector.precompute_anchors([(96, 160), (64, 64)])
+        detector.t_size = (2, 3, 96, 160)
+        self.assertTrue(all(torch.equal(x, y) for x, y in
+                            zip(centers, detector.size_anchors())))
+        self.assertEqual(detector.anchor_stats()["misses"], 0)
+        detector.anchor_cache_size = 1
+        detector.precompute_anchors([(64, 96)])
+        self.assertEqual(detector.anchor_stats()["evictions"], 2)
+        detector.t_size = (2, 3, 128, 128)
+        self.assertEqual(len(detector.predict(torch.rand(2, 3, 128, 128))),
+                         2)
+
+    def test_anchor_detector_batch_encode(self):
+        print("\tcheck -- tensormonk.detection.AnchorDetector.batch_encode")
+        import pickle
+        detector = tiny_detector()
+        r_label = [torch.tensor([1, 2]), torch.tensor([2]),
+                   torch.tensor([1, 1, 2])]
+        r_boxes = [torch.Tensor([[10, 10, 40, 40], [50, 60, 110, 90]]),
+                   torch.Tensor([[30, 30, 62, 62]]),
+                   torch.Tensor([[0, 0, 20, 36], [64, 8, 128, 72],
+                                 [40, 70, 90, 120]])]
+        r_point = [torch.rand(x.size(0), 4) * 128 for x in r_label]
+        targets = detector.batch_encode(r_label, r_boxes, r_point)
+        for i in range(len(r_label)):
+            target = detector.encode(r_label[i].clone(), r_boxes[i].clone(),
+                                     r_point[i].clone())
+            self.assertTrue(target.label.gt(0).any().item())
+            self.assertTrue(torch.equal(target.label, targets.label[i]))
+            self.assertTrue(torch.allclose(target.boxes, targets.boxes[i]))
+            self.assertTrue(torch.allclose(target.point, targets.point[i]))
+            self.assertTrue(torch.allclose(target.objectness,
+                                           targets.objectness[i]))
+            valid = target.label.gt(0)
+            self.assertTrue(torch.allclose(target.centerness[valid],
+                                           targets.centerness[i][valid]))
+        # padded tensors with a mask, and an encoder for DataLoader workers
+        label = torch.tensor([[1, 2, 0], [2, 0, 0], [1, 1, 2]])
+        boxes = torch.zeros(3, 3, 4)
+        for i, x in enumerate(r_boxes):
+            boxes[i, :x.size(0)] = x
+        encoder = pickle.loads(pickle.dumps(detector.target_encoder()))
+        padded = encoder(label, boxes, None, label.gt(0))
+        self.assertTrue(torch.equal(padded.label, targets.label))
+        self.assertTrue(torch.allclose(padded.boxes, targets.boxes))
+        # anchors are picked with the size of images (transposed sizes have
+        # equal anchors)
+        sizes = ((96, 160), (160, 96), (128, 128))
+        encoder = pickle.loads(pickle.dumps(detector.target_encoder(sizes)))
+        for h, w in sizes:
+            images = torch.rand(3, 3, h, w)
+            detector(images)
+            targets = detector.batch_encode(label, boxes, None, label.gt(0))
+            padded = encoder(label, boxes, None, label.gt(0),
+                             size=images.shape)
+            self.assertTrue(torch.equal(padded.label, targets.label))
+            self.assertTrue(torch.allclose(padded.boxes, targets.boxes))
+        with self.assertRaises(ValueError):
+            encoder(label, boxes, None, label.gt(0))
+        with self.assertRaises(ValueError):
+            encoder(label, boxes, None, label.gt(0), size=(64, 64))
+
+    def test_anchor_detector_batch_detect(self):
+        print("\tcheck -- tensormonk.detection.AnchorDetector.batch_detect")
+        detector = tiny_detector()
+        n_anchors = detector.centers.size(0)
+        p_label = torch.sigmoid(torch.randn(3, n_anchors, 3) * 2 - 3)
+        p_boxes = torch.randn(3, n_anchors, 4) * 0.2 + 1
+        detections = detector.batch_detect(p_label, p_boxes, None)
+        padded, counts = detector.batch_detect(p_label, p_boxes, None,
+                                               padded=True)
+        for i, x in enumerate(detections):
+            target = detector.detect(p_label[i], p_boxes[i], None)
+            self.assertTrue(torch.equal(target.label, x.label))
+            self.assertTrue(torch.allclose(target.score, x.score))
+            self.assertTrue(torch.allclose(target.boxes, x.boxes))
+            self.assertEqual(counts[i].item(), x.label.numel())
+            self.assertTrue(torch.equal(padded.boxes[i, :counts[i]],
+                                        x.boxes))
+            self.assertTrue(padded.label[i, counts[i]:].eq(0).all().item())
+        # per label nms and top_k
+        padded, counts = detector.batch_detect(
+            p_label, p_boxes, None, top_k=20, per_class=True, padded=True)
+        self.assertEqual(tuple(padded.boxes.shape), (3, 20, 4))
+        self.assertTrue(counts.le(20).all().item())
+
+    def test_anchor_detector_select_candidates(self):
+        print("\tcheck -- tensormonk.detection.AnchorDetector."
+              "select_candidates")
+        detector = tiny_detector()
+        n_anchors = detector.centers.size(0)
+        p_label = torch.sigmoid(torch.randn(2, n_anchors, 3) * 0.5 + 2)
+        p_boxes = torch.randn(2, n_anchors, 4) * 0.2 + 1
+        # logits are thresholded before activation
+        score = p_label[:, :, 1]
+        keep = detector.select_candidates(score)
+        self.assertTrue(torch.equal(keep, detector.select_candidates(
+            score.logit(), torch.tensor([True, True]))))
+        # limits per level
+        limits = (40, 20, 10)
+        detector.config.detect_candidates_per_level = limits
+        keep = detector.select_candidates(score)
+        sizes = [x[2] * x[3] * len(y) for x, y in zip(
+            detector.c_sizes, detector.config.anchors_per_layer)]
+        for level, limit in zip(keep.split(sizes, 1), limits):
+            self.assertTrue(level.sum(1).eq(limit).all().item())
+        for i, x in enumerate(detector.batch_detect(p_label, p_boxes, None)):
+            target = detector.detect(p_label[i], p_boxes[i], None)
+            self.assertTrue(torch.equal(target.label, x.label))
+            self.assertTrue(torch.allclose(target.boxes, x.boxes))
+            self.assertTrue(x.label.numel() <= sum(limits))
+        detector.config.detect_candidates_per_level = (40, 20)
+        self.assertRaises(ValueError, detector.select_candidates, score)
+
 
 if __name__ == '__main__':
-    from tensormonk.detection import ObjectUtils
+    from tensormonk.detection import ObjectUtils, BatchAugment, CONFIG, \
+        AnchorDetector
     unittest.main()